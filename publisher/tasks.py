@@ -1,5 +1,7 @@
 from publisher.worker.exceptions import RetryException
+from publisher.worker.state import StateReporter
 import publisher.worker
+from django.conf import settings
 
 import time
 import math
@@ -34,17 +36,31 @@ def update_sent_state(sender=None, headers=None, body=None, **kwargs):
         backend.store_result(headers['id'], None, "SENT")
 
 
-@shared_task(track_started=True, max_retries=4)
+# The job is acknowledged when it is finished, so the broker redelivers the
+# job of a killed worker. The redelivered job resumes from the recovery
+# checkpoint in its working dir.
+@shared_task(track_started=True, max_retries=4, acks_late=True,
+             reject_on_worker_lost=True)
 def publish(download_url, test_url, status_url, backend, backend_parameters,
             recovery=None):
     start_time = time.time()
+    # Resource usage of the job (e.g. downloaded bytes, peak memory usage)
+    job_stats = {}
 
-    def update_state(state, percent=0, msg=None, remaining_time=None):
+    def push_state(state, meta):
+        publish.update_state(state=state,  # @UndefinedVariable
+                             meta=meta)
+    # Only meaningful state changes are written to the result back end
+    state_reporter = StateReporter(push_state, settings.PUBLISHER_STATE_UPDATE_INTERVAL)
+
+    def update_state(state, percent=0, msg=None, remaining_time=None, stats=None):
+        if stats:
+            job_stats.update(stats)
         meta = {'msg': msg, 'percent': percent, 'remaining': remaining_time,
-                'timestamp': start_time, 'heartbeat': time.time()}
+                'timestamp': start_time, 'heartbeat': time.time(),
+                'stats': job_stats}
         custom_state = state.upper()
-        publish.update_state(state=custom_state,  # @UndefinedVariable
-                             meta=meta)
+        state_reporter.update(custom_state, percent, meta)
 
     try:
         publisher.worker.publish(download_url,
@@ -60,7 +76,10 @@ def publish(download_url, test_url, status_url, backend, backend_parameters,
                             backend, backend_parameters),
                       kwargs={'recovery': e.recovery_parameters},
                       countdown=30 * math.pow(2, publish.request.retries))
-    return {'timestamp': start_time}
+    finally:
+        # The final progress of the last phase
+        state_reporter.flush()
+    return {'timestamp': start_time, 'stats': job_stats}
 
 
 @shared_task(track_started=True, max_retries=12,
@@ -0,0 +1,133 @@
+'''
+In memory back end for the manager tests
+'''
+import os
+import time
+from io import BytesIO
+
+from publisher.worker.managers.backends import ConnectionBackEnd
+
+
+class MemoryBackEnd(ConnectionBackEnd):
+    """
+    Back end that keeps the files (path -> bytes) and folders in memory.
+    All back end calls are recorded in calls. Every call waits latency
+    seconds to simulate the round trip to a remote server. Clones share the
+    storage and the recorded calls.
+    """
+
+    def __init__(self, files=None, folders=None, latency=0):
+        self.files = files if files is not None else {}
+        self.folders = folders if folders is not None else set()
+        self.permissions = {}
+        self.calls = []
+        self.connected = False
+        self.latency = latency
+
+    def _call(self, *call):
+        self.calls.append(call)
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _norm(self, path):
+        path = os.path.normpath(path)
+        return '' if path == '.' else path
+
+    def _children(self, folder):
+        folder = self._norm(folder)
+        return [path for path in list(self.files) + list(self.folders)
+                if os.path.dirname(path) == folder]
+
+    def connect(self):
+        self._call('connect')
+        self.connected = True
+
+    def quit(self):
+        self._call('quit')
+        self.connected = False
+
+    def _connection_key(self):
+        return id(self.files)
+
+    def clone(self):
+        clone = MemoryBackEnd(self.files, self.folders, self.latency)
+        clone.permissions = self.permissions
+        clone.calls = self.calls
+        return clone
+
+    def exists(self, path):
+        self._call('exists', path)
+        path = self._norm(path)
+        return path in self.files or path in self.folders or path == ''
+
+    def dir(self, folder):
+        self._call('dir', folder)
+        return [os.path.join(folder, os.path.basename(path))
+                for path in self._children(folder)]
+
+    def type(self, path):
+        self._call('type', path)
+        path = self._norm(path)
+        if path in self.folders:
+            return 'd'
+        return '-' if path in self.files else None
+
+    def size(self, path):
+        self._call('size', path)
+        return len(self.files[self._norm(path)])
+
+    def dir_sizes(self, folder):
+        self._call('dir_sizes', folder)
+        return dict((os.path.basename(path), len(self.files[path]))
+                    for path in self._children(folder) if path in self.files)
+
+    def dir_entries(self, folder):
+        self._call('dir_entries', folder)
+        return [(os.path.basename(path), 'd' if path in self.folders else '-',
+                 len(self.files[path]) if path in self.files else None)
+                for path in self._children(folder)]
+
+    def download(self, path):
+        self._call('download', path)
+        return BytesIO(self.files[self._norm(path)])
+
+    def upload(self, path, fp, permission=None):
+        self._call('upload', path)
+        self.files[self._norm(path)] = fp.read()
+        if permission:
+            self.permissions[self._norm(path)] = permission
+
+    def mkdir(self, path):
+        self._call('mkdir', path)
+        self.folders.add(self._norm(path))
+
+    def delete_file(self, path):
+        self._call('delete_file', path)
+        return self.files.pop(self._norm(path), None) is not None
+
+    def delete_directory(self, path):
+        self._call('delete_directory', path)
+        path = self._norm(path)
+        if path not in self.folders or self._children(path):
+            return False
+        self.folders.remove(path)
+        return True
+
+    def chmod(self, path, permission):
+        self._call('chmod', path)
+        self.permissions[self._norm(path)] = permission
+
+    def erase_directory(self, folder):
+        self._call('erase_directory', folder)
+        folder = self._norm(folder)
+        for path in list(self.files):
+            if path.startswith(folder + '/'):
+                del self.files[path]
+        for path in list(self.folders):
+            if path.startswith(folder + '/'):
+                self.folders.remove(path)
+        return True
+
+    def uploaded(self):
+        """ Returns the uploaded paths """
+        return [call[1] for call in self.calls if call[0] == 'upload']
@@ -0,0 +1,112 @@
+import unittest
+import os
+import shutil
+import tempfile
+import zipfile
+from mock import Mock, MagicMock
+
+from publisher.worker.archive import ZipArchive
+from publisher.worker.exceptions import NoRetryException
+from publisher.worker.managers import manifestbased
+from publisher.worker.managers.backends import SFTPUploadBackEnd
+
+
+class ZipArchiveTest(unittest.TestCase):
+
+    files = {'writeable.txt': b'media\n',
+             'website/index.html': b'<html></html>',
+             'website/media/image.png': b'PNG data',
+             'website/media/thumbs/small.png': b'small PNG data',
+             'website/css/style.css': b'body {}'}
+
+    def setUp(self):
+        self.working_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.working_dir)
+        self.archive_path = os.path.join(self.working_dir, 'download.zip')
+        with zipfile.ZipFile(self.archive_path, 'w', zipfile.ZIP_STORED) as zfile:
+            zfile.writestr('website/', b'')
+            zfile.writestr('website/empty/', b'')
+            for name, data in sorted(self.files.items()):
+                zfile.writestr(name, data)
+        self.archive = ZipArchive(self.archive_path)
+        self.addCleanup(self.archive.close)
+
+    def type_mapper(self, path):
+        return 'w' if path.startswith('media') else 'r'
+
+    def test_file_list_matches_extracted_folder(self):
+        extract_dir = os.path.join(self.working_dir, 'extracted')
+        with zipfile.ZipFile(self.archive_path) as zfile:
+            zfile.extractall(extract_dir)
+        local_list = manifestbased.FileList()
+        local_list.scan_local_folder(os.path.join(extract_dir, 'website'), self.type_mapper)
+
+        archive_list = self.archive.get_file_list(self.type_mapper)
+        self.assertEqual(sorted(archive_list.get_files()), sorted(local_list.get_files()))
+        self.assertEqual(sorted(archive_list.get_folders()), sorted(local_list.get_folders()))
+        for path in local_list.get_files():
+            self.assertEqual(archive_list.get_file(path).size, local_list.get_file(path).size)
+            self.assertEqual(archive_list.get_file(path).permission,
+                             local_list.get_file(path).permission)
+            self.assertIsNone(archive_list.get_file(path).checksum)
+            self.assertIsNotNone(archive_list.get_file(path).crc)
+
+    def test_open(self):
+        with self.archive.open('./index.html') as fp:
+            self.assertEqual(fp.read(), b'<html></html>')
+        with self.archive.open('media/thumbs/small.png') as fp:
+            self.assertEqual(fp.read(), b'small PNG data')
+
+    def test_open_bad_crc(self):
+        with open(self.archive_path, 'rb') as f:
+            raw = bytearray(f.read())
+        raw[raw.index(b'PNG data')] = ord('X')
+        with open(self.archive_path, 'wb') as f:
+            f.write(raw)
+        with self.archive.open('media/image.png') as fp:
+            self.assertRaises(NoRetryException, fp.read)
+
+    def test_rewind(self):
+        data = os.urandom(256 * 1024)
+        with zipfile.ZipFile(self.archive_path, 'a', zipfile.ZIP_DEFLATED) as zfile:
+            zfile.writestr('website/large.bin', data)
+        with self.archive.open('large.bin') as fp:
+            fp.read(1024)
+            self.assertEqual(fp.tell(), 1024)
+            fp.seek(0)
+            self.assertEqual(fp.read(), data)
+            # The CRC check starts again after rewinding a completely read member
+            fp.seek(0)
+            self.assertEqual(fp.read(), data)
+
+    def test_retried_upload_sends_the_whole_member(self):
+        sftp = SFTPUploadBackEnd('server', 'user', 'pass', 'basedir', 22, chunk_size=4)
+        sftp._sftp = Mock()
+        remote_file = MagicMock()
+        sftp._sftp.open = Mock(return_value=remote_file)
+        sftp._sftp.stat = Mock(return_value=Mock(st_size=8))
+        sftp.connect = Mock()
+        sftp.quit = Mock()
+        written = []
+
+        def write(chunk):
+            if written and sftp.connect.call_count == 0:
+                raise IOError('Boom!')
+            written.append(chunk)
+        remote_file.write = Mock(side_effect=write)
+        with self.archive.open('media/image.png') as fp:
+            sftp.upload('media/image.png', fp)
+        self.assertEqual(b''.join(written[1:]), b'PNG data')
+
+    def test_upload_of_a_not_rewindable_file(self):
+        sftp = SFTPUploadBackEnd('server', 'user', 'pass', 'basedir', 22)
+        sftp._sftp = Mock()
+        sftp.connect = Mock()
+        sftp.abort = Mock()
+        fp = Mock(spec=['read'])
+        self.assertRaises(IOError, sftp.upload, 'test.txt', fp)
+        self.assertFalse(sftp._sftp.open.called)
+
+
+if __name__ == "__main__":
+    unittest.main()
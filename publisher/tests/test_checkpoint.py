@@ -0,0 +1,75 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+from publisher.worker.checkpoint import RecoveryCheckpoint, CHECKPOINT_JOURNAL_FILE
+from publisher.worker.managers import manifestbased
+
+
+class RecoveryCheckpointTest(unittest.TestCase):
+
+    def setUp(self):
+        self.working_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.working_dir)
+        self.now = 100.0
+        self.checkpoint = RecoveryCheckpoint(self.working_dir, 10, clock=lambda: self.now)
+        self.addCleanup(self.checkpoint.close)
+
+    def _tasklist(self):
+        local_list = manifestbased.FileList()
+        local_list.read_manifest({'files': [('FILE', 'new%d.txt' % i, 'r', 4, 'md5')
+                                            for i in range(3)],
+                                  'folders': [('DIR', 'folder', 'r')]})
+        remote_list = manifestbased.FileList()
+        remote_list.read_manifest({'files': [('FILE', 'old.txt', 'r', 4, 'md5')],
+                                   'folders': []})
+        return manifestbased.TaskList(local_list, remote_list, lambda a, b: False)
+
+    def _done(self, tasklist):
+        return sorted(task.task.path for task in
+                      manifestbased.filter_finished_tasks(
+                          tasklist.new_files + tasklist.delete_files + tasklist.create_folders))
+
+    def test_no_checkpoint(self):
+        self.assertFalse(self.checkpoint.exists())
+        self.assertIsNone(self.checkpoint.load())
+
+    def test_load_journaled_tasks(self):
+        tasklist = self._tasklist()
+        self.checkpoint.start(tasklist)
+        tasklist.new_files[0].task.old = False
+        self.checkpoint.record('upload_files', tasklist.new_files[0].task)
+        tasklist.delete_files[0].task.old = True
+        self.checkpoint.record('delete_files', tasklist.delete_files[0].task)
+        self.checkpoint.close()
+
+        loaded = self.checkpoint.load()
+        self.assertEqual(self._done(loaded),
+                         sorted([tasklist.new_files[0].task.path, 'old.txt']))
+        self.assertTrue(loaded.delete_files[0].task.old)
+        self.assertGreater(loaded.get_progress(1), 0.0)
+
+    def test_incomplete_record_is_ignored(self):
+        tasklist = self._tasklist()
+        self.checkpoint.start(tasklist)
+        self.checkpoint.record('create_folders', tasklist.create_folders[0].task)
+        self.checkpoint.close()
+        with open(os.path.join(self.working_dir, CHECKPOINT_JOURNAL_FILE), 'a') as journal:
+            journal.write('["upload_files", "new')
+        self.assertEqual(self._done(self.checkpoint.load()), ['folder'])
+
+    def test_start_keeps_finished_tasks(self):
+        tasklist = self._tasklist()
+        self.checkpoint.start(tasklist)
+        self.checkpoint.record('delete_files', tasklist.delete_files[0].task)
+        self.checkpoint.close()
+
+        loaded = self.checkpoint.load()
+        self.checkpoint.start(loaded)
+        self.checkpoint.close()
+        self.assertEqual(self._done(self.checkpoint.load()), ['old.txt'])
+
+
+if __name__ == "__main__":
+    unittest.main()
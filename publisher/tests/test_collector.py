@@ -1,6 +1,16 @@
 import unittest
 import mock
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import zipfile
+from http.server import BaseHTTPRequestHandler, HTTPServer
 from publisher.worker import collector
+from publisher.worker.exceptions import NoRetryException
 
 
 class TestableZipCollector(collector.ZIPCollector):
@@ -11,8 +21,10 @@ class TestableZipCollector(collector.ZIPCollector):
         self.url_content = url_content
         self.is_zip = is_zip
 
-    def _open_url(self, url):
-        return mock.mock_open(self.url_file_mock, self.url_content)(url)
+    def _open_url(self, url, headers=None):
+        url_file = mock.mock_open(self.url_file_mock, self.url_content)(url)
+        url_file.headers = {}
+        return url_file
 
     def _open_zip(self, zdata):
         self.zip_mock(zdata)
@@ -27,60 +39,264 @@ class TestableZipCollector(collector.ZIPCollector):
 
 class Test(unittest.TestCase):
 
+    def setUp(self):
+        self.working_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.working_dir)
+
     def test_normal_case(self):
+        working_dir = self.working_dir
         url_mock = mock.Mock()
         attrs = {'testzip.return_value': [],
-                 'namelist.return_value': ['test.txt'], }
+                 'namelist.return_value': ['test.txt'],
+                 'infolist.return_value': [], }
         zip_mock = mock.Mock(name="Zipfile mock", **attrs)
-        col = TestableZipCollector(url_mock, "Testdata", zip_mock)
-        col.collect(mock.sentinel.url, mock.sentinel.workdir)
+        col = TestableZipCollector(url_mock, b"Testdata", zip_mock)
+        col.collect(mock.sentinel.url, working_dir)
         url_mock.assert_called_once_with(mock.sentinel.url)
-        zip_mock.testzip.assert_any_call()
         zip_mock.namelist.assert_any_call()
-        zip_mock.extractall.assert_called_with(mock.sentinel.workdir)
+        zip_mock.infolist.assert_any_call()
+        self.assertFalse(zip_mock.testzip.called)
         calls = zip_mock.method_calls
-        self.assertLess(calls.index(mock.call.testzip()),
-                        calls.index(mock.call.extractall(mock.sentinel.workdir)),
-                        "Zip file not tested before extraction")
         self.assertLess(calls.index(mock.call.namelist()),
-                        calls.index(mock.call.extractall(mock.sentinel.workdir)),
+                        calls.index(mock.call.infolist()),
                         "Zip file not tested before extraction")
 
+    def test_extract_with_checksums(self):
+        working_dir = self.working_dir
+        files = {'writeable.txt': b'media\n',
+                 'website/index.html': b'<html></html>',
+                 'website/media/big.bin': os.urandom(collector.EXTRACT_CHUNK_SIZE + 1)}
+        zdata = io.BytesIO()
+        with zipfile.ZipFile(zdata, 'w', zipfile.ZIP_DEFLATED) as zfile:
+            zfile.writestr('website/', b'')
+            zfile.writestr('website/empty/', b'')
+            for name, data in files.items():
+                zfile.writestr(name, data)
+        zdata.seek(0)
+
+        col = collector.ZIPCollector()
+        col._write_checksums(col._extractData(zdata, working_dir), working_dir)
+        self.assertTrue(os.path.isdir(os.path.join(working_dir, 'website/empty')))
+
+        checksums = collector.read_checksums(working_dir)
+        self.assertEqual(len(checksums), 3)
+        for name, data in files.items():
+            with open(os.path.join(working_dir, name), 'rb') as f:
+                self.assertEqual(f.read(), data)
+            self.assertEqual(checksums[name], [len(data), hashlib.md5(data).hexdigest(),
+                                               zipfile.crc32(data)])
+        with open(os.path.join(working_dir, collector.CHECKSUM_FILE)) as f:
+            self.assertEqual(json.load(f), checksums)
+
+    def test_download_spools_to_disk(self):
+        data = os.urandom(collector.DOWNLOAD_CHUNK_SIZE * 3 + 17)
+        state_mock = mock.Mock()
+        col = collector.ZIPCollector(spool_size=1024, state_callback=state_mock)
+        url_file = mock.mock_open(read_data=data)()
+        url_file.headers = {'Content-Length': str(len(data))}
+        col._open_url = lambda url, headers=None: url_file
+        downloaded = col._downloadData(mock.sentinel.url)
+        self.assertTrue(downloaded._rolled)
+        self.assertEqual(downloaded.read(), data)
+        state_mock.assert_called_once_with(
+            collector.ZIPCollector.STATE_DOWNLOADING, None, None, None,
+            {'downloaded_bytes': len(data), 'peak_rss_kb': mock.ANY})
+
+    def _write_zip_file(self, files, compression=zipfile.ZIP_DEFLATED):
+        archive_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, archive_dir)
+        archive_path = os.path.join(archive_dir, 'archive.zip')
+        with zipfile.ZipFile(archive_path, 'w', compression) as zfile:
+            for name, data in sorted(files.items()):
+                zfile.writestr(name, data)
+        return archive_path
+
+    def test_parallel_extract(self):
+        files = dict(('website/folder%d/file%d.bin' % (i % 3, i), os.urandom(i * 1000))
+                     for i in range(20))
+        archive_path = self._write_zip_file(files)
+        col = collector.ZIPCollector(extract_workers=4)
+        with open(archive_path, 'rb') as zdata:
+            checksums = col._extractData(zdata, self.working_dir)
+        self.assertEqual(len(checksums), 20)
+        for name, data in files.items():
+            with open(os.path.join(self.working_dir, name), 'rb') as f:
+                self.assertEqual(f.read(), data)
+            self.assertEqual(checksums[name], [len(data), hashlib.md5(data).hexdigest(),
+                                               zipfile.crc32(data)])
+
+    def test_parallel_extract_bad_file(self):
+        files = dict(('website/file%d.txt' % i, b'data %d' % i) for i in range(10))
+        files['website/file5.txt'] = b'bad data'
+        archive_path = self._write_zip_file(files, zipfile.ZIP_STORED)
+        with open(archive_path, 'rb') as f:
+            raw = bytearray(f.read())
+        raw[raw.index(b'bad data')] = ord('B')
+        with open(archive_path, 'wb') as f:
+            f.write(raw)
+
+        col = collector.ZIPCollector(extract_workers=3)
+        with open(archive_path, 'rb') as zdata:
+            self.assertRaises(NoRetryException, col._extractData, zdata, self.working_dir)
+        self.assertEqual(os.listdir(self.working_dir), [])
+
+    def test_extract_with_hash_cache(self):
+        files = {'website/a.txt': b'aaa', 'website/b.txt': b'bbb'}
+        archive_path = self._write_zip_file(files)
+        hash_cache = mock.Mock()
+        hash_cache.get_many = mock.Mock(return_value={('website/a.txt', zipfile.crc32(b'aaa'), 3):
+                                                      'cached'})
+        col = collector.ZIPCollector(hash_cache=hash_cache)
+        with open(archive_path, 'rb') as zdata:
+            checksums = col._extractData(zdata, self.working_dir)
+        self.assertEqual(checksums['website/a.txt'], [3, 'cached', zipfile.crc32(b'aaa')])
+        self.assertEqual(checksums['website/b.txt'], [3, hashlib.md5(b'bbb').hexdigest(),
+                                                      zipfile.crc32(b'bbb')])
+        hash_cache.put_many.assert_called_once_with(
+            {('website/b.txt', zipfile.crc32(b'bbb'), 3): hashlib.md5(b'bbb').hexdigest()})
+        with open(os.path.join(self.working_dir, 'website/a.txt'), 'rb') as f:
+            self.assertEqual(f.read(), b'aaa')
+
+    def test_split_member_ranges(self):
+        infolist = [mock.Mock(compress_size=size) for size in (10, 10, 10, 10, 40)]
+        member_ranges = collector.split_member_ranges(infolist, 2)
+        self.assertEqual(member_ranges, [infolist[:4], infolist[4:]])
+        self.assertEqual(collector.split_member_ranges(infolist[:1], 4), [infolist[:1]])
+
+    def test_collect_with_member_filter(self):
+        archive_path = self._write_zip_file({'writeable.txt': b'media', 'website/a.txt': b'a'})
+        with open(archive_path, 'rb') as f:
+            url_file = io.BytesIO(f.read())
+        url_file.headers = {}
+        col = collector.ZIPCollector()
+        col._open_url = lambda url, headers=None: url_file
+        col.collect(mock.sentinel.url, self.working_dir,
+                    lambda name: not name.startswith('website/'))
+        self.assertEqual(sorted(os.listdir(self.working_dir)),
+                         [collector.CHECKSUM_FILE, collector.DOWNLOAD_FILE, 'writeable.txt'])
+
+    def test_read_checksums_without_file(self):
+        self.assertIsNone(collector.read_checksums(self.working_dir))
+
     def test_bad_download(self):
         url_mock = mock.Mock(side_effect=Exception)
         attrs = {'testzip.return_value': [],
                  'namelist.return_value': ['test.txt'], }
         zip_mock = mock.Mock(name="Zipfile mock", **attrs)
-        col = TestableZipCollector(url_mock, "Testdata", zip_mock)
+        col = TestableZipCollector(url_mock, b"Testdata", zip_mock)
         self.assertRaises(Exception, col.collect, mock.sentinel.url,
-                          mock.sentinel.workdir)
+                          self.working_dir)
 
     def test_bad_file(self):
-        url_mock = mock.Mock()
-        attrs = {'testzip.return_value': ['test.txt'],
-                 'namelist.return_value': ['test.txt'], }
-        zip_mock = mock.Mock(name="Zipfile mock", **attrs)
-        col = TestableZipCollector(url_mock, "Testdata", zip_mock)
-        self.assertRaises(Exception, col.collect, mock.sentinel.url,
-                          mock.sentinel.workdir)
+        zdata = io.BytesIO()
+        with zipfile.ZipFile(zdata, 'w', zipfile.ZIP_STORED) as zfile:
+            zfile.writestr('website/a/good.txt', b'good data')
+            zfile.writestr('website/b/bad.txt', b'bad data')
+        raw = bytearray(zdata.getvalue())
+        raw[raw.index(b'bad data')] = ord('B')
+        col = collector.ZIPCollector()
+        self.assertRaises(NoRetryException, col._extractData,
+                          io.BytesIO(bytes(raw)), self.working_dir)
+        self.assertEqual(os.listdir(self.working_dir), [])
 
     def test_bad_filename(self):
         url_mock = mock.Mock()
         attrs = {'testzip.return_value': [],
                  'namelist.return_value': ['../test.txt'], }
         zip_mock = mock.Mock(name="Zipfile mock", **attrs)
-        col = TestableZipCollector(url_mock, "Testdata", zip_mock)
-        self.assertRaises(Exception, col.collect, mock.sentinel.url,
-                          mock.sentinel.workdir)
+        col = TestableZipCollector(url_mock, b"Testdata", zip_mock)
+        self.assertRaises(NoRetryException, col.collect, mock.sentinel.url,
+                          self.working_dir)
 
     def test_no_zip(self):
         url_mock = mock.Mock()
         attrs = {'testzip.return_value': [],
                  'namelist.return_value': [], }
         zip_mock = mock.Mock(name="Zipfile mock", **attrs)
-        col = TestableZipCollector(url_mock, "Testdata", zip_mock, False)
-        self.assertRaises(Exception, col.collect, mock.sentinel.url,
-                          mock.sentinel.workdir)
+        col = TestableZipCollector(url_mock, b"Testdata", zip_mock, False)
+        self.assertRaises(NoRetryException, col.collect, mock.sentinel.url,
+                          self.working_dir)
+
+
+class RangeRequestHandler(BaseHTTPRequestHandler):
+    """
+    Stand-in for the publisher instance with range request support. The
+    server drops the connection after `fail_after` bytes of a response.
+    """
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+        start = 0
+        range_header = self.headers.get('Range')
+        if range_header and self.headers.get('If-Range') == server.etag:
+            start = int(range_header[len('bytes='):].split('-')[0])
+        data = server.data[start:]
+        self.send_response(206 if start else 200)
+        self.send_header('ETag', server.etag)
+        self.send_header('Content-Length', str(len(data)))
+        if start:
+            self.send_header('Content-Range', 'bytes %d-%d/%d'
+                             % (start, len(server.data) - 1, len(server.data)))
+        self.end_headers()
+        if server.fail_after is not None:
+            data = data[:server.fail_after]
+            server.fail_after = None
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class ResumeDownloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.working_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.working_dir)
+        self.server = HTTPServer(('127.0.0.1', 0), RangeRequestHandler)
+        self.server.data = os.urandom(300 * 1024)
+        self.server.etag = '"v1"'
+        self.server.fail_after = 100 * 1024
+        self.server.requests = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = 'http://127.0.0.1:%d/export.zip' % self.server.server_port
+        self.collector = collector.ZIPCollector(spool_size=1024)
+
+    def test_resume_download(self):
+        self.assertRaises(collector.DownloadRetryException,
+                          self.collector._downloadData, self.url, self.working_dir)
+        self.assertEqual(os.path.getsize(os.path.join(self.working_dir, collector.DOWNLOAD_FILE)),
+                         100 * 1024)
+
+        with self.collector._downloadData(self.url, self.working_dir) as downloaded:
+            self.assertEqual(downloaded.read(), self.server.data)
+        self.assertEqual(self.server.requests[1]['Range'], 'bytes=%d-' % (100 * 1024))
+        self.assertEqual(self.server.requests[1]['If-Range'], '"v1"')
+
+    def test_restart_download_on_changed_file(self):
+        self.assertRaises(collector.DownloadRetryException,
+                          self.collector._downloadData, self.url, self.working_dir)
+        self.server.etag = '"v2"'
+        self.server.data = os.urandom(200 * 1024)
+
+        with self.collector._downloadData(self.url, self.working_dir) as downloaded:
+            self.assertEqual(downloaded.read(), self.server.data)
+        self.assertIn('Range', self.server.requests[1])
+
+    def test_collect_removes_download(self):
+        zdata = io.BytesIO()
+        with zipfile.ZipFile(zdata, 'w') as zfile:
+            zfile.writestr('website/index.html', os.urandom(300 * 1024))
+        self.server.data = zdata.getvalue()
+        self.server.fail_after = None
+
+        self.collector.collect(self.url, self.working_dir)
+        self.assertEqual(sorted(os.listdir(self.working_dir)),
+                         [collector.CHECKSUM_FILE, 'website'])
 
 
 if __name__ == "__main__":
@@ -0,0 +1,112 @@
+import unittest
+from mock import Mock, patch
+
+from publisher.worker.managers.connections import ConnectionCache
+from publisher.worker.managers.backends import FTPUploadBackEnd, SFTPUploadBackEnd
+
+
+class ConnectionCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 100.0
+        self.cache = ConnectionCache(2, idle_timeout=60, max_age=300, clock=lambda: self.now)
+        self.closed = []
+
+    def _entry(self, name):
+        return self.cache.create(name, self.closed.append)
+
+    def test_reuse(self):
+        self.cache.checkin('key', self._entry('a'))
+        self.assertIsNone(self.cache.checkout('other', lambda c: True))
+        self.assertEqual(self.cache.checkout('key', lambda c: True).connection, 'a')
+        self.assertIsNone(self.cache.checkout('key', lambda c: True))
+        self.assertEqual(self.closed, [])
+
+    def test_idle_timeout(self):
+        self.cache.checkin('key', self._entry('a'))
+        self.now += 61
+        self.assertIsNone(self.cache.checkout('key', lambda c: True))
+        self.assertEqual(self.closed, ['a'])
+
+    def test_max_age(self):
+        entry = self._entry('a')
+        self.now += 250
+        self.cache.checkin('key', entry)
+        self.now += 51
+        self.assertIsNone(self.cache.checkout('key', lambda c: True))
+        self.assertEqual(self.closed, ['a'])
+        self.cache.checkin('key', entry)
+        self.assertEqual(len(self.cache), 0)
+
+    def test_dead_connection_is_dropped(self):
+        self.cache.checkin('key', self._entry('a'))
+        self.cache.checkin('key', self._entry('b'))
+        is_alive = Mock(side_effect=[IOError('Boom!'), True])
+        self.assertEqual(self.cache.checkout('key', is_alive).connection, 'a')
+        self.assertEqual(self.closed, ['b'])
+
+    def test_cache_full(self):
+        for name in 'abc':
+            self.cache.checkin(name, self._entry(name))
+        self.assertEqual(len(self.cache), 2)
+        self.assertEqual(self.closed, ['c'])
+        self.cache.clear()
+        self.assertEqual(sorted(self.closed), ['a', 'b', 'c'])
+
+
+class BackEndConnectionReuseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = ConnectionCache(4)
+
+    def test_ftp_session_is_reused(self):
+        ftp = FTPUploadBackEnd('server', 'user', 'pass', 'basedir', 21,
+                               connection_cache=self.cache)
+        session = ftp._ftp = Mock()
+        ftp._track_connection()
+        ftp.quit()
+        self.assertFalse(session.quit.called)
+        self.assertEqual(len(self.cache), 1)
+
+        # FTPUploadBackEnd.connect can be replaced by other tests
+        other = ftp.clone()
+        self.assertEqual(other._checkout_connection()[0], session)
+        session.voidcmd.assert_called_once_with('NOOP')
+
+        other.password = 'other'
+        self.assertIsNone(other._checkout_connection())
+
+    def test_ftp_abort_closes_the_session(self):
+        ftp = FTPUploadBackEnd('server', 'user', 'pass', 'basedir', 21,
+                               connection_cache=self.cache)
+        session = ftp._ftp = Mock()
+        ftp._track_connection()
+        ftp.abort()
+        session.quit.assert_called_once_with()
+        self.assertEqual(len(self.cache), 0)
+
+    @patch('paramiko.SFTPClient')
+    @patch('paramiko.Transport')
+    def test_sftp_session_is_reused(self, transport, _client):
+        sftp = SFTPUploadBackEnd('server', 'user', 'pass', 'basedir', 22,
+                                 connection_cache=self.cache)
+        sftp.connect()
+        session = sftp._sftp
+        sftp.quit()
+        self.assertFalse(session.close.called)
+
+        other = sftp.clone()
+        other.connect()
+        self.assertEqual(transport.call_count, 1)
+        self.assertIs(other._sftp, session)
+        session.stat.assert_called_once_with('.')
+
+        transport.return_value.is_active.return_value = False
+        other.quit()
+        other.connect()
+        self.assertEqual(transport.call_count, 2)
+        session.close.assert_called_once_with()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -4,8 +4,16 @@ Created on 30.01.2013
 @author: mtrunner
 '''
 import unittest
+import ftplib
+import os
+import shutil
+import tempfile
+from io import BytesIO
 from mock import Mock
+from publisher.worker.managers import manifestbased
 from publisher.worker.managers.backends import FTPUploadBackEnd, FTPLineParser
+from publisher.worker.managers.backends import CachedFTPUploadBackEnd
+from publisher.worker.managers.backends import parse_feat_response, parse_mlsd_entry
 
 
 class FTPBackEndTest(unittest.TestCase):
@@ -46,6 +54,193 @@ class FTPBackEndTest(unittest.TestCase):
         self.assertTrue('test' in ftp.dir(''))
         self.assertEqual(ftp._list.call_count, 2)
 
+    def test_snapshot(self):
+        ftp = FTPUploadBackEnd('server', 'user', 'pass', 'basedir', 21)
+        listings = {'top': [('.', 'd', None), ('..', 'd', None), ('sub', 'd', None),
+                            ('a.txt', '-', 1)],
+                    'top/sub': [('b.txt', '-', 2)]}
+        ftp._list = Mock(side_effect=lambda folder: listings[folder])
+        self.assertEqual(ftp.snapshot('top'), [('top/sub', 'd', None), ('top/a.txt', '-', 1),
+                                               ('top/sub/b.txt', '-', 2)])
+        self.assertEqual(ftp._list.call_count, 2)
+
+    def test_erase_directory(self):
+        ftp = FTPUploadBackEnd('server', 'user', 'pass', 'basedir', 21)
+        ftp.snapshot = Mock(return_value=[('top/sub', 'd', None), ('top/a.txt', '-', 1),
+                                          ('top/sub/b.txt', '-', 2)])
+        ftp.type = Mock()
+        deleted = []
+        ftp._delete_file = Mock(side_effect=deleted.append)
+        ftp._delete_directory = Mock(side_effect=deleted.append)
+        self.assertTrue(ftp.erase_directory('top'))
+        self.assertEqual(deleted, ['top/sub/b.txt', 'top/a.txt', 'top/sub'])
+        self.assertFalse(ftp.type.called)
+
+    def test_upload_with_permission(self):
+        ftp = FTPUploadBackEnd('server', 'user', 'pass', 'basedir', 21, {'r': '644'})
+        ftp._cwd = Mock()
+        ftp._ftp.storbinary = Mock()
+        ftp._ftp.voidcmd = Mock()
+        ftp.upload('folder/a.txt', Mock())
+        self.assertFalse(ftp._ftp.voidcmd.called)
+        ftp.upload('folder/a.txt', Mock(), 'r')
+        ftp._ftp.voidcmd.assert_called_once_with('SITE CHMOD 644 a.txt')
+
+    def test_retried_upload_starts_at_the_beginning(self):
+        ftp = FTPUploadBackEnd('server', 'user', 'pass', 'basedir', 21)
+        ftp._cwd = Mock()
+        ftp.connect = Mock()
+        ftp.abort = Mock()
+        sent = []
+
+        def storbinary(_cmd, fp):
+            sent.append(fp.read(4))
+            if len(sent) == 1:
+                raise IOError('Boom!')
+            sent.append(fp.read())
+        ftp._ftp.storbinary = Mock(side_effect=storbinary)
+        ftp.upload('a.txt', BytesIO(b'12345678'))
+        self.assertEqual(sent[1:], [b'1234', b'5678'])
+
+
+class FakeFTP(object):
+    """
+    ftplib.FTP session on a server (a dict of absolute paths -> 'd' or '-')
+    shared by all sessions
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.folder = '/'
+
+    def _path(self, name):
+        return os.path.normpath(os.path.join(self.folder, name))
+
+    def cwd(self, folder):
+        if self.server.get(self._path(folder)) != 'd':
+            raise ftplib.error_perm('550 No such directory')
+        self.folder = self._path(folder)
+
+    def dir(self, _arg, callback):
+        for path, entry_type in sorted(self.server.items()):
+            if os.path.dirname(path) == self.folder and path != '/':
+                callback("%srw-r--r--    1 user     group          12 Jan 30  2013 %s"
+                         % (entry_type, os.path.basename(path)))
+
+    def mkd(self, name):
+        self.server[self._path(name)] = 'd'
+
+    def delete(self, name):
+        del self.server[self._path(name)]
+
+    def storbinary(self, _cmd, _fp):
+        pass
+
+    def voidcmd(self, _cmd):
+        pass
+
+
+class PooledCachedFTPTest(unittest.TestCase):
+
+    def _connect(self, ftp, server):
+        ftp._ftp = FakeFTP(server)
+        ftp._ftp_folder = '/basedir'
+        ftp.connect = Mock()
+        return ftp
+
+    def test_clones_share_the_listings(self):
+        server = {'/': 'd', '/basedir': 'd', '/basedir/x': '-'}
+        ftp = self._connect(CachedFTPUploadBackEnd('server', 'user', 'pass', 'basedir'), server)
+        clone = self._connect(ftp.clone(), server)
+        self.assertEqual(clone.type('x'), '-')
+        ftp.delete_file('x')
+        self.assertFalse(clone.exists('x'))
+
+    def test_file_replaced_by_folder(self):
+        working_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, working_dir)
+        os.mkdir(os.path.join(working_dir, 'x'))
+        with open(os.path.join(working_dir, 'x', 'a.txt'), 'wb') as f:
+            f.write(b'test')
+        local_list = manifestbased.FileList()
+        local_list.read_manifest({'files': [('FILE', 'x/a.txt', 'r', 4, 'md5')],
+                                  'folders': [('DIR', 'x', 'r')]})
+        remote_list = manifestbased.FileList()
+        remote_list.read_manifest({'files': [('FILE', 'x', 'r', 4, 'md5')], 'folders': []})
+
+        server = {'/': 'd', '/basedir': 'd', '/basedir/x': '-'}
+        ftp = self._connect(CachedFTPUploadBackEnd('server', 'user', 'pass', 'basedir'), server)
+        clone = self._connect(ftp.clone(), server)
+        ftp.clone = Mock(return_value=clone)
+        # Listings of the validation
+        self.assertTrue(ftp.exists('x'))
+        self.assertTrue(clone.exists('x'))
+
+        manager = manifestbased.ManifestUploadManager(ftp, connections=2)
+        manager._get_remote_list = Mock(return_value=remote_list)
+        tasklist = manager._create_new_task_list(local_list)
+        manager._synchronize_parallel(tasklist, working_dir)
+        self.assertEqual(server['/basedir/x'], 'd')
+        self.assertTrue(all(task.done for task in tasklist.create_folders + tasklist.new_files))
+
+
+class FTPMLSDTest(unittest.TestCase):
+
+    FEAT = ("211-Features:\n"
+            " MDTM\n"
+            " MLST type*;size*;modify*;perm*;\n"
+            " UTF8\n"
+            "211 End")
+
+    def _ftp(self, feat=FEAT):
+        ftp = FTPUploadBackEnd('server', 'user', 'pass', 'basedir', 21)
+        ftp._ftp = Mock()
+        ftp._ftp.sendcmd = Mock(return_value=feat)
+        ftp._mlsd = ftp._detect_mlsd()
+        return ftp
+
+    def test_parse_feat_response(self):
+        features = parse_feat_response(self.FEAT)
+        self.assertEqual(features['MLST'], 'type*;size*;modify*;perm*;')
+        self.assertIn('UTF8', features)
+
+    def test_parse_mlsd_entry(self):
+        self.assertIsNone(parse_mlsd_entry('.', {'type': 'cdir'}))
+        self.assertIsNone(parse_mlsd_entry('..', {'type': 'pdir'}))
+        self.assertEqual(parse_mlsd_entry('sub', {'type': 'dir'}), ('sub', 'd', None))
+        self.assertEqual(parse_mlsd_entry('a.txt', {'type': 'file', 'size': '12'}),
+                         ('a.txt', '-', 12))
+        self.assertEqual(parse_mlsd_entry('l', {'type': 'OS.unix=symlink'}), ('l', 'l', None))
+
+    def test_mlsd_listing(self):
+        ftp = self._ftp()
+        ftp._ftp.mlsd = Mock(return_value=iter([('.', {'type': 'cdir'}),
+                                                ('sub', {'type': 'dir'}),
+                                                ('a.txt', {'type': 'file', 'size': '12'})]))
+        self.assertEqual(ftp.dir_sizes('folder'), {'a.txt': 12})
+        self.assertFalse(ftp._ftp.dir.called)
+
+    def test_facts_are_enabled(self):
+        ftp = self._ftp(self.FEAT.replace('size*', 'size'))
+        ftp._ftp.sendcmd.assert_any_call('OPTS MLST type;size;')
+        self.assertTrue(ftp._mlsd)
+
+    def test_list_without_mlst_feature(self):
+        ftp = self._ftp("211-Features:\n MDTM\n211 End")
+        self.assertFalse(ftp._mlsd)
+        ftp._ftp.dir = Mock(side_effect=lambda _arg, callback: callback(
+            "-rw-r--r--    1 user     group          12 Jan 30  2013 a.txt"))
+        self.assertEqual(ftp.dir_sizes('folder'), {'a.txt': 12})
+        self.assertFalse(ftp._ftp.mlsd.called)
+
+    def test_list_fallback_on_mlsd_error(self):
+        ftp = self._ftp()
+        ftp._ftp.mlsd = Mock(side_effect=ftplib.error_perm('500 Unknown command'))
+        ftp._ftp.dir = Mock(side_effect=lambda _arg, callback: callback(
+            "-rw-r--r--    1 user     group          12 Jan 30  2013 a.txt"))
+        self.assertEqual(ftp.dir_sizes('folder'), {'a.txt': 12})
+        self.assertFalse(ftp._mlsd)
+
 
 class FTPLineParserTest(unittest.TestCase):
 
@@ -68,6 +263,25 @@ class FTPLineParserTest(unittest.TestCase):
         self.assertEqual("wwwlogs", n)
         self.assertEqual("d", t)
 
+    def test_parse_with_size(self):
+        parser = FTPLineParser()
+        self.assertEqual(parser.parse_with_size(
+            "-rw-r--r-- 1 mtrunner domnen-benutzer 1234 30. Aug 10:29 test.txt"),
+            ('test.txt', '-', 1234))
+        self.assertEqual(parser.parse_with_size(
+            '11-19-13  02:03AM               5678 index.html'),
+            ('index.html', '-', 5678))
+        self.assertEqual(parser.parse_with_size(
+            '11-19-13  02:03AM       <DIR>          wwwlogs'),
+            ('wwwlogs', 'd', None))
+
+    def test_dir_sizes(self):
+        ftp = FTPUploadBackEnd('server', 'user', 'pass', 'basedir', 21)
+        ftp._list = Mock(return_value=[('.', 'd', 4096), ('sub', 'd', 4096),
+                                       ('a.txt', '-', 12)])
+        self.assertEqual(ftp.dir_sizes('folder'), {'a.txt': 12})
+        ftp._list.assert_called_once_with('folder')
+
 
 if __name__ == "__main__":
     # import sys;sys.argv = ['', 'Test.testName']
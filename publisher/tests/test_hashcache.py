@@ -0,0 +1,49 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+from publisher.worker.hashcache import HashCache
+
+
+class HashCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        self.path = os.path.join(cache_dir, 'cache.sqlite')
+        self.cache = HashCache(self.path, 3)
+        self.addCleanup(self.cache.close)
+
+    def test_get_many(self):
+        self.cache.put_many({('a.txt', 1, 10): 'md5a', ('b.txt', 2, 20): 'md5b'})
+        result = self.cache.get_many([('a.txt', 1, 10), ('b.txt', 2, 21), ('c.txt', 3, 30)])
+        self.assertEqual(result, {('a.txt', 1, 10): 'md5a'})
+
+    def test_persistent(self):
+        self.cache.put_many({('a.txt', 1, 10): 'md5a'})
+        other_cache = HashCache(self.path, 3)
+        self.addCleanup(other_cache.close)
+        self.assertEqual(other_cache.get_many([('a.txt', 1, 10)]), {('a.txt', 1, 10): 'md5a'})
+
+    def test_lru_eviction(self):
+        self.cache.put_many({('a.txt', 1, 10): 'md5a'})
+        self.cache.put_many({('b.txt', 2, 20): 'md5b'})
+        self.cache.put_many({('c.txt', 3, 30): 'md5c'})
+        # a.txt is used again, so b.txt is the least recently used entry
+        self.cache.get_many([('a.txt', 1, 10)])
+        self.cache.put_many({('d.txt', 4, 40): 'md5d'})
+        result = self.cache.get_many([('a.txt', 1, 10), ('b.txt', 2, 20),
+                                      ('c.txt', 3, 30), ('d.txt', 4, 40)])
+        self.assertEqual(sorted(result.values()), ['md5a', 'md5c', 'md5d'])
+
+    def test_many_keys(self):
+        items = dict((('file%d' % i, i, i), 'md5%d' % i) for i in range(1000))
+        cache = HashCache(self.path, 2000)
+        self.addCleanup(cache.close)
+        cache.put_many(items)
+        self.assertEqual(cache.get_many(items.keys()), items)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,7 +1,43 @@
 import unittest
 import mock
+import hashlib
+import io
+from io import BytesIO
+import pickle
+import gzip
+import json
+import sys
+import logging
+import tracemalloc
+import os
+import shutil
+import tempfile
+import time
 
 from publisher.worker.managers import manifestbased
+from publisher.worker.exceptions import RetryException
+from publisher.worker.checkpoint import RecoveryCheckpoint
+from publisher.tests.memory_backend import MemoryBackEnd
+from publisher.worker.exceptions import NoRetryException
+
+
+class Md5SumTest(unittest.TestCase):
+
+    def test_md5sum(self):
+        working_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, working_dir)
+        data = os.urandom(manifestbased.MD5_CHUNK_SIZE * 2 + 123)
+        path = os.path.join(working_dir, 'test.bin')
+        with open(path, 'wb') as f:
+            f.write(data)
+        self.assertEqual(manifestbased.md5sum(path), hashlib.md5(data).hexdigest())
+
+    def test_md5sum_empty_file(self):
+        working_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, working_dir)
+        path = os.path.join(working_dir, 'empty.txt')
+        open(path, 'wb').close()
+        self.assertEqual(manifestbased.md5sum(path), hashlib.md5().hexdigest())
 
 
 class FileListTest(unittest.TestCase):
@@ -19,12 +55,333 @@ class FileListTest(unittest.TestCase):
         fl.remove_invalids(lambda x: (x.find('2') > -1))
         # TODO: Check arrays
 
+    def test_manifest_crc(self):
+        fl = manifestbased.FileList()
+        fl.read_manifest({'files': [('FILE', 'new.txt', 'r', 1, 'md5', False, 1234),
+                                    ('FILE', 'legacy.txt', 'r', 1, 'md5', False)],
+                          'folders': []})
+        self.assertEqual(fl.get_file('new.txt').crc, 1234)
+        self.assertIsNone(fl.get_file('legacy.txt').crc)
+
+        fl2 = manifestbased.FileList()
+        fl2.read_manifest_file(io.StringIO(fl.generate_manifest()))
+        self.assertEqual(fl2.get_file('new.txt').crc, 1234)
+
+    def test_compressed_manifest(self):
+        fl = manifestbased.FileList(
+            [manifestbased.FileListFileEntry('./a.txt', 'r', 1, 'md5', 7)],
+            [manifestbased.FileListFolderEntry('sub', 'w')])
+        old_file = manifestbased.FileListFileEntry('sub/old.txt', 'r', 2, 'md5')
+        old_file.old = True
+        manifest = io.BytesIO()
+        fl.write_manifest_file(manifest, [], [old_file])
+        self.assertEqual(manifest.getvalue()[:2], manifestbased.GZIP_MAGIC)
+
+        manifest.seek(0)
+        fl2 = manifestbased.FileList()
+        fl2.read_manifest_file(manifest)
+        self.assertEqual(sorted(fl2.get_files()), ['./a.txt', 'sub/old.txt'])
+        self.assertEqual(fl2.get_folders(), ['sub'])
+        self.assertEqual(fl2.get_file('./a.txt').tojson(),
+                         ('FILE', './a.txt', 'r', 1, 'md5', False, 7))
+        self.assertEqual(fl2.get_folder('sub').permission, 'w')
+
+    def test_compressed_manifest_with_legacy_recovery(self):
+        manifest = io.BytesIO()
+        fl = manifestbased.FileList([manifestbased.FileListFileEntry('a.txt', 'r', 1, 'new')])
+        fl.write_manifest_file(manifest)
+        manifest.seek(0)
+        recovery = io.BytesIO(json.dumps({'files': [('FILE', 'a.txt', 'r', 1, 'old', False),
+                                                    ('FILE', 'b.txt', 'r', 1, 'b', False)],
+                                          'folders': []}).encode('utf-8'))
+        fl = manifestbased.FileList()
+        fl.read_manifest_file(manifest, recovery)
+        self.assertEqual(fl.get_file('a.txt').checksum, 'new')
+        self.assertEqual(fl.get_file('b.txt').checksum, 'b')
+
+    def test_unknown_manifest_version(self):
+        manifest = io.BytesIO()
+        with gzip.GzipFile(fileobj=manifest, mode='wb') as gzip_file:
+            gzip_file.write(b'{"version": 99}\n')
+        manifest.seek(0)
+        self.assertRaises(NoRetryException, manifestbased.FileList().read_manifest_file, manifest)
+
+    def test_parallel_scan_local_folder(self):
+        working_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, working_dir)
+        for folder in ('', 'sub1', 'sub1/sub2', 'sub3'):
+            if folder:
+                os.mkdir(os.path.join(working_dir, folder))
+            for i in range(5):
+                with open(os.path.join(working_dir, folder, 'f%d.txt' % i), 'wb') as f:
+                    f.write(os.urandom(i * 1000))
+        serial_list = manifestbased.FileList()
+        serial_list.scan_local_folder(working_dir)
+        parallel_list = manifestbased.FileList()
+        parallel_list.scan_local_folder(working_dir, workers=4)
+
+        self.assertEqual(len(parallel_list.get_files()), 20)
+        self.assertEqual(serial_list.get_folders(), parallel_list.get_folders())
+        self.assertEqual(serial_list.generate_manifest(),
+                         parallel_list.generate_manifest())
+
+    def test_scan_local_folder_with_checksums(self):
+        working_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, working_dir)
+        os.mkdir(os.path.join(working_dir, 'sub'))
+        for filename in ('known.txt', 'sub/known.txt', 'unknown.txt'):
+            with open(os.path.join(working_dir, filename), 'wb') as f:
+                f.write(b'test')
+        checksums = {'known.txt': [1000, 'a'], 'sub/known.txt': [2, 'b']}
+        fl = manifestbased.FileList()
+        with mock.patch.object(manifestbased, 'md5sum',
+                               return_value='c') as md5sum_mock:
+            with self.assertLogs(manifestbased.logger, logging.INFO) as logs:
+                fl.scan_local_folder(working_dir, checksums=checksums)
+        md5sum_mock.assert_called_once_with(os.path.join(working_dir, 'unknown.txt'))
+        # Only the read files count for the throughput
+        self.assertIn("Hashed 1 of 3 files (4 bytes)", logs.output[0])
+        self.assertEqual(fl.get_file('./known.txt').checksum, 'a')
+        self.assertEqual(fl.get_file('./known.txt').size, 1000)
+        self.assertEqual(fl.get_file('sub/known.txt').size, 2)
+        self.assertEqual(fl.get_file('./unknown.txt').size, 4)
+        self.assertEqual(fl.get_file('./unknown.txt').checksum, 'c')
+
+
+class TreeHashTest(unittest.TestCase):
+
+    def _file_list(self, changed=False):
+        fl = manifestbased.FileList()
+        fl.read_manifest({'files': [('FILE', './index.html', 'r', 1, 'a'),
+                                    ('FILE', 'media/a.png', 'r', 2, 'b'),
+                                    ('FILE', 'media/thumbs/a.png', 'r', 3, 'c'),
+                                    ('FILE', 'css/style.css', 'r', 4,
+                                     'changed' if changed else 'd')],
+                          'folders': [('DIR', 'media', 'w'), ('DIR', 'media/thumbs', 'w'),
+                                      ('DIR', 'css', 'r')]})
+        return fl
+
+    def test_tree_hashes(self):
+        hashes = self._file_list().get_tree_hashes()
+        self.assertEqual(sorted(hashes), ['', 'css', 'media', 'media/thumbs'])
+        changed = self._file_list(changed=True).get_tree_hashes()
+        self.assertEqual(hashes['media'], changed['media'])
+        self.assertEqual(hashes['media/thumbs'], changed['media/thumbs'])
+        self.assertNotEqual(hashes['css'], changed['css'])
+        self.assertNotEqual(hashes[''], changed[''])
+
+    def test_unchanged_subtrees_are_pruned(self):
+        changed = mock.Mock(return_value=False)
+        manifestbased.TaskList(self._file_list(changed=True), self._file_list(), changed)
+        self.assertEqual(sorted(c[0][0].path for c in changed.call_args_list),
+                         ['./index.html', 'css/style.css'])
+
+        changed.reset_mock()
+        manifestbased.TaskList(self._file_list(), self._file_list(), changed)
+        self.assertFalse(changed.called)
+
+    def test_dirty_paths_are_compared(self):
+        changed = mock.Mock(side_effect=lambda local, _remote: local.path == 'media/thumbs/a.png')
+        tasklist = manifestbased.TaskList(self._file_list(), self._file_list(), changed,
+                                          ['media/thumbs/a.png'])
+        self.assertEqual([task.task.path for task in tasklist.update_files],
+                         ['media/thumbs/a.png'])
+        # The folders of the dirty path are compared, css stays pruned
+        self.assertNotIn('css/style.css', [c[0][0].path for c in changed.call_args_list])
+
+    def test_tree_hashes_in_manifest(self):
+        manifest = io.BytesIO()
+        self._file_list().write_manifest_file(manifest)
+        manifest.seek(0)
+        parsed = manifestbased.parse_manifest(manifest)
+        self.assertEqual(len(parsed['trees']), 4)
+
+        fl = manifestbased.FileList()
+        fl.read_manifest(parsed)
+        self.assertEqual(fl.get_tree_hashes(), self._file_list().get_tree_hashes())
+        fl.apply_delta({'files': [('FILE', 'css/style.css', 'r', 4, 'changed')],
+                        'folders': [], 'deleted': []})
+        self.assertEqual(fl.get_tree_hashes(), self._file_list(changed=True).get_tree_hashes())
+
+
+class EntryMemoryTest(unittest.TestCase):
+
+    class DictFileEntry(object):
+        """ The dict based file entry of older versions """
+
+        def __init__(self, path, permission, size, checksum, crc=None):
+            self.path = path
+            self.permission = permission
+            self.old = False
+            self.size = size
+            self.checksum = checksum
+            self.crc = crc
+
+    def _bytes_per_entry(self, factory, count=10000):
+        paths = ['folder/file%d.html' % i for i in range(count)]
+        tracemalloc.start()
+        try:
+            entries = [factory(path) for path in paths]
+            size = tracemalloc.get_traced_memory()[0] - sys.getsizeof(entries)
+        finally:
+            tracemalloc.stop()
+        return float(size) / count
+
+    def test_file_entry_memory(self):
+        dict_size = self._bytes_per_entry(
+            lambda path: self.DictFileEntry(path, 'r', 1, 'md5', 1))
+        slots_size = self._bytes_per_entry(
+            lambda path: manifestbased.FileListFileEntry(path, 'r', 1, 'md5', 1))
+        task_size = self._bytes_per_entry(lambda path: manifestbased.TaskListEntry(None))
+        logging.getLogger(__name__).info(
+            "Bytes per entry: dict file entry %.0f, file entry %.0f, task entry %.0f"
+            % (dict_size, slots_size, task_size))
+        # Entries allocate nothing besides the object itself
+        self.assertLessEqual(
+            slots_size, sys.getsizeof(manifestbased.FileListFileEntry('a', 'r', 1, 'md5', 1)))
+        self.assertLessEqual(task_size, sys.getsizeof(manifestbased.TaskListEntry(None)))
+        # and need at least a quarter less than the dict based entries
+        self.assertLessEqual(slots_size, dict_size * 0.75)
+
+    def test_entries_have_no_dict(self):
+        for entry in (manifestbased.FileListFileEntry('a', 'r', 1, 'md5'),
+                      manifestbased.FileListFolderEntry('a', 'r'),
+                      manifestbased.TaskListEntry(None)):
+            self.assertFalse(hasattr(entry, '__dict__'))
+
+    def test_pickle_entries(self):
+        entry = manifestbased.TaskListEntry(manifestbased.FileListFileEntry('a', 'r', 1, 'md5', 2))
+        entry.done = True
+        copy = pickle.loads(pickle.dumps(entry))
+        self.assertTrue(copy.done)
+        self.assertEqual(copy.task.tojson(), ('FILE', 'a', 'r', 1, 'md5', False, 2))
+
+    def test_unpickle_dict_state(self):
+        # Recovery task lists of older versions contain the __dict__ state
+        entry = manifestbased.FileListFileEntry.__new__(manifestbased.FileListFileEntry)
+        entry.__setstate__({'path': 'a', 'permission': 'r', 'old': False,
+                            'size': 1, 'checksum': 'md5'})
+        self.assertEqual(entry.tojson(), ('FILE', 'a', 'r', 1, 'md5', False, None))
+
+
+class ManifestJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = MemoryBackEnd()
+
+    def _publish(self, files, max_deltas=2, backend=None):
+        working_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, working_dir)
+        for name, data in files.items():
+            path = os.path.join(working_dir, name)
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as f:
+                f.write(data)
+        manager = manifestbased.ManifestUploadManager(backend or self.backend,
+                                                      max_manifest_deltas=max_deltas)
+        manager.start(working_dir)
+        return manager
+
+    def _remote_list(self):
+        manager = manifestbased.ManifestUploadManager(self.backend, max_manifest_deltas=2)
+        return manager._get_remote_list()
+
+    def _manifest_path(self):
+        return [path for path in self.backend.files if path.endswith('/.manifest')][0]
+
+    def _manifest_files(self):
+        return sorted(os.path.basename(path) for path in self.backend.files
+                      if '/.manifest' in path)
+
+    def test_small_publish_uploads_delta(self):
+        self._publish({'a.txt': b'a', 'sub/b.txt': b'b', 'c.txt': b'c'})
+        self.assertEqual(self._manifest_files(), ['.manifest'])
+        manifest = self.backend.files[self._manifest_path()]
+
+        self.backend.calls = []
+        self._publish({'a.txt': b'aa', 'sub/b.txt': b'b', 'd.txt': b'd'})
+        self.assertEqual(self._manifest_files(), ['.manifest', '.manifest.delta.1'])
+        self.assertEqual(self.backend.files[self._manifest_path()], manifest)
+        self.assertEqual(sorted(os.path.basename(p) for p in self.backend.uploaded()),
+                         ['.manifest.delta.1', '.manifest.new', 'a.txt', 'd.txt'])
+
+        remote_list = self._remote_list()
+        self.assertEqual(sorted(remote_list.get_files()), ['./a.txt', './d.txt', 'sub/b.txt'])
+        self.assertEqual(remote_list.get_file('./a.txt').size, 2)
+
+    def test_changed_modes_are_set_on_updated_files(self):
+        self.backend.permission_map = {'r': '644'}
+        self._publish({'a.txt': b'a'})
+        self.assertEqual(self.backend.permissions, {'a.txt': 'r'})
+
+        self.backend.permissions = {}
+        self._publish({'a.txt': b'aa'})
+        self.assertEqual(self.backend.permissions, {})
+
+        # New modes of the chmod settings are read from the manifest delta
+        self.backend.permission_map = {'r': '600'}
+        self._publish({'a.txt': b'aaa'})
+        self.assertEqual(self.backend.permissions, {'a.txt': 'r'})
+        self.assertEqual(self._manifest_files(), ['.manifest', '.manifest.delta.1',
+                                                  '.manifest.delta.2'])
+
+    def test_changed_modes_of_an_unchanged_site_are_stored(self):
+        self.backend.permission_map = {'r': '644'}
+        self._publish({'a.txt': b'a'})
+        self.backend.permission_map = {'r': '600'}
+        self._publish({'a.txt': b'a'})
+        self.assertEqual(self._manifest_files(), ['.manifest', '.manifest.delta.1'])
+
+        self.backend.permission_map = {'r': '644'}
+        self.backend.permissions = {}
+        self._publish({'a.txt': b'aa'})
+        self.assertEqual(self.backend.permissions, {'a.txt': 'r'})
+
+    def test_compaction(self):
+        for i in range(5):
+            self._publish({'a.txt': b'a' * (i + 1)})
+        # Two deltas, then the full manifest (journal 2) and a new delta
+        self.assertEqual(self._manifest_files(), ['.manifest', '.manifest.delta.3'])
+        self.assertEqual(self._remote_list().get_file('./a.txt').size, 5)
+
+    def test_deltas_of_the_manifest_are_ignored(self):
+        for i in range(4):
+            self._publish({'a.txt': b'a' * (i + 1)})
+        # Delta 2 is part of the compacted manifest, but wasn't deleted
+        delta = BytesIO()
+        manifestbased.write_manifest(delta, [('DELETE', './a.txt')], {'delta': 2})
+        folder = os.path.dirname(self._manifest_path())
+        self.backend.files[folder + '/.manifest.delta.2'] = delta.getvalue()
+        self.assertEqual(self._remote_list().get_file('./a.txt').size, 4)
+
+    def test_recovery_with_deltas(self):
+        self._publish({'a.txt': b'a'})
+        self._publish({'a.txt': b'a', 'b.txt': b'b'})
+        failing = MemoryBackEnd(self.backend.files, self.backend.folders)
+        failing.upload = self._failing_upload(failing)
+        with self.assertRaises(RetryException) as raised:
+            self._publish({'a.txt': b'a', 'b.txt': b'b', 'c.txt': b'c'}, backend=failing)
+        self.assertEqual(raised.exception.message, 'Boom!')
+        self.assertIn('.manifest.new', self._manifest_files())
+
+        remote_list = self._remote_list()
+        self.assertEqual(sorted(remote_list.get_files()), ['./a.txt', './b.txt', './c.txt'])
+        self.assertEqual(self._manifest_files(), ['.manifest'])
+
+    def _failing_upload(self, backend):
+        def upload(path, fp, permission=None):
+            if '.manifest' not in path:
+                raise IOError("Boom!")
+            backend.files[backend._norm(path)] = fp.read()
+        return upload
+
 
 class ManagerTest(unittest.TestCase):
 
     def test_create_tasklist(self):
         backend = mock.Mock()
-        backend.size = mock.Mock(return_value=1024)
+        backend.dir_sizes = mock.Mock(return_value={'test2.txt': 1024, 'test3.txt': 1024})
 
         local_list = manifestbased.FileList()
         files = [('FILE', 'subfolder1/test.txt', oct(777), 512, 1234567890),
@@ -64,6 +421,198 @@ class ManagerTest(unittest.TestCase):
         self.assertIn('test2.txt', [task.task.path for task in
                                     tasklist.change_permissions])
 
+    def _progress_tasklist(self):
+        local_list = manifestbased.FileList()
+        local_list.read_manifest({'files': [('FILE', 'new.txt', 'r', 3000, 'a'),
+                                            ('FILE', 'same.txt', 'r', 10, 'b')],
+                                  'folders': [('DIR', 'new', 'r')]})
+        remote_list = manifestbased.FileList()
+        remote_list.read_manifest({'files': [('FILE', 'same.txt', 'r', 10, 'b'),
+                                             ('FILE', 'old.txt', 'r', 10, 'c')],
+                                   'folders': []})
+        return manifestbased.TaskList(local_list, remote_list, lambda local, remote: False)
+
+    def test_tasklist_progress(self):
+        tasklist = self._progress_tasklist()
+        # 3 tasks (delete, create, chmod) weighted with 1000 and 3000 bytes
+        self.assertEqual(tasklist.get_progress(1000), 0.0)
+        tasklist.mark_done('delete_files', tasklist.delete_files[0])
+        tasklist.mark_done('delete_files', tasklist.delete_files[0])
+        self.assertAlmostEqual(tasklist.get_progress(1000), 1000.0 / 6000)
+        tasklist.mark_uploaded(tasklist.new_files[0])
+        self.assertAlmostEqual(tasklist.get_progress(1000), 4000.0 / 6000)
+        tasklist.mark_done('create_folders', tasklist.create_folders[0])
+        tasklist.mark_done('change_permissions', tasklist.change_permissions[0])
+        self.assertEqual(tasklist.get_progress(1000), 1.0)
+
+    def test_tasklist_progress_after_recovery(self):
+        tasklist = self._progress_tasklist()
+        tasklist.mark_uploaded(tasklist.new_files[0])
+        # Task lists of older versions have no counters
+        for attr in ('_total_tasks', '_done_tasks', '_total_bytes', '_done_bytes'):
+            delattr(tasklist, attr)
+        recovered = pickle.loads(pickle.dumps(tasklist))
+        self.assertAlmostEqual(recovered.get_progress(1000), 3000.0 / 6000)
+
+    def test_unchanged_permissions_are_kept(self):
+        local_list = manifestbased.FileList()
+        local_list.read_manifest({'files': [('FILE', 'same.txt', 'r', 10, 'new'),
+                                            ('FILE', 'writeable.txt', 'w', 10, 'new'),
+                                            ('FILE', 'missing.txt', 'r', 10, 'new'),
+                                            ('FILE', 'new.txt', 'r', 10, 'new')],
+                                  'folders': []})
+        remote_list = manifestbased.FileList()
+        remote_list.read_manifest({'files': [('FILE', 'same.txt', 'r', 10, 'old'),
+                                             ('FILE', 'writeable.txt', 'r', 10, 'old'),
+                                             ('FILE', 'missing.txt', 'r', 10, 'old')],
+                                   'folders': []})
+        remote_list.permission_map = {'r': '644', 'w': '666'}
+        tasklist = manifestbased.TaskList(local_list, remote_list,
+                                          lambda local, remote: True, ['missing.txt'],
+                                          {'r': '644', 'w': '666'})
+        self.assertEqual(tasklist.keep_permissions, set(['same.txt']))
+        permissions = dict((task.task.path, tasklist.get_upload_permission(task))
+                           for task in tasklist.new_files + tasklist.update_files)
+        self.assertEqual(permissions, {'same.txt': None, 'writeable.txt': 'w',
+                                       'missing.txt': 'r', 'new.txt': 'r'})
+        # Task lists of older versions chmod all uploaded files
+        del tasklist.keep_permissions
+        recovered = pickle.loads(pickle.dumps(tasklist))
+        self.assertEqual(recovered.get_upload_permission(recovered.update_files[0]),
+                         recovered.update_files[0].task.permission)
+
+        # The same permission with another octal mode or unknown modes
+        for old_map, new_map in [({'r': '644'}, {'r': '600'}), (None, {'r': '644'}),
+                                 ({'r': '644'}, None)]:
+            remote_list.permission_map = old_map
+            tasklist = manifestbased.TaskList(local_list, remote_list,
+                                              lambda local, remote: True, (), new_map)
+            self.assertEqual(tasklist.keep_permissions, set())
+
+    def test_only_changed_modes_are_set(self):
+        local_list = manifestbased.FileList()
+        local_list.read_manifest({'files': [('FILE', 'same.txt', 'r', 10, 'a'),
+                                            ('FILE', 'writeable.txt', 'w', 10, 'b'),
+                                            ('FILE', 'other.txt', 'x', 10, 'c')],
+                                  'folders': [('DIR', 'same', 'r'), ('DIR', 'cache', 'c')]})
+        remote_list = manifestbased.FileList()
+        remote_list.read_manifest({'files': [('FILE', 'same.txt', 'r', 10, 'a'),
+                                             ('FILE', 'writeable.txt', 'r', 10, 'b'),
+                                             ('FILE', 'other.txt', 'x', 10, 'c')],
+                                   'folders': [('DIR', 'same', 'r'), ('DIR', 'cache', 'c')]})
+        remote_list.permission_map = {'r': '644', 'w': '666', 'x': '755', 'c': '777'}
+
+        def chmods(permission_map):
+            tasklist = manifestbased.TaskList(local_list, remote_list,
+                                              lambda local, remote: False, (), permission_map)
+            self.assertEqual([task.task.path for task in tasklist.erase_folders], ['cache'])
+            return sorted(task.task.path for task in tasklist.change_permissions)
+        self.assertEqual(chmods(remote_list.permission_map), ['writeable.txt'])
+        self.assertEqual(chmods({'r': '644', 'w': '666', 'x': '700', 'c': '770'}),
+                         ['cache', 'other.txt', 'writeable.txt'])
+        # Unknown modes are always set
+        self.assertEqual(chmods(None), ['cache', 'other.txt', 'same', 'same.txt',
+                                        'writeable.txt'])
+
+    def test_changed_with_crc(self):
+        backend = mock.Mock()
+        manager = manifestbased.ManifestUploadManager(backend)
+        entry = manifestbased.FileListFileEntry
+        # md5 checksums are compared when both files have one
+        self.assertFalse(manager._changed(entry('a', 'r', 10, 'md5', 1),
+                                          entry('a', 'r', 10, 'md5', 2)))
+        self.assertTrue(manager._changed(entry('a', 'r', 10, 'md5', 1),
+                                         entry('a', 'r', 10, 'other', 1)))
+        # otherwise the CRC is used
+        self.assertFalse(manager._changed(entry('a', 'r', 10, None, 1),
+                                          entry('a', 'r', 10, 'md5', 1)))
+        self.assertTrue(manager._changed(entry('a', 'r', 10, None, 1),
+                                         entry('a', 'r', 10, 'md5', 2)))
+        self.assertTrue(manager._changed(entry('a', 'r', 10, None, 1),
+                                         entry('a', 'r', 10, 'md5')))
+
+    def _verification_lists(self):
+        local_list = manifestbased.FileList()
+        local_list.read_manifest({'files': [('FILE', 'a/1.txt', 'r', 1, 'x'),
+                                            ('FILE', 'a/2.txt', 'r', 2, 'x'),
+                                            ('FILE', 'b/3.txt', 'r', 3, 'x'),
+                                            ('FILE', 'b/4.txt', 'r', 4, 'new')],
+                                  'folders': []})
+        remote_list = manifestbased.FileList()
+        remote_list.read_manifest({'files': [('FILE', 'a/1.txt', 'r', 1, 'x'),
+                                             ('FILE', 'a/2.txt', 'r', 2, 'x'),
+                                             ('FILE', 'b/3.txt', 'r', 3, 'x'),
+                                             ('FILE', 'b/4.txt', 'r', 5, 'old')],
+                                   'folders': []})
+        return local_list, remote_list
+
+    def test_full_verification(self):
+        backend = mock.Mock()
+        sizes = {'a': {'1.txt': 1, '2.txt': 20}, 'b': {'4.txt': 5}}
+        backend.dir_sizes = mock.Mock(side_effect=lambda folder: sizes[folder])
+        manager = manifestbased.ManifestUploadManager(backend)
+        local_list, remote_list = self._verification_lists()
+        manager._get_remote_list = mock.Mock(return_value=remote_list)
+        tasklist = manager._create_new_task_list(local_list)
+        # One listing per folder, no size request per file
+        self.assertEqual(sorted(c[0][0] for c in backend.dir_sizes.call_args_list),
+                         ['a', 'b'])
+        self.assertFalse(backend.size.called)
+        # Wrong server size and missing file are uploaded again
+        self.assertEqual(sorted(task.task.path for task in tasklist.update_files),
+                         ['a/2.txt', 'b/3.txt', 'b/4.txt'])
+
+    def test_no_verification(self):
+        backend = mock.Mock()
+        manager = manifestbased.ManifestUploadManager(
+            backend, verification=manifestbased.ManifestUploadManager.VERIFY_NONE)
+        local_list, remote_list = self._verification_lists()
+        manager._get_remote_list = mock.Mock(return_value=remote_list)
+        tasklist = manager._create_new_task_list(local_list)
+        self.assertFalse(backend.dir_sizes.called)
+        self.assertEqual([task.task.path for task in tasklist.update_files], ['b/4.txt'])
+
+    def test_sampled_verification(self):
+        backend = mock.Mock()
+        backend.dir_sizes = mock.Mock(return_value={'1.txt': 1, '2.txt': 2, '3.txt': 3})
+        manager = manifestbased.ManifestUploadManager(
+            backend, verification=manifestbased.ManifestUploadManager.VERIFY_SAMPLED,
+            verification_sample_size=2)
+        local_list, remote_list = self._verification_lists()
+        sizes = manager._get_remote_sizes(local_list, remote_list)
+        self.assertEqual(len(sizes), 2)
+        self.assertTrue(set(sizes) <= set(['a/1.txt', 'a/2.txt', 'b/3.txt']))
+
+    def test_folder_index(self):
+        index = manifestbased.FolderIndex(['media', 'a/b'])
+        self.assertTrue(index.covers('media'))
+        self.assertTrue(index.covers('media/image.png'))
+        self.assertTrue(index.covers('a/b/c/d.txt'))
+        self.assertFalse(index.covers('media2/image.png'))
+        self.assertFalse(index.covers('a/c.txt'))
+        self.assertFalse(index.covers('./index.html'))
+
+    def test_erased_files_are_not_validated(self):
+        backend = mock.Mock()
+        backend.exists = mock.Mock(return_value=True)
+        manager = manifestbased.ManifestUploadManager(backend)
+        local_list = manifestbased.FileList()
+        local_list.read_manifest({'files': [('FILE', 'cache/new.txt', 'c', 1, 'a'),
+                                            ('FILE', 'cache2/new.txt', 'r', 1, 'a')],
+                                  'folders': [('DIR', 'cache', 'c'), ('DIR', 'cache2', 'r')]})
+        remote_list = manifestbased.FileList()
+        remote_list.read_manifest({'files': [],
+                                   'folders': [('DIR', 'cache', 'c'), ('DIR', 'cache/sub', 'c')]})
+        manager._get_remote_list = mock.Mock(return_value=remote_list)
+        tasklist = manager._create_new_task_list(local_list)
+        backend.exists = mock.Mock(return_value=False)
+        manager._validate_task_list(tasklist)
+        checked = set(c[0][0] for c in backend.exists.call_args_list)
+        self.assertIn('cache2/new.txt', checked)
+        self.assertNotIn('cache/new.txt', checked)
+        # The content of cache/sub is erased, so it isn't listed
+        self.assertFalse(backend.dir.called)
+
     def test_new_file_exists_tasklist_validation(self):
         backend = mock.Mock()
         backend.exists = mock.Mock(return_value=True)
@@ -126,6 +675,209 @@ class ManagerTest(unittest.TestCase):
         backend.delete_file.assert_called_with('file.txt')
         backend.delete_directory.assert_called_with('subfolder')
 
+    def test_parallel_upload(self):
+        working_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, working_dir)
+        files = []
+        for i in range(10):
+            filename = 'test%d.txt' % i
+            with open(os.path.join(working_dir, filename), 'wb') as f:
+                f.write(b'test')
+            files.append(('FILE', filename, 'r', 4, 'checksum'))
+        local_list = manifestbased.FileList()
+        local_list.read_manifest({'files': files, 'folders': []})
+
+        backend = mock.Mock()
+        clones = [mock.Mock(), mock.Mock()]
+        backend.clone = mock.Mock(side_effect=clones)
+        manager = manifestbased.ManifestUploadManager(
+            backend, "http://test/test.zip", connections=3)
+        manager._get_remote_list = mock.Mock(
+            return_value=manifestbased.FileList())
+        tasklist = manager._create_new_task_list(local_list)
+        manager._synchronize_parallel(tasklist, working_dir)
+
+        self.assertTrue(all(task.done for task in tasklist.new_files))
+        uploads = [call[0][0] for back_end in [backend] + clones
+                   for call in back_end.upload.call_args_list]
+        self.assertEqual(sorted(uploads), sorted(f[1] for f in files))
+        for clone in clones:
+            if clone.connect.called:
+                clone.quit.assert_called_once_with()
+        self.assertFalse(backend.quit.called)
+
+    def test_parallel_upload_failure_keeps_done_state(self):
+        working_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, working_dir)
+        files = []
+        for i in range(4):
+            filename = 'test%d.txt' % i
+            with open(os.path.join(working_dir, filename), 'wb') as f:
+                f.write(b'test')
+            files.append(('FILE', filename, 'r', 4, 'checksum'))
+        local_list = manifestbased.FileList()
+        local_list.read_manifest({'files': files, 'folders': []})
+
+        def upload(path, _fp, _permission=None):
+            if path == 'test2.txt':
+                raise IOError('Boom!')
+        backend = mock.Mock()
+        backend.upload = mock.Mock(side_effect=upload)
+        backend.clone = mock.Mock(return_value=backend)
+        manager = manifestbased.ManifestUploadManager(
+            backend, "http://test/test.zip", connections=2)
+        manager._get_remote_list = mock.Mock(
+            return_value=manifestbased.FileList())
+        tasklist = manager._create_new_task_list(local_list)
+        self.assertRaises(IOError, manager._synchronize_parallel, tasklist, working_dir)
+
+        done = dict((task.task.path, task.done) for task in tasklist.new_files)
+        self.assertFalse(done['test2.txt'])
+        uploaded = set(call[0][0] for call in backend.upload.call_args_list)
+        uploaded.discard('test2.txt')
+        self.assertEqual(set(path for path, path_done in done.items() if path_done),
+                         uploaded)
+        # The connections of a failed job aren't kept for the next job
+        self.assertTrue(backend.abort.called)
+        self.assertFalse(backend.quit.called)
+
+
+class ParallelSyncTest(unittest.TestCase):
+
+    def _working_dir(self, files):
+        working_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, working_dir)
+        for name, data in files.items():
+            path = os.path.join(working_dir, name)
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as f:
+                f.write(data)
+        return working_dir
+
+    def _publish(self, backend, files, connections):
+        manager = manifestbased.ManifestUploadManager(backend, connections=connections)
+        manager.start(self._working_dir(files))
+
+    def _site(self, version):
+        files = {}
+        for folder in range(4):
+            for i in range(5):
+                files['f%d/v%d/file%d.txt' % (folder, version, i)] = b'x' * (version + i)
+        return files
+
+    def test_same_result_as_serial(self):
+        serial, parallel = MemoryBackEnd(), MemoryBackEnd()
+        for files in [self._site(1), self._site(2), {'f0/v2/file0.txt': b'y', 'g/x.txt': b'x'}]:
+            self._publish(serial, files, 1)
+            self._publish(parallel, files, 4)
+            self.assertEqual(
+                sorted(p for p in parallel.files if '.publisher' not in p),
+                sorted(p for p in serial.files if '.publisher' not in p))
+            self.assertEqual(sorted(p for p in parallel.folders if '.publisher' not in p),
+                             sorted(p for p in serial.folders if '.publisher' not in p))
+
+    def test_folder_order(self):
+        backend = MemoryBackEnd()
+        self._publish(backend, self._site(1), 4)
+        backend.calls = []
+        self._publish(backend, self._site(2), 4)
+        done = {}
+        for index, call in enumerate(backend.calls):
+            if call[0] in ('mkdir', 'upload', 'delete_file', 'delete_directory'):
+                done.setdefault(call[1], index)
+        for path, index in done.items():
+            if path.endswith('.txt') and '/v2/' in path:
+                # Folder created before its content
+                self.assertLess(done[os.path.dirname(path)], index)
+            elif path.endswith('.txt'):
+                # Content deleted before its folder
+                self.assertLess(index, done[os.path.dirname(path)])
+
+    def test_resume_from_checkpoint(self):
+        backend = MemoryBackEnd()
+        files = self._site(1)
+        working_dir = self._working_dir(files)
+        checkpoint = RecoveryCheckpoint(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, os.path.dirname(checkpoint.path))
+        upload = backend.upload
+
+        def killed_upload(path, fp, permission=None):
+            if len(backend.uploaded()) == 10:
+                # Not handled by the manager, like a killed process
+                raise SystemExit()
+            upload(path, fp, permission)
+        backend.upload = killed_upload
+        manager = manifestbased.ManifestUploadManager(backend, connections=1)
+        self.assertRaises(SystemExit, manager.start, working_dir, checkpoint=checkpoint)
+        del backend.upload
+        uploaded = set(p for p in backend.uploaded() if '.publisher' not in p)
+
+        backend.calls = []
+        manager = manifestbased.ManifestUploadManager(backend, connections=1)
+        manager.start(working_dir, checkpoint=checkpoint)
+        resumed = set(p for p in backend.uploaded() if '.publisher' not in p)
+        self.assertTrue(uploaded)
+        self.assertFalse(uploaded & resumed)
+        self.assertEqual(len(uploaded) + len(resumed), len(files))
+        self.assertEqual(sorted(p for p in backend.files if '.publisher' not in p),
+                         sorted(files))
+
+    def test_connection_of_a_failed_job_is_dropped(self):
+        for fail in (False, True):
+            backend = MemoryBackEnd()
+            backend.quit = mock.Mock()
+            backend.abort = mock.Mock()
+            if fail:
+                backend.upload = mock.Mock(side_effect=IOError('Boom!'))
+                self.assertRaises(RetryException, self._publish, backend, self._site(1), 1)
+            else:
+                self._publish(backend, self._site(1), 1)
+            self.assertEqual((backend.abort.called, backend.quit.called), (fail, not fail))
+
+    def test_old_publish_cleanup(self):
+        backend = MemoryBackEnd({'server/version.json': b'{}', 'mdb/mdb.php': b'',
+                                 'index.html': b'old', '.htaccess': b''},
+                                set(['server', 'mdb']))
+        self._publish(backend, {'index.html': b'new'}, 1)
+        self.assertFalse(any(call[0] == 'type' for call in backend.calls))
+        self.assertEqual(sorted(p for p in backend.files if '.publisher' not in p),
+                         ['.htaccess', 'index.html'])
+        self.assertEqual(backend.files['index.html'], b'new')
+        self.assertEqual(sorted(p for p in backend.folders if '.publisher' not in p), [])
+
+    def test_latency_benchmark(self):
+        """
+        Synchronizes the same change set with injected round trip latency on
+        one and on four connections. The durations are only logged, the
+        parallel run has to use the additional connections.
+        """
+        durations = {}
+        for connections in (1, 4):
+            backend = MemoryBackEnd()
+            self._publish(backend, self._site(1), connections)
+            backend.latency = 0.003
+            backend.calls = []
+            start = time.time()
+            self._publish(backend, self._site(2), connections)
+            durations[connections] = time.time() - start
+            connects = len([call for call in backend.calls if call[0] == 'connect'])
+            self.assertEqual(connects > 1, connections > 1)
+        logging.getLogger(__name__).info("Synchronized with 1 connection in %.3fs, with 4 in %.3fs"
+                                         % (durations[1], durations[4]))
+
+    def test_parallel_state(self):
+        backend = MemoryBackEnd()
+        self._publish(backend, self._site(1), 4)
+        states = []
+        manager = manifestbased.ManifestUploadManager(
+            backend, state_callback=lambda state, *args: states.append(state), connections=4)
+        manager.start(self._working_dir(self._site(2)))
+        self.assertIn('SYNCHRONIZING', states)
+        self.assertFalse(set(states) & set(['DELETE_FILES', 'DELETE_FOLDERS', 'CREATE_FOLDERS',
+                                            'UPLOAD_FILES', 'CHANGE_PERMISSIONS']))
+
+
 if __name__ == "__main__":
     # import sys;sys.argv = ['', 'Test.testName']
     unittest.main()
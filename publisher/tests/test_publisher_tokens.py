@@ -40,6 +40,15 @@ class PublisherTokenTest(SimpleTestCase):
         self.assertEqual(pps['basedir'], request_data['basedir'])
         self.assertEqual(pps['password'], request_data['password'])
         self.assertEqual(pps['chmod'], request_data['chmod'])
+        self.assertNotIn('connections', pps)
+
+        request_data['connections'] = 4
+        pps = res.get_protocol_parameters(request_data)
+        self.assertEqual(pps['connections'], 4)
+
+        request_data['verification'] = 'sampled'
+        pps = res.get_protocol_parameters(request_data)
+        self.assertEqual(pps['verification'], 'sampled')
 
     def test_internal_token(self):
         res = self.sut.create_token(self.internal_token)
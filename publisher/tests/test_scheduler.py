@@ -0,0 +1,92 @@
+import unittest
+import threading
+import time
+
+from publisher.worker.managers.scheduler import Operation, TaskGraph, run_task_graph
+
+
+class Task(object):
+
+    def __init__(self, path):
+        self.path = path
+
+
+class TaskEntry(object):
+
+    def __init__(self, path):
+        self.task = Task(path)
+
+
+def operation(path):
+    return Operation('test', TaskEntry(path))
+
+
+class TaskGraphTest(unittest.TestCase):
+
+    def test_ready_and_complete(self):
+        parent, child, other = operation('a'), operation('a/b'), operation('c')
+        graph = TaskGraph()
+        graph.add(parent)
+        graph.add(child, [parent, None])
+        graph.add(other)
+        self.assertEqual(len(graph), 3)
+        self.assertEqual(graph.get_ready(), [parent, other])
+        self.assertEqual(graph.complete(other), [])
+        self.assertEqual(graph.complete(parent), [child])
+
+    def test_multiple_dependencies(self):
+        first, second, folder = operation('a/x'), operation('a/y'), operation('a')
+        graph = TaskGraph()
+        graph.add(folder, [first, second])
+        graph.add(first)
+        graph.add(second)
+        self.assertEqual(graph.get_ready(), [first, second])
+        self.assertEqual(graph.complete(first), [])
+        self.assertEqual(graph.complete(second), [folder])
+
+
+class RunTaskGraphTest(unittest.TestCase):
+
+    def _chain_graph(self):
+        self.ops = [operation('a'), operation('a/b'), operation('a/b/c'), operation('d')]
+        graph = TaskGraph()
+        graph.add(self.ops[0])
+        graph.add(self.ops[1], [self.ops[0]])
+        graph.add(self.ops[2], [self.ops[1]])
+        graph.add(self.ops[3])
+        return graph
+
+    def test_dependencies_are_respected(self):
+        lock = threading.Lock()
+        started, completed = [], []
+
+        def execute(op):
+            with lock:
+                started.append(op)
+            time.sleep(0.01)
+        run_task_graph(self._chain_graph(), 4, execute, completed.append)
+        self.assertEqual(sorted(completed, key=self.ops.index), self.ops)
+        chain = [op for op in started if op is not self.ops[3]]
+        self.assertEqual(chain, self.ops[:3])
+
+    def test_completed_in_calling_thread(self):
+        threads = set()
+        run_task_graph(self._chain_graph(), 2, lambda op: None,
+                       lambda op: threads.add(threading.current_thread()))
+        self.assertEqual(threads, set([threading.current_thread()]))
+
+    def test_failure_stops_dependents(self):
+        completed = []
+
+        def execute(op):
+            if op is self.ops[1]:
+                raise IOError('Boom!')
+        self.assertRaises(IOError, run_task_graph, self._chain_graph(), 2, execute,
+                          completed.append)
+        self.assertIn(self.ops[0], completed)
+        self.assertNotIn(self.ops[1], completed)
+        self.assertNotIn(self.ops[2], completed)
+
+
+if __name__ == "__main__":
+    unittest.main()
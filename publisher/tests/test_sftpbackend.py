@@ -0,0 +1,189 @@
+import unittest
+import os
+import socket
+import stat
+import threading
+from io import BytesIO
+from mock import Mock, patch, MagicMock
+import paramiko
+from publisher.worker.managers.backends import SFTPUploadBackEnd
+
+
+class SFTPBackEndTest(unittest.TestCase):
+
+    def _backend(self, **kwrds):
+        sftp = SFTPUploadBackEnd('server', 'user', 'pass', 'basedir', 22, **kwrds)
+        sftp._sftp = Mock()
+        self.remote_file = MagicMock()
+        sftp._sftp.open = Mock(return_value=self.remote_file)
+        return sftp
+
+    def _stored(self, sftp, size, mode=0o644):
+        """
+        Sets the stat result of the uploaded file
+        """
+        attr = paramiko.SFTPAttributes()
+        attr.st_size, attr.st_mode = size, stat.S_IFREG | mode
+        sftp._sftp.stat = Mock(return_value=attr)
+
+    def test_upload_is_streamed_and_pipelined(self):
+        sftp = self._backend(chunk_size=1024)
+        data = os.urandom(1024 * 3 + 10)
+        self._stored(sftp, len(data))
+        sftp.upload('test.bin', BytesIO(data))
+
+        sftp._sftp.open.assert_called_once_with('basedir/test.bin', 'wb', 1024)
+        self.remote_file.set_pipelined.assert_called_once_with(True)
+        writes = [call[0][0] for call in self.remote_file.write.call_args_list]
+        self.assertEqual([len(chunk) for chunk in writes], [1024, 1024, 1024, 10])
+        self.assertEqual(b''.join(writes), data)
+        self.remote_file.close.assert_called_once_with()
+        sftp._sftp.stat.assert_called_once_with('basedir/test.bin')
+
+    def test_size_mismatch(self):
+        sftp = self._backend()
+        sftp.connect = Mock()
+        sftp.abort = Mock()
+        self._stored(sftp, 0)
+        self.assertRaises(IOError, sftp.upload, 'test.txt', BytesIO(b'test'))
+
+    def test_mode_is_set_again(self):
+        sftp = self._backend(permission_map={'r': '644'})
+        self._stored(sftp, 4, 0o600)
+        sftp.upload('test.txt', BytesIO(b'test'), 'r')
+        sftp._sftp.chmod.assert_called_once_with('basedir/test.txt', 0o644)
+
+    def test_upload_with_permission(self):
+        sftp = self._backend(permission_map={'r': '644'})
+        self._stored(sftp, 4)
+        sftp.upload('test.txt', BytesIO(b'test'), 'r')
+        self.assertFalse(sftp._sftp.chmod.called)
+        (fileobj, command, handle, attr), _kwrds = sftp._sftp._async_request.call_args
+        self.assertEqual((fileobj, command, handle),
+                         (self.remote_file, paramiko.sftp.CMD_FSETSTAT, self.remote_file.handle))
+        self.assertEqual(attr.st_mode, 0o644)
+        self.remote_file.close.assert_called_once_with()
+
+    def test_upload_with_permission_without_async_request(self):
+        sftp = self._backend(permission_map={'r': '644'})
+        sftp._sftp = Mock(spec=['open', 'stat'])
+        sftp._sftp.open = Mock(return_value=self.remote_file)
+        self._stored(sftp, 4)
+        sftp.upload('test.txt', BytesIO(b'test'), 'r')
+        self.remote_file.chmod.assert_called_once_with(0o644)
+
+    def test_erase_directory(self):
+        sftp = self._backend()
+
+        def attr(name, mode, size=0):
+            entry = paramiko.SFTPAttributes()
+            entry.filename, entry.st_mode, entry.st_size = name, mode, size
+            return entry
+        listings = {'basedir/top': [attr('sub', stat.S_IFDIR | 0o755),
+                                    attr('link', stat.S_IFLNK | 0o777)],
+                    'basedir/top/sub': [attr('a.txt', stat.S_IFREG | 0o644, 12)]}
+        sftp._sftp.listdir_attr = Mock(side_effect=lambda path: listings[path])
+        self.assertEqual(sftp.snapshot('top'), [('top/sub', 'd', 0), ('top/link', 'l', 0),
+                                                ('top/sub/a.txt', '-', 12)])
+        self.assertTrue(sftp.erase_directory('top'))
+        self.assertEqual([call[0][0] for call in sftp._sftp.remove.call_args_list],
+                         ['basedir/top/sub/a.txt', 'basedir/top/link'])
+        sftp._sftp.rmdir.assert_called_once_with('basedir/top/sub')
+        self.assertFalse(sftp._sftp.stat.called)
+
+    def test_retried_upload_starts_at_the_beginning(self):
+        sftp = self._backend(chunk_size=4)
+        self._stored(sftp, 8)
+        sftp.connect = Mock()
+        sftp.quit = Mock()
+        writes = []
+
+        def write(chunk):
+            if len(writes) == 1 and sftp.connect.call_count == 0:
+                raise IOError('Boom!')
+            writes.append(chunk)
+        self.remote_file.write = Mock(side_effect=write)
+        sftp.upload('test.txt', BytesIO(b'12345678'))
+        sftp.connect.assert_called_once_with()
+        self.assertEqual(writes[1:], [b'1234', b'5678'])
+
+    def test_clone_keeps_the_transfer_options(self):
+        sftp = SFTPUploadBackEnd('server', 'user', 'pass', 'basedir', 22,
+                                 chunk_size=1024, window_size=4096)
+        clone = sftp.clone()
+        self.assertEqual((clone.chunk_size, clone.window_size), (1024, 4096))
+
+    @patch('paramiko.SFTPClient')
+    @patch('paramiko.Transport')
+    def test_window_size(self, transport, _client):
+        SFTPUploadBackEnd('server', 'user', 'pass', 'basedir', 22,
+                          window_size=4096).connect()
+        transport.assert_called_once_with(('server', 22), default_window_size=4096)
+        transport.reset_mock()
+        SFTPUploadBackEnd('server', 'user', 'pass', 'basedir', 22).connect()
+        transport.assert_called_once_with(('server', 22))
+
+
+class FailingWriteHandle(paramiko.SFTPHandle):
+
+    def write(self, offset, data):
+        return paramiko.SFTP_FAILURE
+
+
+class FailingWriteSFTPServer(paramiko.SFTPServerInterface):
+    """
+    SFTP server that opens every file, but doesn't store anything
+    """
+
+    def open(self, path, flags, attr):
+        handle = FailingWriteHandle(flags)
+        handle.filename = path
+        return handle
+
+    def stat(self, path):
+        attr = paramiko.SFTPAttributes()
+        attr.st_size, attr.st_mode = 0, stat.S_IFREG | 0o644
+        return attr
+
+    def lstat(self, path):
+        return self.stat(path)
+
+
+class PasswordServer(paramiko.ServerInterface):
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+
+class SFTPServerTest(unittest.TestCase):
+
+    def setUp(self):
+        client_sock, server_sock = socket.socketpair()
+        server = paramiko.Transport(server_sock)
+        self.addCleanup(server.close)
+        server.add_server_key(paramiko.RSAKey.generate(1024))
+        server.set_subsystem_handler('sftp', paramiko.SFTPServer, FailingWriteSFTPServer)
+        server.start_server(threading.Event(), PasswordServer())
+        self.transport = paramiko.Transport(client_sock)
+        self.addCleanup(self.transport.close)
+        self.transport.connect(username='user', password='pass')
+
+    def test_failed_write_raises(self):
+        sftp = SFTPUploadBackEnd('server', 'user', 'pass', 'basedir', 22,
+                                 permission_map={'r': '644'}, chunk_size=4)
+        sftp._sftp = paramiko.SFTPClient.from_transport(self.transport)
+        sftp.connect = Mock()
+        sftp.abort = Mock()
+        for permission in (None, 'r'):
+            self.assertRaises(IOError, sftp.upload, 'test.txt', BytesIO(b'12345678'),
+                              permission)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+import unittest
+import mock
+
+from publisher.worker.state import StateReporter
+
+
+class StateReporterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 100.0
+        self.push = mock.Mock()
+        self.reporter = StateReporter(self.push, 2, 0.01, clock=lambda: self.now)
+
+    def test_first_update_is_pushed(self):
+        self.assertTrue(self.reporter.update('UPLOAD_FILES', 0.0, {'a': 1}))
+        self.push.assert_called_once_with('UPLOAD_FILES', {'a': 1})
+
+    def test_small_changes_are_dropped(self):
+        self.reporter.update('UPLOAD_FILES', 0.1, {})
+        self.assertFalse(self.reporter.update('UPLOAD_FILES', 0.105, {}))
+        self.assertFalse(self.reporter.update('UPLOAD_FILES', 0.109, {}))
+        self.assertTrue(self.reporter.update('UPLOAD_FILES', 0.12, {}))
+        self.assertEqual(self.push.call_count, 2)
+
+    def test_state_change_is_pushed(self):
+        self.reporter.update('DELETE_FILES', 0.1, {})
+        self.assertTrue(self.reporter.update('UPLOAD_FILES', 0.1, {}))
+
+    def test_dropped_update_is_pushed_before_the_next_state(self):
+        self.reporter.update('DELETE_FILES', 0.1, {'n': 1})
+        self.reporter.update('DELETE_FILES', 0.105, {'n': 2})
+        self.assertTrue(self.reporter.update('UPLOAD_FILES', 0.105, {'n': 3}))
+        self.assertEqual(self.push.call_args_list,
+                         [mock.call('DELETE_FILES', {'n': 1}), mock.call('DELETE_FILES', {'n': 2}),
+                          mock.call('UPLOAD_FILES', {'n': 3})])
+
+    def test_flush(self):
+        self.reporter.update('UPLOAD_FILES', 0.99, {'n': 1})
+        self.assertFalse(self.reporter.update('UPLOAD_FILES', 0.995, {'n': 2}))
+        self.assertTrue(self.reporter.flush())
+        self.push.assert_called_with('UPLOAD_FILES', {'n': 2})
+        self.assertFalse(self.reporter.flush())
+        self.assertEqual(self.push.call_count, 2)
+
+    def test_interval(self):
+        self.reporter.update('DOWNLOADING', None, {})
+        self.now += 1
+        self.assertFalse(self.reporter.update('DOWNLOADING', None, {}))
+        self.now += 1
+        self.assertTrue(self.reporter.update('DOWNLOADING', None, {}))
+        self.assertFalse(self.reporter.update('DOWNLOADING', None, {}))
+        self.assertTrue(self.reporter.update('DOWNLOADING', 0.5, {}))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+import unittest
+import mock
+import os
+import uuid
+
+import publisher.worker
+from publisher import tasks
+from publisher.worker.managers import manifestbased
+from publisher.tests.memory_backend import MemoryBackEnd
+
+
+class PublishRedeliveryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.download_url = 'http://test/%s.zip' % uuid.uuid4().hex
+        self.working_dir = publisher.worker.get_tmp_dir(self.download_url)
+        self.addCleanup(publisher.worker.clean_tmp_dir, self.working_dir)
+        self.files = dict(('f%d/file%d.txt' % (i % 3, i), b'x' * i) for i in range(20))
+
+    def _collect(self, download_url, working_dir, *args):
+        for name, data in self.files.items():
+            path = os.path.join(working_dir, publisher.worker.WEBSITE_FOLDER, name)
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as f:
+                f.write(data)
+        for name in ('writeable.txt', 'cache.txt'):
+            open(os.path.join(working_dir, name), 'w').close()
+
+    def test_publish_is_redelivered(self):
+        self.assertTrue(tasks.publish.acks_late)
+        self.assertTrue(tasks.publish.reject_on_worker_lost)
+
+    @mock.patch('publisher.worker._get_hash_cache', return_value=None)
+    @mock.patch('publisher.worker.init_manager')
+    @mock.patch('publisher.worker.ZIPCollector')
+    def test_redelivered_job_resumes(self, collector, init_manager, _hash_cache):
+        collector.return_value.collect.side_effect = self._collect
+        backend = MemoryBackEnd()
+        upload = backend.upload
+
+        def killed_upload(path, fp, permission=None):
+            if len(backend.uploaded()) == 10:
+                # Not handled by the worker, like a killed process
+                raise SystemExit()
+            upload(path, fp, permission)
+        backend.upload = killed_upload
+        init_manager.side_effect = lambda *args: manifestbased.ManifestUploadManager(
+            backend, connections=1)
+        self.assertRaises(SystemExit, publisher.worker.publish,
+                          self.download_url, None, 'memory', {})
+        del backend.upload
+        uploaded = set(p for p in backend.uploaded() if '.publisher' not in p)
+
+        # The broker redelivers the job with the same arguments
+        backend.calls = []
+        publisher.worker.publish(self.download_url, None, 'memory', {})
+        resumed = set(p for p in backend.uploaded() if '.publisher' not in p)
+        self.assertEqual(collector.return_value.collect.call_count, 1)
+        self.assertTrue(uploaded)
+        self.assertFalse(uploaded & resumed)
+        self.assertEqual(sorted(p for p in backend.files if '.publisher' not in p),
+                         sorted(self.files))
+        self.assertFalse(os.path.exists(self.working_dir))
+
+
+if __name__ == "__main__":
+    unittest.main()
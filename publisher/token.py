@@ -35,6 +35,7 @@ class PublisherToken(object, metaclass=abc.ABCMeta):
     PAYLOAD_SIZE = 2
 
     PROTOCOL_PARAMETERS = []
+    OPTIONAL_PROTOCOL_PARAMETERS = []
 
     def __init__(self, token_payload):
         self.instance = None
@@ -102,6 +103,9 @@ class PublisherToken(object, metaclass=abc.ABCMeta):
             parameters = {}
             for p in self.PROTOCOL_PARAMETERS:
                 parameters[p] = request_data[p]
+            for p in self.OPTIONAL_PROTOCOL_PARAMETERS:
+                if p in request_data:
+                    parameters[p] = request_data[p]
             return parameters
         except KeyError:
             raise InvalidBackendData('Protocol parameter missing: %s' % p)
@@ -144,6 +148,7 @@ class ExternalPublisherToken(PublisherToken):
 
     TYPE = PublisherToken.TYPE_EXTERNAL
     PROTOCOL_PARAMETERS = {'host', 'username', 'password', 'basedir', 'port', 'chmod'}
+    OPTIONAL_PROTOCOL_PARAMETERS = {'connections', 'verification'}
     FIELD_PROTOCOL = 'protocol'
 
     def get_protocol(self, request_data):
@@ -7,7 +7,12 @@ import shutil
 # Used for folder name calculation
 import hashlib
 
-from .collector import ZIPCollector
+from django.conf import settings
+
+from .collector import ZIPCollector, read_checksums, DOWNLOAD_FILE
+from .hashcache import HashCache
+from .archive import ZipArchive
+from .checkpoint import RecoveryCheckpoint
 
 from .exceptions import RetryException
 from .managers import init_manager
@@ -39,25 +44,76 @@ def clean_tmp_dir(tmp_dir):
         shutil.rmtree(tmp_dir)
 
 
+# Back ends that can upload the files directly from the archive
+ARCHIVE_MODE_BACKENDS = ('ftp', 'ftps', 'sftp')
+
+# Folder in the publish archive with the website files
+WEBSITE_FOLDER = "website"
+
+
 def _read_list_file(path):
     with open(path) as read_file:
         return [line.strip() for line in read_file]
 
 
+def _read_website_checksums(working_dir):
+    """
+    Returns the checksums calculated while collecting, with the paths
+    relative to the website folder
+    """
+    checksums = read_checksums(working_dir)
+    if checksums is None:
+        return None
+    prefix = WEBSITE_FOLDER + os.sep
+    return dict((path[len(prefix):], checksum)
+                for path, checksum in checksums.items()
+                if path.startswith(prefix))
+
+
+def _get_hash_cache():
+    """
+    Returns the shared md5 hash cache or None when it is disabled
+    """
+    if not settings.PUBLISHER_HASH_CACHE_SIZE:
+        return None
+    path = settings.PUBLISHER_HASH_CACHE_FILE or \
+        os.path.join(tempfile.gettempdir(), "publisher-hash-cache.sqlite")
+    try:
+        return HashCache(path, settings.PUBLISHER_HASH_CACHE_SIZE)
+    except Exception:
+        logger.exception("Couldn't open the hash cache %s" % path)
+        return None
+
+
 def publish(download_url, test_url, backend, backend_parameters,
             recovery=None, state_callback=None):
     """
     Publishs a publishing file from download_url to the given back end server
     """
+    archive_mode = settings.PUBLISHER_ARCHIVE_MODE and backend in ARCHIVE_MODE_BACKENDS
+    hash_cache = _get_hash_cache()
+    archive = None
     try:
         # Prepare working dir
         working_dir = get_tmp_dir(download_url)
-        if recovery is None or not os.path.exists(working_dir):
+        # The checkpoint is written after the collecting, a job with a
+        # checkpoint was killed while synchronizing and redelivered
+        checkpoint = RecoveryCheckpoint(working_dir, settings.PUBLISHER_CHECKPOINT_SYNC_INTERVAL)
+        resume = recovery is None and checkpoint.exists()
+        if resume:
+            logger.info("Found a checkpoint in %s" % working_dir)
+        if (recovery is None and not resume) or not os.path.exists(working_dir):
             # Prepares the job for upload
             if not os.path.exists(working_dir):
                 os.mkdir(working_dir)
-            collector = ZIPCollector()
-            collector.collect(download_url, working_dir)
+            collector = ZIPCollector(settings.PUBLISHER_DOWNLOAD_SPOOL_SIZE, state_callback,
+                                     settings.PUBLISHER_EXTRACT_WORKERS, hash_cache)
+            if archive_mode:
+                # Only the meta data files are extracted
+                collector.collect(download_url, working_dir,
+                                  lambda name: not name.startswith(WEBSITE_FOLDER + "/"))
+            else:
+                collector.collect(download_url, working_dir)
 
         # Init back end
         _manager = init_manager(test_url, backend, backend_parameters, state_callback)
@@ -67,9 +123,14 @@ def publish(download_url, test_url, backend, backend_parameters,
         cache_list = _read_list_file(cache_txt)
         logger.debug("Writeable list: %s" % writeable_list)
         logger.debug("Cache list: %s" % cache_list)
+        checksums = _read_website_checksums(working_dir)
+        if archive_mode:
+            archive = ZipArchive(os.path.join(working_dir, DOWNLOAD_FILE),
+                                 WEBSITE_FOLDER + "/", hash_cache)
 
         # Start job
-        _manager.start(os.path.join(working_dir, "website"), recovery, writeable_list, cache_list)
+        _manager.start(os.path.join(working_dir, WEBSITE_FOLDER), recovery, writeable_list,
+                       cache_list, checksums, archive, checkpoint)
         # Clean up
         clean_tmp_dir(working_dir)
     except RetryException as e:
@@ -78,6 +139,11 @@ def publish(download_url, test_url, backend, backend_parameters,
     except Exception as e:
         clean_tmp_dir(working_dir)
         raise e
+    finally:
+        if archive is not None:
+            archive.close()
+        if hash_cache is not None:
+            hash_cache.close()
 
 
 def delete(backend, backend_parameters):
@@ -0,0 +1,137 @@
+'''
+Read access to the website files of a downloaded publish archive.
+
+In the archive mode the website files are not extracted. The local file list
+is build from the zip central directory (path, size, CRC32) and the files are
+streamed from the archive to the back end when they are uploaded.
+'''
+import os
+import threading
+import zipfile
+
+from .exceptions import NoRetryException
+from .managers.manifestbased import FileList, FileListFileEntry, FileListFolderEntry
+
+# Logging support
+import logging
+logger = logging.getLogger(__name__)
+
+
+class ArchiveMemberFile(object):
+    """
+    File object of an archive member. The CRC of the member is checked
+    while it is read, a wrong CRC raises a NoRetryException.
+    """
+
+    def __init__(self, member_file, name):
+        self._member_file = member_file
+        self.name = name
+
+    def read(self, *args):
+        try:
+            return self._member_file.read(*args)
+        except zipfile.BadZipFile:
+            logger.error("Internal zip file CRC of %s failed" % self.name)
+            raise NoRetryException("Internal zip file CRC of %s failed" % self.name)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        """
+        Moves to the given position, e.g. to the start for a retried upload.
+        Rewinding restarts the decompression and the CRC check of the member.
+        """
+        return self._member_file.seek(offset, whence)
+
+    def tell(self):
+        return self._member_file.tell()
+
+    def close(self):
+        self._member_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ZipArchive(object):
+    """
+    The website folder (prefix) of a zip archive
+    """
+
+    def __init__(self, path, prefix="website/", hash_cache=None):
+        self.path = path
+        self.prefix = prefix
+        self._hash_cache = hash_cache
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._zip_files = []
+
+    def _zip_file(self):
+        """
+        Returns the ZipFile handle of the current thread
+        """
+        zfile = getattr(self._local, 'zfile', None)
+        if zfile is None:
+            zfile = zipfile.ZipFile(self.path, 'r')
+            self._local.zfile = zfile
+            with self._lock:
+                self._zip_files.append(zfile)
+        return zfile
+
+    def _member_name(self, path):
+        return self.prefix + os.path.normpath(path)
+
+    def get_file_list(self, type_mapper=None):
+        """
+        Builds the FileList from the zip central directory. The paths are the
+        same as FileList.scan_local_folder would return for the extracted
+        folder. The md5 checksums are only known for files in the hash cache.
+        """
+        if not type_mapper:
+            type_mapper = lambda _path: 'r'
+        files = []
+        folders = set()
+        for info in self._zip_file().infolist():
+            if not info.filename.startswith(self.prefix):
+                continue
+            name = info.filename[len(self.prefix):].rstrip('/')
+            if not name:
+                continue
+            folder = name if info.filename.endswith('/') else os.path.dirname(name)
+            while folder:
+                folders.add(folder)
+                folder = os.path.dirname(folder)
+            if not info.filename.endswith('/'):
+                files.append(info)
+        known_hashes = {}
+        if self._hash_cache is not None:
+            known_hashes = self._hash_cache.get_many(
+                (os.path.normpath(info.filename), info.CRC, info.file_size) for info in files)
+        file_list = []
+        for info in files:
+            name = info.filename[len(self.prefix):]
+            path = os.path.join(os.path.dirname(name) or '.', os.path.basename(name))
+            checksum = known_hashes.get((os.path.normpath(info.filename), info.CRC,
+                                         info.file_size))
+            file_list.append(FileListFileEntry(path, type_mapper(path), info.file_size,
+                                               checksum, info.CRC))
+        folder_list = [FileListFolderEntry(folder, type_mapper(folder))
+                       for folder in sorted(folders)]
+        logger.debug("Read %d files and %d folders from %s"
+                     % (len(file_list), len(folder_list), self.path))
+        return FileList(file_list, folder_list)
+
+    def open(self, path):
+        """
+        Opens the given website file for reading
+        """
+        name = self._member_name(path)
+        return ArchiveMemberFile(self._zip_file().open(name), name)
+
+    def close(self):
+        with self._lock:
+            zip_files, self._zip_files = self._zip_files, []
+            self._local = threading.local()
+        for zfile in zip_files:
+            zfile.close()
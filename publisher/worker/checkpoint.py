@@ -0,0 +1,98 @@
+'''
+Local checkpoint of the recovery state of a publish job.
+
+The task list is stored once when the synchronization starts. Afterwards only
+the finished tasks are appended to a journal, so a job that was killed
+without raising a RetryException (e.g. by the OOM killer) resumes from the
+last checkpoint instead of starting over.
+'''
+import json
+import os
+import pickle
+import time
+
+# Logging support
+import logging
+logger = logging.getLogger(__name__)
+
+# Names of the checkpoint files in the job working dir
+CHECKPOINT_FILE = "recovery.pickle"
+CHECKPOINT_JOURNAL_FILE = "recovery.journal"
+
+
+class RecoveryCheckpoint(object):
+    """
+    Task list snapshot and journal of the finished tasks in the job working
+    dir. Every journal record is handed to the OS immediately, the journal
+    is synced to the disk at most every interval seconds.
+    """
+
+    def __init__(self, working_dir, interval=10, clock=time.time):
+        self.path = os.path.join(working_dir, CHECKPOINT_FILE)
+        self.journal_path = os.path.join(working_dir, CHECKPOINT_JOURNAL_FILE)
+        self.interval = interval
+        self._clock = clock
+        self._journal = None
+        self._last_sync = None
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def load(self):
+        """
+        Returns the stored task list with the journaled tasks marked as done
+        or None if there is no (readable) checkpoint
+        """
+        if not self.exists():
+            return None
+        try:
+            with open(self.path, 'rb') as checkpoint_file:
+                tasklist = pickle.load(checkpoint_file)
+        except Exception:
+            logger.exception("Couldn't read the checkpoint %s" % self.path)
+            return None
+        records = []
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path) as journal:
+                for line in journal:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        # The last record of a killed job can be incomplete
+                        logger.warning("Ignoring incomplete checkpoint record")
+                        break
+        tasklist.restore_done(records)
+        logger.info("Loaded checkpoint with %d finished tasks" % len(records))
+        return tasklist
+
+    def start(self, tasklist):
+        """
+        Stores the task list (atomically) and starts a new journal
+        """
+        self.close()
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'wb') as checkpoint_file:
+            pickle.dump(tasklist, checkpoint_file, pickle.HIGHEST_PROTOCOL)
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+        # Records of the old journal are also part of the new task list
+        os.rename(tmp_path, self.path)
+        self._journal = open(self.journal_path, 'w')
+        self._last_sync = self._clock()
+
+    def record(self, category, entry):
+        """
+        Journals the finished task list entry of the given category
+        """
+        if self._journal is None:
+            return
+        self._journal.write(json.dumps([category, entry.path, entry.old]) + "\n")
+        self._journal.flush()
+        if self._clock() - self._last_sync >= self.interval:
+            os.fsync(self._journal.fileno())
+            self._last_sync = self._clock()
+
+    def close(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
@@ -7,15 +7,84 @@ Created on 23.01.2013
 import zipfile
 # Used to download the zip file from the instance
 import urllib.request, urllib.error, urllib.parse
+import http.client
 import contextlib
 # Used as a in memory buffer of the downloaded zip file
 import tempfile
+# Used to calculate and store the checksums while extracting
+import hashlib
+import json
+import os
+# Used to report the peak memory usage
+import resource
+# Used for the parallel extraction
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 # Logging support
 import logging
 logger = logging.getLogger(__name__)
 
-from publisher.worker.exceptions import NoRetryException
+from publisher.worker.exceptions import NoRetryException, RetryException
+
+# Name of the file (in the working dir) with the size and md5 hash of all
+# extracted files
+CHECKSUM_FILE = "checksums.json"
+
+# Buffer size used while extracting the zip members
+EXTRACT_CHUNK_SIZE = 1024 * 1024
+
+# Buffer size used while downloading the zip file
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# The download state is reported after each DOWNLOAD_STATE_INTERVAL bytes
+DOWNLOAD_STATE_INTERVAL = 16 * 1024 * 1024
+
+# Name of the (partial) download file in the working dir
+DOWNLOAD_FILE = "download.zip"
+
+# Name of the file with the validation data for resuming the download
+DOWNLOAD_STATE_FILE = "download.json"
+
+
+def split_member_ranges(infolist, count):
+    """
+    Splits the zip members into max. count continuous ranges with a similar
+    (compressed) size
+    """
+    total = sum(info.compress_size for info in infolist)
+    range_size = float(total) / count if count else total
+    member_ranges = [[]]
+    current_size = 0
+    for info in infolist:
+        if member_ranges[-1] and current_size >= range_size * len(member_ranges) \
+                and len(member_ranges) < count:
+            member_ranges.append([])
+        member_ranges[-1].append(info)
+        current_size += info.compress_size
+    return member_ranges
+
+
+class DownloadRetryException(RetryException):
+    """
+    Raised when the download failed or is incomplete. The partial download
+    stays in the working dir and is resumed by the next try.
+    """
+
+    def __init__(self, msg):
+        super(DownloadRetryException, self).__init__(msg, None)
+
+
+def read_checksums(working_dir):
+    """
+    Returns the checksums of the extracted files as dict (path -> [size, md5, crc])
+    or None when the working dir doesn't contain a checksum file.
+    """
+    path = os.path.join(working_dir, CHECKSUM_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as checksum_file:
+        return json.load(checksum_file)
 
 
 class ZIPCollector:
@@ -23,33 +92,213 @@ class ZIPCollector:
     Collects the webside data from the instance and extracts it in a directory.
     """
 
-    def collect(self, url, working_dir):
+    STATE_DOWNLOADING = "DOWNLOADING"
+
+    # Downloads bigger than this (in bytes) are moved from memory to disk
+    spool_size = 16 * 1024 * 1024
+
+    # Number of threads used to extract the zip file
+    extract_workers = 1
+
+    _state_callback = None
+
+    _hash_cache = None
+
+    def __init__(self, spool_size=None, state_callback=None, extract_workers=None,
+                 hash_cache=None):
+        if spool_size is not None:
+            self.spool_size = spool_size
+        if extract_workers is not None:
+            self.extract_workers = extract_workers
+        self._state_callback = state_callback
+        self._hash_cache = hash_cache
+
+    def collect(self, url, working_dir, member_filter=None):
         """
         Download, validates a zip file and extracts it content to the given
-        directory
+        directory. The size, md5 hash and CRC of each file is calculated
+        while extracting and stored in the CHECKSUM_FILE of the working dir.
+
+        With a member_filter only the members matching the filter are
+        extracted and the zip file is kept as DOWNLOAD_FILE in the working
+        dir, so the other members can be read from the archive later.
         """
-        downloaded_zip_file = self._downloadData(url)
-        self._validateData(downloaded_zip_file)
-        self._extractData(downloaded_zip_file, working_dir)
+        keep_download = member_filter is not None
+        downloaded_zip_file = self._downloadData(url, working_dir, spool=not keep_download)
+        try:
+            self._validateData(downloaded_zip_file)
+            checksums = self._extractData(downloaded_zip_file, working_dir, member_filter)
+            self._write_checksums(checksums, working_dir)
+        finally:
+            downloaded_zip_file.close()
+            if not keep_download:
+                self._remove_download(working_dir)
 
-    def _downloadData(self, url):
+    def _downloadData(self, url, working_dir=None, spool=True):
         """
-        Downloads the related content/data from the publisher instance and
-        stores it in memory.
+        Downloads the related content/data from the publisher instance.
+
+        Small downloads (if spool is True) or all downloads without a
+        working dir are stored
+        in a temporary file, that is kept in memory until it grows bigger
+        than spool_size. All other downloads are written to the DOWNLOAD_FILE
+        of the working dir. When such a download fails, it is resumed with a
+        HTTP range request on the next try, if the server sends a validator
+        (ETag or Last-Modified) for the file.
 
         Returns the file object of the download file
         """
         logger.debug("Downloading file from: %s" % url)
-        with self._open_url(url) as url_file:
-            mem_puffer = tempfile.SpooledTemporaryFile()
-            mem_puffer.write(url_file.read())
-            mem_puffer.seek(0)
-            return mem_puffer
+        download_path = None
+        download_state = None
+        offset = 0
+        headers = {}
+        if working_dir:
+            download_path = os.path.join(working_dir, DOWNLOAD_FILE)
+            download_state = self._read_download_state(url, working_dir)
+            if download_state:
+                offset = os.path.getsize(download_path)
+                logger.info("Resuming download of %s at byte %d" % (url, offset))
+                headers['Range'] = 'bytes=%d-' % offset
+                headers['If-Range'] = download_state['validator']
+        try:
+            with self._open_url(url, headers) as url_file:
+                if offset and not self._is_resumed(url_file, offset, download_state,
+                                                   working_dir):
+                    logger.info("Server sent the complete file, restarting download")
+                    offset = 0
+                length = self._get_content_length(url_file)
+                if length is not None:
+                    length += offset
+                if not download_path or (spool and not offset and length is not None and
+                                         length <= self.spool_size):
+                    puffer = tempfile.SpooledTemporaryFile(max_size=self.spool_size)
+                    downloaded = self._copy_download(url_file, puffer, 0)
+                    puffer.seek(0)
+                else:
+                    if not offset:
+                        self._write_download_state(url, url_file, length, working_dir)
+                    with open(download_path, 'ab' if offset else 'wb') as download_file:
+                        downloaded = self._copy_download(url_file, download_file, offset)
+                    puffer = open(download_path, 'rb')
+        except urllib.error.HTTPError as e:
+            if e.code == 416:
+                # Range not satisfiable, the partial download is useless
+                self._remove_download(working_dir)
+                raise DownloadRetryException("Couldn't resume the download: %s" % e)
+            if e.code < 500:
+                raise
+            raise DownloadRetryException("Download failed: %s" % e)
+        except (urllib.error.URLError, http.client.HTTPException, OSError) as e:
+            logger.warning("Download of %s failed: %s" % (url, e))
+            raise DownloadRetryException("Download failed: %s" % e)
+        if length is not None and downloaded != length:
+            puffer.close()
+            logger.warning("Download of %s incomplete (%d of %d bytes)"
+                           % (url, downloaded, length))
+            raise DownloadRetryException("Download incomplete (%d of %d bytes)"
+                                         % (downloaded, length))
+        logger.info("Downloaded %d bytes from %s" % (downloaded, url))
+        self._update_state(downloaded)
+        return puffer
+
+    def _copy_download(self, url_file, puffer, offset):
+        """
+        Copies the response into the given file and returns the size of the
+        download (including the offset of a resumed download)
+        """
+        downloaded = offset
+        next_report = offset + DOWNLOAD_STATE_INTERVAL
+        for data in iter(lambda: url_file.read(DOWNLOAD_CHUNK_SIZE), b''):
+            puffer.write(data)
+            downloaded += len(data)
+            if downloaded >= next_report:
+                self._update_state(downloaded)
+                next_report += DOWNLOAD_STATE_INTERVAL
+        return downloaded
+
+    def _get_content_length(self, url_file):
+        try:
+            return int(url_file.headers['Content-Length'])
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def _is_resumed(self, url_file, offset, download_state, working_dir):
+        """
+        Checks that the server answered the range request with the missing
+        part of the same file.
+        """
+        if url_file.getcode() != 206:
+            return False
+        content_range = url_file.headers.get('Content-Range', '')
+        try:
+            unit, byte_range = content_range.split(' ', 1)
+            byte_range, total = byte_range.split('/', 1)
+            start = int(byte_range.split('-', 1)[0])
+        except ValueError:
+            raise DownloadRetryException("Invalid Content-Range: %s" % content_range)
+        if unit != 'bytes' or start != offset or \
+                str(download_state['length']) != total:
+            self._remove_download(working_dir)
+            raise DownloadRetryException("Unexpected Content-Range: %s" % content_range)
+        return True
+
+    def _read_download_state(self, url, working_dir):
+        """
+        Returns the validation data of a resumable partial download or None
+        """
+        state_path = os.path.join(working_dir, DOWNLOAD_STATE_FILE)
+        download_path = os.path.join(working_dir, DOWNLOAD_FILE)
+        if not (os.path.exists(state_path) and os.path.exists(download_path)):
+            return None
+        with open(state_path) as state_file:
+            download_state = json.load(state_file)
+        size = os.path.getsize(download_path)
+        if download_state.get('url') != url or not size or \
+                size >= download_state.get('length'):
+            return None
+        return download_state
+
+    def _write_download_state(self, url, url_file, length, working_dir):
+        """
+        Stores the validation data for a later resume of the download. A
+        download can only be resumed with a known length and a validator.
+        """
+        state_path = os.path.join(working_dir, DOWNLOAD_STATE_FILE)
+        etag = url_file.headers.get('ETag')
+        validator = etag if etag and not etag.startswith('W/') else \
+            url_file.headers.get('Last-Modified')
+        if length is None or not validator:
+            if os.path.exists(state_path):
+                os.remove(state_path)
+            return
+        with open(state_path, 'w') as state_file:
+            json.dump({'url': url, 'validator': validator, 'length': length},
+                      state_file)
+
+    def _remove_download(self, working_dir):
+        """
+        Removes the (partial) download file and its state from the working dir
+        """
+        if not working_dir:
+            return
+        for filename in (DOWNLOAD_FILE, DOWNLOAD_STATE_FILE):
+            path = os.path.join(working_dir, filename)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _update_state(self, downloaded):
+        if self._state_callback is None:
+            return
+        stats = {'downloaded_bytes': downloaded,
+                 'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+        self._state_callback(self.STATE_DOWNLOADING, None, None, None, stats)
 
     def _validateData(self, zdata):
         """
         Validates the content of the zip file (zdata) and throws an exception
-        when something is wrong with the given zip file
+        when something is wrong with the given zip file. The CRC's of the
+        members are checked while extracting them.
         """
         logger.debug("Checking magic number")
         if not self._is_zipfile(zdata):
@@ -58,14 +307,6 @@ class ZIPCollector:
         logger.debug("Magic number for ZIP found")
 
         with self._open_zip(zdata) as zfile:
-            logger.debug("Validating content of the zip file")
-            badfile = zfile.testzip()
-            if badfile:
-                logger.error("Internal zip file CRC of %s failed" % badfile)
-                raise NoRetryException("Internal zip file CRC of %s failed"
-                                       % badfile)
-            logger.debug("All crc's are okay")
-
             logger.debug("Validating the filenames in the zip file")
             for name in zfile.namelist():
                 # TODO os.path.join + os.path.abs
@@ -76,22 +317,168 @@ class ZIPCollector:
                                            " file: %s" % name)
             logger.debug("All filenames are okay")
 
-    def _extractData(self, zdata, working_dir):
+    def _extractData(self, zdata, working_dir, member_filter=None):
         """
-        Extracts the given zip file in the given directory.
+        Extracts the given zip file in the given directory. Stops and removes
+        the extracted files on the first member with a wrong CRC.
+
+        With more than one extract worker and a zip file on disk, the
+        members are split into ranges that are extracted concurrently, each
+        range with its own ZipFile handle (zlib releases the GIL).
+
+        Members found in the hash cache are not hashed again. Only the
+        members matching the optional member_filter are extracted.
+
+        Returns a dict with the size, md5 hash and CRC of each extracted file
         """
         with self._open_zip(zdata) as zfile:
             logger.debug("Extracting zip file")
-            zfile.extractall(working_dir)
+            infolist = zfile.infolist()
+            if member_filter is not None:
+                infolist = [info for info in infolist if member_filter(info.filename)]
+            known_hashes = self._get_known_hashes(infolist)
+            archive_path = getattr(zdata, 'name', None)
+            try:
+                if self.extract_workers > 1 and len(infolist) > 1 and \
+                        isinstance(archive_path, str):
+                    results = self._extract_parallel(archive_path, infolist, working_dir,
+                                                     known_hashes)
+                else:
+                    results = self._extract_members(zfile, infolist, working_dir,
+                                                    known_hashes)
+            except NoRetryException:
+                self._remove_extracted(infolist, working_dir)
+                raise
+            logger.debug("All crc's are okay")
             logger.debug("All files extracted to %s" % working_dir)
+        self._store_hashes(results, known_hashes)
+        return dict((os.path.normpath(info.filename), checksum)
+                    for info, checksum in results if checksum)
+
+    def _hash_cache_key(self, info):
+        return (os.path.normpath(info.filename), info.CRC, info.file_size)
+
+    def _get_known_hashes(self, infolist):
+        """
+        Returns the md5 hashes (hash cache key -> md5) of the members that
+        are in the hash cache
+        """
+        if self._hash_cache is None:
+            return {}
+        return self._hash_cache.get_many(self._hash_cache_key(info) for info in infolist
+                                         if not info.filename.endswith('/'))
+
+    def _store_hashes(self, results, known_hashes):
+        if self._hash_cache is None:
+            return
+        new_hashes = {}
+        for info, checksum in results:
+            key = self._hash_cache_key(info)
+            if checksum and key not in known_hashes:
+                new_hashes[key] = checksum[1]
+        self._hash_cache.put_many(new_hashes)
+
+    def _extract_members(self, zfile, infolist, working_dir, known_hashes,
+                         stop_event=None):
+        """
+        Extracts the given members and returns a list of (member, checksum)
+        tuples. Stops when the optional stop_event is set.
+        """
+        results = []
+        for info in infolist:
+            if stop_event is not None and stop_event.is_set():
+                break
+            md5 = known_hashes.get(self._hash_cache_key(info))
+            try:
+                results.append((info, self._extract_member(zfile, info, working_dir, md5)))
+            except zipfile.BadZipFile:
+                logger.error("Internal zip file CRC of %s failed" % info.filename)
+                raise NoRetryException("Internal zip file CRC of %s failed"
+                                       % info.filename)
+        return results
+
+    def _extract_parallel(self, archive_path, infolist, working_dir, known_hashes):
+        """
+        Extracts the members concurrently in ranges of similar size
+        """
+        member_ranges = split_member_ranges(infolist, self.extract_workers)
+        logger.debug("Extracting %d members with %d workers"
+                     % (len(infolist), len(member_ranges)))
+        stop_event = threading.Event()
+
+        def extract_range(members):
+            try:
+                with self._open_zip(archive_path) as zfile:
+                    return self._extract_members(zfile, members, working_dir,
+                                                 known_hashes, stop_event)
+            except Exception:
+                stop_event.set()
+                raise
+
+        with ThreadPoolExecutor(max_workers=len(member_ranges)) as executor:
+            futures = [executor.submit(extract_range, members)
+                       for members in member_ranges]
+        results = []
+        for future in futures:
+            results.extend(future.result())
+        return results
+
+    def _remove_extracted(self, infolist, working_dir):
+        """
+        Removes the (partly) extracted members of the zip file
+        """
+        folders = set()
+        for info in infolist:
+            target = os.path.join(working_dir, info.filename)
+            if not info.filename.endswith('/') and os.path.isfile(target):
+                os.remove(target)
+            folder = info.filename.rstrip('/') if info.filename.endswith('/') \
+                else os.path.dirname(info.filename)
+            while folder:
+                folders.add(folder)
+                folder = os.path.dirname(folder)
+        # Child folders before their parents
+        for folder in sorted(folders, reverse=True):
+            path = os.path.join(working_dir, folder)
+            if os.path.isdir(path) and not os.listdir(path):
+                os.rmdir(path)
+
+    def _extract_member(self, zfile, info, working_dir, md5sum=None):
+        """
+        Extracts a single zip member and hashes it while it is written,
+        unless its md5sum is already known.
+
+        Returns the size, md5 hash and CRC of the file or None for directories
+        """
+        target = os.path.join(working_dir, info.filename)
+        if info.filename.endswith('/'):
+            os.makedirs(target, exist_ok=True)
+            return None
+        target_dir = os.path.dirname(target)
+        if target_dir:
+            os.makedirs(target_dir, exist_ok=True)
+        md5 = hashlib.md5() if md5sum is None else None
+        size = 0
+        with zfile.open(info) as source, open(target, 'wb') as dest:
+            for data in iter(lambda: source.read(EXTRACT_CHUNK_SIZE), b''):
+                if md5 is not None:
+                    md5.update(data)
+                dest.write(data)
+                size += len(data)
+        return [size, md5.hexdigest() if md5 is not None else md5sum, info.CRC]
+
+    def _write_checksums(self, checksums, working_dir):
+        with open(os.path.join(working_dir, CHECKSUM_FILE), 'w') as checksum_file:
+            json.dump(checksums, checksum_file)
 
     def _open_zip(self, zdata):
         """ Factory method for unit tests """
         return zipfile.ZipFile(zdata, 'r')
 
-    def _open_url(self, url):
+    def _open_url(self, url, headers=None):
         """ Factory method for unit tests """
-        return contextlib.closing(urllib.request.urlopen(url))
+        request = urllib.request.Request(url, headers=headers or {})
+        return contextlib.closing(urllib.request.urlopen(request))
 
     def _is_zipfile(self, zdata):
         return zipfile.is_zipfile(zdata)
@@ -0,0 +1,78 @@
+'''
+Persistent cache for the md5 hashes of the published files.
+
+The cache maps the zip member identity (path, CRC32, size), which is known
+from the zip central directory without reading the file data, to the md5
+hash calculated by a previous publish.
+'''
+import sqlite3
+import time
+
+# Logging support
+import logging
+logger = logging.getLogger(__name__)
+
+
+class HashCache(object):
+    """
+    LRU cache (path, crc, size) -> md5, stored in a sqlite database so it is
+    shared by all worker processes and survives restarts.
+    """
+
+    # sqlite limits the number of variables per statement
+    _BATCH_SIZE = 300
+
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self._db = sqlite3.connect(path, timeout=30)
+        self._db.execute("CREATE TABLE IF NOT EXISTS hashes ("
+                         " path TEXT NOT NULL,"
+                         " crc INTEGER NOT NULL,"
+                         " size INTEGER NOT NULL,"
+                         " md5 TEXT NOT NULL,"
+                         " last_used REAL NOT NULL,"
+                         " PRIMARY KEY (path, crc, size))")
+        self._db.execute("CREATE INDEX IF NOT EXISTS hashes_last_used"
+                         " ON hashes (last_used)")
+        self._db.commit()
+
+    def get_many(self, keys):
+        """
+        Returns a dict key -> md5 for all given (path, crc, size) keys found
+        in the cache and marks them as recently used.
+        """
+        result = {}
+        keys = list(keys)
+        for start in range(0, len(keys), self._BATCH_SIZE):
+            batch = keys[start:start + self._BATCH_SIZE]
+            condition = " OR ".join(["(path=? AND crc=? AND size=?)"] * len(batch))
+            params = [value for key in batch for value in key]
+            for path, crc, size, md5 in self._db.execute(
+                    "SELECT path, crc, size, md5 FROM hashes WHERE " + condition, params):
+                result[(path, crc, size)] = md5
+        if result:
+            now = time.time()
+            self._db.executemany("UPDATE hashes SET last_used=?"
+                                 " WHERE path=? AND crc=? AND size=?",
+                                 [(now, ) + key for key in result])
+            self._db.commit()
+        logger.debug("Hash cache hits: %d of %d" % (len(result), len(keys)))
+        return result
+
+    def put_many(self, items):
+        """
+        Stores the given (path, crc, size) -> md5 items and evicts the least
+        recently used entries above max_entries.
+        """
+        now = time.time()
+        self._db.executemany("INSERT OR REPLACE INTO hashes"
+                             " (path, crc, size, md5, last_used) VALUES (?, ?, ?, ?, ?)",
+                             [key + (md5, now) for key, md5 in items.items()])
+        self._db.execute("DELETE FROM hashes WHERE rowid IN ("
+                         " SELECT rowid FROM hashes ORDER BY last_used DESC"
+                         " LIMIT -1 OFFSET ?)", (self.max_entries, ))
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
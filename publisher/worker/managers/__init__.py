@@ -1,12 +1,49 @@
 from . import backends
 from . import manifestbased
 from . import livehosting
+from . import connections
 from django.conf import settings
 
 import logging
 logger = logging.getLogger(__name__)
 
 
+def _get_connections(back_end_params):
+    """
+    Returns the number of parallel connections for the job, limited by the
+    PUBLISHER_MAX_UPLOAD_CONNECTIONS setting
+    """
+    try:
+        connections = int(back_end_params.get('connections', 1))
+    except (TypeError, ValueError):
+        logger.warning("Invalid connections parameter: %s"
+                       % back_end_params.get('connections'))
+        connections = 1
+    return max(1, min(connections, settings.PUBLISHER_MAX_UPLOAD_CONNECTIONS))
+
+
+def _get_verification(back_end_params):
+    """
+    Returns the file size verification of the job, defaults to the
+    PUBLISHER_VERIFICATION setting
+    """
+    verification = back_end_params.get('verification', settings.PUBLISHER_VERIFICATION)
+    if verification not in manifestbased.ManifestUploadManager.VERIFICATIONS:
+        logger.warning("Invalid verification parameter: %s" % verification)
+        verification = settings.PUBLISHER_VERIFICATION
+    return verification
+
+
+def _get_connection_cache():
+    """
+    Returns the connection cache of the worker process, None if the
+    PUBLISHER_CONNECTION_CACHE_SIZE setting disables the connection reuse
+    """
+    return connections.get_connection_cache(settings.PUBLISHER_CONNECTION_CACHE_SIZE,
+                                            settings.PUBLISHER_CONNECTION_IDLE_TIMEOUT,
+                                            settings.PUBLISHER_CONNECTION_MAX_AGE)
+
+
 def init_manager(test_url, back_end_type, back_end_params, state=None):
     if back_end_type == "internal":
         logger.info("Initalising internal back end")
@@ -31,8 +68,15 @@ def init_manager(test_url, back_end_type, back_end_params, state=None):
         }
         manager_back_end = backends.SFTPUploadBackEnd(
             back_end_params['host'], back_end_params['username'], back_end_params['password'],
-            back_end_params['basedir'], back_end_params['port'], permission_map)
-        return manifestbased.ManifestUploadManager(manager_back_end, test_url, state)
+            back_end_params['basedir'], back_end_params['port'], permission_map,
+            settings.PUBLISHER_SFTP_CHUNK_SIZE, settings.PUBLISHER_SFTP_WINDOW_SIZE,
+            _get_connection_cache())
+        return manifestbased.ManifestUploadManager(manager_back_end, test_url, state,
+                                                   _get_connections(back_end_params),
+                                                   settings.PUBLISHER_SCAN_WORKERS,
+                                                   _get_verification(back_end_params),
+                                                   settings.PUBLISHER_VERIFICATION_SAMPLE_SIZE,
+                                                   settings.PUBLISHER_MANIFEST_MAX_DELTAS)
     elif back_end_type == "ftp":
         logger.info("Initalising FTP back end")
         logger.debug("Back end parameters are: %s" % back_end_params)
@@ -41,8 +85,14 @@ def init_manager(test_url, back_end_type, back_end_params, state=None):
                           'c': back_end_params['chmod']['writeable']}
         manager_back_end = backends.BoostedFTPUploadBackEnd(
             back_end_params['host'], back_end_params['username'], back_end_params['password'],
-            back_end_params['basedir'], back_end_params['port'], permission_map)
-        return manifestbased.ManifestUploadManager(manager_back_end, test_url, state)
+            back_end_params['basedir'], back_end_params['port'], permission_map,
+            connection_cache=_get_connection_cache())
+        return manifestbased.ManifestUploadManager(manager_back_end, test_url, state,
+                                                   _get_connections(back_end_params),
+                                                   settings.PUBLISHER_SCAN_WORKERS,
+                                                   _get_verification(back_end_params),
+                                                   settings.PUBLISHER_VERIFICATION_SAMPLE_SIZE,
+                                                   settings.PUBLISHER_MANIFEST_MAX_DELTAS)
     elif back_end_type == "ftps":
         logger.info("Initalising FTPS back end")
         logger.debug("Back end parameters are: %s" % back_end_params)
@@ -51,7 +101,13 @@ def init_manager(test_url, back_end_type, back_end_params, state=None):
                           'c': back_end_params['chmod']['writeable']}
         manager_back_end = backends.BoostedFTPUploadBackEnd(
             back_end_params['host'], back_end_params['username'], back_end_params['password'],
-            back_end_params['basedir'], back_end_params['port'], permission_map, ssl=True)
-        return manifestbased.ManifestUploadManager(manager_back_end, test_url, state)
+            back_end_params['basedir'], back_end_params['port'], permission_map, ssl=True,
+            connection_cache=_get_connection_cache())
+        return manifestbased.ManifestUploadManager(manager_back_end, test_url, state,
+                                                   _get_connections(back_end_params),
+                                                   settings.PUBLISHER_SCAN_WORKERS,
+                                                   _get_verification(back_end_params),
+                                                   settings.PUBLISHER_VERIFICATION_SAMPLE_SIZE,
+                                                   settings.PUBLISHER_MANIFEST_MAX_DELTAS)
     else:
         logger.info("Unknown back_end_type: %s" % back_end_type)
@@ -5,9 +5,12 @@ Created on 14.02.2013
 '''
 from functools import wraps
 import abc
+import queue
+import threading
 
 import re
 import ftplib
+import io
 import os.path
 from io import BytesIO
 
@@ -15,11 +18,35 @@ import paramiko
 import stat
 import contextlib
 
+from .connections import credentials_fingerprint
+
 import logging
 logger = logging.getLogger(__name__)
 
+# Size of the blocks read from the local file while uploading via SFTP
+SFTP_CHUNK_SIZE = 256 * 1024
+
+
+def rewind(fp):
+    """
+    Moves the file back to the start, so a retried upload sends the whole
+    file. Raises an IOError if the file can't be rewound.
+    """
+    try:
+        fp.seek(0)
+    except (AttributeError, io.UnsupportedOperation):
+        raise IOError("Can't rewind %s for the upload" % getattr(fp, 'name', fp))
+
 
 class ConnectionBackEnd(object, metaclass=abc.ABCMeta):
+
+    # Octal modes of the permissions ('r', 'w', 'c'), None when not set
+    permission_map = None
+    # Per process cache of idle connections (connections.ConnectionCache)
+    connection_cache = None
+    # Cache entry of the current connection
+    _connection_entry = None
+
     @staticmethod
     def on_exception_reconnect_and_retry(func):
         """
@@ -35,7 +62,7 @@ class ConnectionBackEnd(object, metaclass=abc.ABCMeta):
                                " reconnecting and retrying the command"
                                % (exp, func))
                 try:
-                    self.quit()
+                    self.abort()
                 except Exception:
                     pass
                 self.connect()
@@ -50,6 +77,149 @@ class ConnectionBackEnd(object, metaclass=abc.ABCMeta):
     def quit(self):
         pass
 
+    def abort(self):
+        """
+        Closes a broken connection, it is never reused
+        """
+        self._connection_entry = None
+        self.quit()
+
+    @abc.abstractmethod
+    def _connection_key(self):
+        """
+        Returns the connection cache key of the back end
+        """
+        pass
+
+    def _checkout_connection(self):
+        """
+        Returns a live connection of the connection cache or None
+        """
+        if self.connection_cache is None:
+            return None
+        entry = self.connection_cache.checkout(self._connection_key(), self._is_alive)
+        if entry is None:
+            return None
+        self._connection_entry = entry
+        return entry.connection
+
+    def _track_connection(self):
+        """
+        Registers a new connection for the connection cache
+        """
+        if self.connection_cache is not None:
+            self._connection_entry = self.connection_cache.create(None, self._close_connection)
+
+    def _release_connection(self, connection):
+        """
+        Hands the connection over to the connection cache. Returns False,
+        when it has to be closed by the caller.
+        """
+        entry = self._connection_entry
+        if self.connection_cache is None or entry is None:
+            return False
+        self._connection_entry = None
+        entry.connection = connection
+        self.connection_cache.checkin(self._connection_key(), entry)
+        return True
+
+    @abc.abstractmethod
+    def clone(self):
+        """
+        Returns a new, not yet connected back end with the same configuration
+        """
+        pass
+
+    def snapshot(self, folder):
+        """
+        Returns all entries (path, type, size) of the folder subtree with a
+        single listing (dir_entries) per folder. Folders are returned before
+        their content.
+        """
+        entries = []
+        pending = [folder]
+        while pending:
+            current = pending.pop()
+            for name, entry_type, size in self.dir_entries(current):
+                path = os.path.join(current, name)
+                entries.append((path, entry_type, size))
+                if entry_type == 'd':
+                    pending.append(path)
+        return entries
+
+
+class ConnectionBackEndPool(object):
+    """
+    Bounded pool of back end connections for parallel operations.
+
+    The pool is seeded with an already connected back end. The additional
+    connections are clones of it and are connected lazily on first use.
+    Clones that can't connect (e.g. because the server limits the number of
+    concurrent logins) are dropped and the work continues on the remaining
+    connections.
+    """
+
+    def __init__(self, back_end, size):
+        self.size = max(1, size)
+        self._back_end = back_end
+        self._lock = threading.Lock()
+        self._connected = set([back_end])
+        self._clones = [back_end.clone() for unused in range(self.size - 1)]
+        self._available = queue.Queue()
+        self._available.put(back_end)
+        for clone in self._clones:
+            self._available.put(clone)
+
+    def acquire(self):
+        """
+        Returns a connected back end. Blocks until one is available.
+        """
+        while True:
+            back_end = self._available.get()
+            with self._lock:
+                connected = back_end in self._connected
+            if connected:
+                return back_end
+            try:
+                back_end.connect()
+            except Exception as exp:
+                logger.warning("Couldn't open an additional connection (%s),"
+                               " continuing with less connections" % exp)
+                continue
+            with self._lock:
+                self._connected.add(back_end)
+            return back_end
+
+    def release(self, back_end):
+        self._available.put(back_end)
+
+    def run(self, func, *args, **kwrds):
+        """
+        Calls func with an acquired back end as first argument
+        """
+        back_end = self.acquire()
+        try:
+            return func(back_end, *args, **kwrds)
+        finally:
+            self.release(back_end)
+
+    def close(self, abort=False):
+        """
+        Closes all additional connections. The seed back end stays connected.
+        With abort the connections are dropped instead of being cached.
+        """
+        with self._lock:
+            clones = [c for c in self._clones if c in self._connected]
+            self._connected.difference_update(clones)
+        for clone in clones:
+            try:
+                if abort:
+                    clone.abort()
+                else:
+                    clone.quit()
+            except Exception:
+                logger.warning("Could not close back end connection")
+
 
 class FTPLineParser(object):
     """ Helper to parses the human readable out put of the FTP DIR command """
@@ -65,7 +235,7 @@ class FTPLineParser(object):
                                   r"([r-][w-][xXsStT-]){3}\s+"
                                   r"\d+\s+"
                                   r"\S+\s+\S+\s+"
-                                  r"\d+\s+"
+                                  r"(?P<size>\d+)\s+"
                                   r"\S+\s+\S+\s+"
                                   r"(\d{2}:\d{2}|\d{4})\s"
                                   r"(?P<name>.+)$")
@@ -84,29 +254,74 @@ class FTPLineParser(object):
 
         Hint: The MS-DOS <DIR> will be mapped to the unix 'd' type.
         """
+        return self.parse_with_size(line)[:2]
+
+    def parse_with_size(self, line):
+        """
+        Same as parse, but also returns the size of the entry (or None when
+        the line doesn't contain a size).
+        """
         unix_result = self._list_regex_unix.match(line)
         if unix_result:
             return (unix_result.group('name'),
-                    unix_result.group('type'))
+                    unix_result.group('type'),
+                    int(unix_result.group('size')))
         msdos_result = self._list_regex_msdos.match(line)
         if msdos_result:
             if msdos_result.group('type') == '<DIR>':
-                return (msdos_result.group('name'), 'd')
+                return (msdos_result.group('name'), 'd', None)
             else:
-                return (msdos_result.group('name'), '-')
+                size = msdos_result.group('type').replace(',', '')
+                return (msdos_result.group('name'), '-',
+                        int(size) if size.isdigit() else None)
         msg = "Unknown FTP DIR line format detected: '%s'" % line
         logger.error(msg)
         raise self.LineFormatError(msg)
 
 
+# Facts of the MLSD listing (RFC 3659) used by the FTP back end
+MLSD_FACTS = ('type', 'size')
+
+
+def parse_feat_response(response):
+    """
+    Returns the features (name -> parameters) of a FEAT response
+    """
+    features = {}
+    for line in response.splitlines()[1:]:
+        if not line.startswith(' '):
+            continue
+        name, _sep, parameters = line.strip().partition(' ')
+        features[name.upper()] = parameters
+    return features
+
+
+def parse_mlsd_entry(name, facts):
+    """
+    Returns the name, type and size of a MLSD entry, like the LIST line
+    parser, or None for the entries of the folder itself and its parent
+    """
+    entry_type = facts.get('type', '').lower()
+    if entry_type in ('cdir', 'pdir'):
+        return None
+    if entry_type == 'dir':
+        return (name, 'd', None)
+    size = facts.get('size')
+    return (name, 'l' if 'link' in entry_type else '-',
+            int(size) if size and size.isdigit() else None)
+
+
 class FTPUploadBackEnd(ConnectionBackEnd):
     """
     FTP Upload Back end for the rukzuk publisher.
+
+    The folders are listed with MLSD when the server supports it (FEAT),
+    otherwise the human readable LIST output is parsed.
     """
 
     def __init__(self,
                  host, username, password, basedir, port=21,
-                 permission_map={}, ssl=False):
+                 permission_map={}, ssl=False, connection_cache=None):
         self.host = host
         self.username = username
         self.password = password
@@ -114,15 +329,40 @@ class FTPUploadBackEnd(ConnectionBackEnd):
         self.port = port if port else 21
         self.permission_map = permission_map
         self.ssl = ssl
-        # FTP or FTPS (with TLS/SSL)
-        if ssl:
-            self._ftp = ftplib.FTP_TLS()
-        else:
-            self._ftp = ftplib.FTP()
+        self.connection_cache = connection_cache
+        self._ftp = self._create_ftp()
         self._ftp_folder = basedir
         self._type_i = True
+        self._mlsd = False
+
+    def _create_ftp(self):
+        # FTP or FTPS (with TLS/SSL)
+        if self.ssl:
+            return ftplib.FTP_TLS()
+        return ftplib.FTP()
+
+    def _connection_key(self):
+        return (self.host, self.port, self.username, self.basedir,
+                credentials_fingerprint(self.ssl, self.password))
+
+    @staticmethod
+    def _is_alive(connection):
+        connection[0].voidcmd("NOOP")
+        return True
+
+    @staticmethod
+    def _close_connection(connection):
+        try:
+            connection[0].quit()
+        finally:
+            connection[0].close()
 
     def connect(self):
+        connection = self._checkout_connection()
+        if connection is not None:
+            self._ftp, self._ftp_folder, self._type_i, self._mlsd = connection
+            self._cwd(self._ftp_folder)
+            return
         logger.info("Connecting %s:%s" % (self.host, self.port))
         self._ftp.connect(self.host, self.port, 15)
         self._ftp.login(self.username, self.password)
@@ -134,7 +374,35 @@ class FTPUploadBackEnd(ConnectionBackEnd):
         self._ftp_folder = os.path.join(pwd, self.basedir)
         logger.debug("Switching to binary mode")
         self._set_binary_mode()
+        self._mlsd = self._detect_mlsd()
         self._cwd(self._ftp_folder)
+        self._track_connection()
+
+    def _detect_mlsd(self):
+        """
+        Checks with FEAT if the server supports MLSD and enables the needed
+        facts
+        """
+        try:
+            features = parse_feat_response(self._ftp.sendcmd("FEAT"))
+        except ftplib.Error:
+            logger.debug("FTP server doesn't support FEAT, using LIST")
+            return False
+        if 'MLST' not in features:
+            logger.debug("FTP server doesn't support MLSD, using LIST")
+            return False
+        facts = dict((fact.rstrip('*').lower(), fact.endswith('*'))
+                     for fact in features['MLST'].split(';') if fact)
+        if not all(fact in facts for fact in MLSD_FACTS):
+            logger.debug("FTP server MLSD facts are incomplete, using LIST")
+            return False
+        if not all(facts[fact] for fact in MLSD_FACTS):
+            try:
+                self._ftp.sendcmd("OPTS MLST %s;" % ";".join(MLSD_FACTS))
+            except ftplib.Error:
+                return False
+        logger.debug("Using MLSD for the folder listings")
+        return True
 
     def exists(self, filepath):
         """
@@ -159,9 +427,37 @@ class FTPUploadBackEnd(ConnectionBackEnd):
         except ftplib.Error:
             # Assuming that a ftp error means folder does not exist.
             return []
+        if self._mlsd:
+            try:
+                return [entry for entry in (parse_mlsd_entry(name, facts)
+                                            for name, facts in self._ftp.mlsd())
+                        if entry is not None]
+            except ftplib.error_perm as exp:
+                logger.warning("MLSD failed (%s), falling back to LIST" % exp)
+                self._mlsd = False
         self._ftp.dir("-a", dir_list.append)
         return list(map(self._parse_list_line, dir_list))
 
+    @ConnectionBackEnd.on_exception_reconnect_and_retry
+    def dir_sizes(self, folder):
+        """
+        Returns the sizes of all files in the directory (name -> size) read
+        from a single directory listing
+        """
+        return dict((os.path.basename(entry[0]), entry[2])
+                    for entry in self._list(folder)
+                    if entry[1] != 'd')
+
+    @ConnectionBackEnd.on_exception_reconnect_and_retry
+    def dir_entries(self, folder):
+        """
+        Returns the name, type and size of all elements in the directory
+        read from a single directory listing
+        """
+        return [(os.path.basename(name), entry_type, size)
+                for name, entry_type, size in self._list(folder)
+                if os.path.basename(name) not in ('.', '..')]
+
     def erase_directory(self, folder):
         """
         Erases the hole content of an directory.
@@ -169,18 +465,15 @@ class FTPUploadBackEnd(ConnectionBackEnd):
         """
         logger.debug("Erasing %s" % folder)
         result = True
-        for entry in self.dir(folder):
-            if self.type(entry) == 'd':
-                result = result and self.erase_directory(entry)
-                try:
-                    self._delete_directory(entry)
-                except:
-                    result = False
-            else:
-                try:
-                    self._delete_file(entry)
-                except:
-                    result = False
+        # The content of a folder is deleted before the folder
+        for path, entry_type, _size in reversed(self.snapshot(folder)):
+            try:
+                if entry_type == 'd':
+                    self._delete_directory(path)
+                else:
+                    self._delete_file(path)
+            except:
+                result = False
         return result
 
     @ConnectionBackEnd.on_exception_reconnect_and_retry
@@ -193,16 +486,16 @@ class FTPUploadBackEnd(ConnectionBackEnd):
         """
         try:
             folder, name = os.path.split(path)
-            for entryname, entrytype in self._list(folder):
-                if entryname == name:
-                    return entrytype
+            for entry in self._list(folder):
+                if entry[0] == name:
+                    return entry[1]
             return None
         except ftplib.Error:
             return None
 
     def _parse_list_line(self, line):
         parser = FTPLineParser()
-        return parser.parse(line)
+        return parser.parse_with_size(line)
 
     @ConnectionBackEnd.on_exception_reconnect_and_retry
     def size(self, filepath):
@@ -229,13 +522,17 @@ class FTPUploadBackEnd(ConnectionBackEnd):
         return buf
 
     @ConnectionBackEnd.on_exception_reconnect_and_retry
-    def upload(self, filepath, fp):
+    def upload(self, filepath, fp, permission=None):
         """
-        Uploads a file to the ftp server
+        Uploads a file to the ftp server and sets the permission, if given
         """
         dirpath, filename = os.path.split(filepath)
+        # A retried upload starts again at the beginning of the file
+        rewind(fp)
         self._cwd(dirpath)
         self._ftp.storbinary("STOR %s" % filename, fp)
+        if permission:
+            self.chmod(filepath, permission)
 
     @ConnectionBackEnd.on_exception_reconnect_and_retry
     def mkdir(self, newdir):
@@ -308,10 +605,21 @@ class FTPUploadBackEnd(ConnectionBackEnd):
 
     def quit(self):
         """
-        Exits the FTP session
+        Exits the FTP session. With a connection cache the session is kept
+        for the next job.
         """
+        connection = (self._ftp, self._ftp_folder, self._type_i, self._mlsd)
+        if self._release_connection(connection):
+            self._ftp = self._create_ftp()
+            return
         self._ftp.quit()
 
+    def clone(self):
+        return self.__class__(self.host, self.username, self.password,
+                              self.basedir, port=self.port,
+                              permission_map=self.permission_map, ssl=self.ssl,
+                              connection_cache=self.connection_cache)
+
     def _cwd(self, directory):
         if directory:
             logger.debug("Switching into ftp directory %s"
@@ -330,53 +638,110 @@ class FTPUploadBackEnd(ConnectionBackEnd):
                 self._type_i = False
 
 
+class DirectoryListCache(object):
+    """
+    FTP directory listings (folder -> entries) shared by a back end and its
+    clones, so a change on one connection of a ConnectionBackEndPool clears
+    the listings of all connections. A listing read while a change is in
+    progress is not stored.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._listings = {}
+        self._generation = 0
+        self._changes = 0
+
+    def get(self, folder, read_listing):
+        """
+        Returns the cached listing of the folder or reads it with read_listing
+        """
+        with self._lock:
+            if folder in self._listings:
+                logger.debug("Ftp directory cache entry found for %s" % folder)
+                return self._listings[folder]
+            generation = self._generation
+        logger.debug("No ftp directory cache entry found for %s" % folder)
+        listing = read_listing(folder)
+        with self._lock:
+            if generation == self._generation and not self._changes:
+                self._listings[folder] = listing
+        return listing
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._listings.clear()
+
+    @contextlib.contextmanager
+    def change(self):
+        """
+        Context of a change on the server, the cache is cleared before and
+        after the change
+        """
+        with self._lock:
+            self._changes += 1
+            self._generation += 1
+            self._listings.clear()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._changes -= 1
+                self._generation += 1
+                self._listings.clear()
+
+
 class CachedFTPUploadBackEnd(FTPUploadBackEnd):
     """
     FTP back end that caches the FTP list call result for a faster task list
-    creation on an initial publishing FTP job.
+    creation on an initial publishing FTP job. Clones share the cache.
     """
 
-    def __init__(self, host, username, password, basedir, port=21, permission_map={}, ssl=False):
+    def __init__(self, host, username, password, basedir, port=21, permission_map={}, ssl=False,
+                 connection_cache=None):
         logger.debug("Init FTP back end with directory list cache")
-        self._list_cache = {}
+        self._list_cache = DirectoryListCache()
         FTPUploadBackEnd.__init__(self, host, username, password, basedir,
-                                  port=port, permission_map=permission_map, ssl=ssl)
+                                  port=port, permission_map=permission_map, ssl=ssl,
+                                  connection_cache=connection_cache)
 
     def connect(self):
         self._invalidate_cache()
         FTPUploadBackEnd.connect(self)
 
+    def clone(self):
+        clone = FTPUploadBackEnd.clone(self)
+        clone._list_cache = self._list_cache
+        return clone
+
     def _list(self, folder):
-        if folder not in self._list_cache:
-            logger.debug("No ftp directory cache entry found for %s" % folder)
-            self._list_cache[folder] = FTPUploadBackEnd._list(self, folder)
-        else:
-            logger.debug("Ftp directory cache entry found for %s" % folder)
-        return self._list_cache[folder]
+        return self._list_cache.get(folder, lambda f: FTPUploadBackEnd._list(self, f))
 
     def _invalidate_cache(self):
         """ Invalidates the internal FTP directory list cache """
         self._list_cache.clear()
 
     def delete_directory(self, directorypath):
-        self._invalidate_cache()
-        return FTPUploadBackEnd.delete_directory(self, directorypath)
+        with self._list_cache.change():
+            return FTPUploadBackEnd.delete_directory(self, directorypath)
 
     def delete_file(self, filepath):
-        self._invalidate_cache()
-        return FTPUploadBackEnd.delete_file(self, filepath)
+        with self._list_cache.change():
+            return FTPUploadBackEnd.delete_file(self, filepath)
 
-    def upload(self, filepath, fp):
-        self._invalidate_cache()
-        FTPUploadBackEnd.upload(self, filepath, fp)
+    def upload(self, filepath, fp, permission=None):
+        with self._list_cache.change():
+            FTPUploadBackEnd.upload(self, filepath, fp, permission)
 
     def mkdir(self, newdir):
-        self._invalidate_cache()
-        FTPUploadBackEnd.mkdir(self, newdir)
+        with self._list_cache.change():
+            FTPUploadBackEnd.mkdir(self, newdir)
 
     def erase_directory(self, folder):
-        self._invalidate_cache()
-        return FTPUploadBackEnd.erase_directory(self, folder)
+        # The listings of the erased folders are outdated afterwards
+        with self._list_cache.change():
+            return FTPUploadBackEnd.erase_directory(self, folder)
 
 
 class BoostedFTPUploadBackEnd(CachedFTPUploadBackEnd):
@@ -404,29 +769,86 @@ class BoostedFTPUploadBackEnd(CachedFTPUploadBackEnd):
 
 
 class SFTPUploadBackEnd(ConnectionBackEnd):
+    """
+    SFTP back end. Files are uploaded in chunks of chunk_size bytes with
+    pipelined writes, the window_size (bytes) of the SSH channel limits the
+    data in flight. Without a window_size the paramiko default is used.
+    """
 
     def __init__(self, host, username, password, basedir, port=22,
-                 permission_map={}):
+                 permission_map={}, chunk_size=SFTP_CHUNK_SIZE, window_size=None,
+                 connection_cache=None):
         self.host = host
         self.username = username
         self.password = password
         self.basedir = basedir
         self.port = port if port else 22
         self.permission_map = permission_map
+        self.chunk_size = chunk_size
+        self.window_size = window_size
+        self.connection_cache = connection_cache
         self._sftp_folder = basedir
         self._sftp = None
         self._transport = None
 
-    def connect(self):
-        transport = paramiko.Transport((self.host, self.port))
+    def _connection_key(self):
+        return (self.host, self.port, self.username, self.basedir,
+                credentials_fingerprint(self.window_size, self.password))
+
+    @staticmethod
+    def _is_alive(connection):
+        transport, sftp = connection
+        if not transport.is_active():
+            return False
+        sftp.stat('.')
+        return True
+
+    @staticmethod
+    def _close_connection(connection):
+        transport, sftp = connection
+        try:
+            sftp.close()
+        finally:
+            transport.close()
+
+    def _create_transport(self):
+        if self.window_size:
+            return paramiko.Transport((self.host, self.port),
+                                      default_window_size=self.window_size)
+        return paramiko.Transport((self.host, self.port))
+
+    def _login(self, transport):
         transport.connect(username=self.username, password=self.password)
+
+    def connect(self):
+        connection = self._checkout_connection()
+        if connection is not None:
+            self._transport, self._sftp = connection
+            return
+        transport = self._create_transport()
+        self._login(transport)
         self._sftp = paramiko.SFTPClient.from_transport(transport)
         self._transport = transport
+        self._track_connection()
 
     def quit(self):
+        """
+        Closes the SFTP session. With a connection cache the session is kept
+        for the next job.
+        """
+        if self._release_connection((self._transport, self._sftp)):
+            self._transport, self._sftp = None, None
+            return
         self._sftp.close()
         self._transport.close()
 
+    def clone(self):
+        return self.__class__(self.host, self.username, self.password,
+                              self.basedir, port=self.port,
+                              permission_map=self.permission_map,
+                              chunk_size=self.chunk_size, window_size=self.window_size,
+                              connection_cache=self.connection_cache)
+
     def _path(self, path):
         if path.startswith(self._sftp_folder):
             return path
@@ -445,6 +867,38 @@ class SFTPUploadBackEnd(ConnectionBackEnd):
         return [os.path.join(folder, entry)
                 for entry in self._sftp.listdir(self._path(folder))]
 
+    @ConnectionBackEnd.on_exception_reconnect_and_retry
+    def dir_sizes(self, folder):
+        """
+        Returns the sizes of all files in the directory (name -> size) read
+        from a single directory listing
+        """
+        try:
+            entries = self._sftp.listdir_attr(self._path(folder))
+        except IOError:
+            return {}
+        return dict((entry.filename, entry.st_size) for entry in entries
+                    if not stat.S_ISDIR(entry.st_mode))
+
+    @ConnectionBackEnd.on_exception_reconnect_and_retry
+    def dir_entries(self, folder):
+        """
+        Returns the name, type and size of all elements in the directory
+        read from a single directory listing. Symbolic links are not
+        followed.
+        """
+        try:
+            entries = self._sftp.listdir_attr(self._path(folder))
+        except IOError:
+            return []
+        return [(entry.filename, self._entry_type(entry.st_mode), entry.st_size)
+                for entry in entries]
+
+    def _entry_type(self, mode):
+        if stat.S_ISDIR(mode):
+            return 'd'
+        return 'l' if stat.S_ISLNK(mode) else '-'
+
     @ConnectionBackEnd.on_exception_reconnect_and_retry
     def type(self, path):
         path = self._path(path)
@@ -463,11 +917,57 @@ class SFTPUploadBackEnd(ConnectionBackEnd):
         return buf
 
     @ConnectionBackEnd.on_exception_reconnect_and_retry
-    def upload(self, filepath, fp):
+    def upload(self, filepath, fp, permission=None):
+        """
+        Streams the file to the server. The writes are pipelined and
+        paramiko drops the server answers of pipelined writes, so a failed
+        write isn't raised. Like SFTPClient.putfo the upload is confirmed
+        with a stat of the closed file: a wrong size raises an IOError and a
+        wrong mode (the pipelined FSETSTAT failed) is set again.
+        """
         path = self._path(filepath)
         logger.debug("Uploading %s" % path)
-        with contextlib.closing(self._sftp.open(path, 'wb')) as remote_file:
-            remote_file.write(fp.read())
+        # A retried upload starts again at the beginning of the file
+        rewind(fp)
+        chmod = self.permission_map.get(permission, None)
+        mode = int(chmod, 8) if chmod else None
+        sent = 0
+        with contextlib.closing(self._sftp.open(path, 'wb', self.chunk_size)) as remote_file:
+            remote_file.set_pipelined(True)
+            while True:
+                chunk = fp.read(self.chunk_size)
+                if not chunk:
+                    break
+                remote_file.write(chunk)
+                sent += len(chunk)
+            if mode is not None:
+                remote_file.flush()
+                self._set_mode(remote_file, mode)
+        attr = self._sftp.stat(path)
+        if attr.st_size != sent:
+            raise IOError("Size mismatch after the upload of %s: %s != %s"
+                          % (path, attr.st_size, sent))
+        if mode is not None and stat.S_IMODE(attr.st_mode) != mode:
+            logger.debug("Setting the mode of %s again" % path)
+            self._sftp.chmod(path, mode)
+
+    def _set_mode(self, remote_file, mode):
+        """
+        Sends the FSETSTAT of the open file without waiting for the answer.
+        paramiko has no public API for it (SFTPFile.chmod waits for the round
+        trip), so the private SFTPClient._async_request is used, like the
+        pipelined writes of SFTPFile do. The answer isn't checked, the mode
+        is confirmed by the stat after the upload. Without it (other
+        paramiko versions than the one in requirements.txt) the mode is set
+        with a round trip.
+        """
+        if not hasattr(self._sftp, '_async_request'):
+            remote_file.chmod(mode)
+            return
+        attr = paramiko.SFTPAttributes()
+        attr.st_mode = mode
+        self._sftp._async_request(remote_file, paramiko.sftp.CMD_FSETSTAT,
+                                  remote_file.handle, attr)
 
     @ConnectionBackEnd.on_exception_reconnect_and_retry
     def mkdir(self, newdir):
@@ -495,18 +995,15 @@ class SFTPUploadBackEnd(ConnectionBackEnd):
         """
         logger.debug("Erasing %s" % folder)
         result = True
-        for entry_path in self.dir(folder):
-            if self.type(entry_path) == 'd':
-                result = result and self.erase_directory(entry_path)
-                try:
-                    self.delete_directory(entry_path)
-                except:
-                    result = False
-            else:
-                try:
-                    self.delete_file(entry_path)
-                except:
-                    result = False
+        # The content of a folder is deleted before the folder
+        for path, entry_type, _size in reversed(self.snapshot(folder)):
+            try:
+                if entry_type == 'd':
+                    self._sftp.rmdir(self._path(path))
+                else:
+                    self._sftp.remove(self._path(path))
+            except IOError:
+                result = False
         return result
 
 
@@ -515,22 +1012,35 @@ class PKeySFTPUploadBackEnd(SFTPUploadBackEnd):
     SFTP back end with private key auth support
     """
 
-    def __init__(self, host, username, pkey_file, basedir, port=22, permission_map={}):
+    def __init__(self, host, username, pkey_file, basedir, port=22, permission_map={},
+                 chunk_size=SFTP_CHUNK_SIZE, window_size=None, connection_cache=None):
         self.host = host
         self.username = username
+        self.pkey_file = pkey_file
         self.pkey = paramiko.RSAKey.from_private_key_file(pkey_file)
         self.basedir = basedir
         self.port = port if port else 22
         self.permission_map = permission_map
+        self.chunk_size = chunk_size
+        self.window_size = window_size
+        self.connection_cache = connection_cache
         self._sftp_folder = basedir
         self._sftp = None
         self._transport = None
 
-    def connect(self):
-        transport = paramiko.Transport((self.host, self.port))
+    def _connection_key(self):
+        return (self.host, self.port, self.username, self.basedir,
+                credentials_fingerprint(self.window_size, self.pkey.get_fingerprint()))
+
+    def _login(self, transport):
         transport.connect(username=self.username, pkey=self.pkey)
-        self._sftp = paramiko.SFTPClient.from_transport(transport)
-        self._transport = transport
+
+    def clone(self):
+        return self.__class__(self.host, self.username, self.pkey_file,
+                              self.basedir, port=self.port,
+                              permission_map=self.permission_map,
+                              chunk_size=self.chunk_size, window_size=self.window_size,
+                              connection_cache=self.connection_cache)
 
 
 class LiveHostingSFTPBackEnd(PKeySFTPUploadBackEnd):
@@ -6,8 +6,14 @@ logger = logging.getLogger(__name__)
 
 class PublishManager(object, metaclass=abc.ABCMeta):
     @abc.abstractmethod
-    def start(self, working_dir, recovery=None, writeable_list=[], cache_list=[]):
+    def start(self, working_dir, recovery=None, writeable_list=[], cache_list=[],
+              checksums=None, archive=None, checkpoint=None):
         """
         Starts the synchronisation. This method uploads the local working directory on the
-        configured server
+        configured server. The optional checksums (path -> [size, md5, crc]) were calculated
+        while collecting and can be used instead of reading the files again.
+        Managers that support it read the files from the optional archive
+        (publisher.worker.archive.ZipArchive) instead of the working directory.
+        Without recovery parameters they resume from the optional checkpoint
+        (publisher.worker.checkpoint.RecoveryCheckpoint) of a killed job.
         """
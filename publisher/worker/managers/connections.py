@@ -0,0 +1,155 @@
+'''
+Per worker process cache of idle back end connections.
+
+Publish and delete jobs for the same server reuse the logged in connection of
+a previous job instead of doing a new TCP connect, TLS handshake or SSH key
+exchange and login.
+'''
+import hashlib
+import threading
+import time
+
+# Logging support
+import logging
+logger = logging.getLogger(__name__)
+
+
+def credentials_fingerprint(*credentials):
+    """
+    Returns a hash of the credentials for the cache keys, so a connection is
+    only reused by jobs that could log in themselves
+    """
+    digest = hashlib.sha256()
+    for credential in credentials:
+        digest.update(repr(credential).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class CachedConnection(object):
+    """
+    A back end connection (e.g. the ftplib.FTP object) with the function to
+    close it and the time it was opened
+    """
+    __slots__ = ('connection', 'close', 'created', 'released')
+
+    def __init__(self, connection, close, created):
+        self.connection = connection
+        self.close = close
+        self.created = created
+        self.released = created
+
+
+class ConnectionCache(object):
+    """
+    Idle connections by key (e.g. host, port, user, basedir and credentials).
+    Connections are closed when they are idle for more than idle_timeout
+    seconds or older than max_age seconds. At most max_size connections are
+    kept.
+    """
+
+    def __init__(self, max_size, idle_timeout=60, max_age=300, clock=time.time):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.max_age = max_age
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._idle = {}
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(entries) for entries in self._idle.values())
+
+    def create(self, connection, close):
+        """
+        Returns the cache entry of a new connection
+        """
+        return CachedConnection(connection, close, self._clock())
+
+    def checkout(self, key, is_alive):
+        """
+        Returns the most recently used idle connection of the key that passes
+        the liveness check (is_alive(connection)) or None
+        """
+        while True:
+            with self._lock:
+                expired = self._expire()
+                entries = self._idle.get(key)
+                entry = entries.pop() if entries else None
+            self._close_all(expired)
+            if entry is None:
+                return None
+            try:
+                alive = is_alive(entry.connection)
+            except Exception:
+                alive = False
+            if alive:
+                logger.debug("Reusing connection %s" % (key[:2], ))
+                return entry
+            logger.debug("Dropping dead connection %s" % (key[:2], ))
+            self._close_all([entry])
+
+    def checkin(self, key, entry):
+        """
+        Keeps the connection for the next job or closes it, when it is too
+        old or the cache is full
+        """
+        now = self._clock()
+        entry.released = now
+        with self._lock:
+            expired = self._expire()
+            size = sum(len(entries) for entries in self._idle.values())
+            if now - entry.created < self.max_age and size < self.max_size:
+                self._idle.setdefault(key, []).append(entry)
+            else:
+                expired.append(entry)
+        self._close_all(expired)
+
+    def clear(self):
+        with self._lock:
+            expired = [entry for entries in self._idle.values() for entry in entries]
+            self._idle.clear()
+        self._close_all(expired)
+
+    def _expire(self):
+        """
+        Removes the expired connections and returns them (lock held)
+        """
+        now = self._clock()
+        expired = []
+        for key in list(self._idle):
+            entries = self._idle[key]
+            kept = [entry for entry in entries
+                    if now - entry.released < self.idle_timeout and
+                    now - entry.created < self.max_age]
+            if len(kept) != len(entries):
+                expired.extend(entry for entry in entries if entry not in kept)
+            if kept:
+                self._idle[key] = kept
+            else:
+                del self._idle[key]
+        return expired
+
+    def _close_all(self, entries):
+        for entry in entries:
+            try:
+                entry.close(entry.connection)
+            except Exception:
+                logger.debug("Could not close cached connection")
+
+
+_connection_cache = None
+_connection_cache_lock = threading.Lock()
+
+
+def get_connection_cache(max_size, idle_timeout, max_age):
+    """
+    Returns the connection cache of the worker process or None, when the
+    max_size is 0
+    """
+    global _connection_cache
+    if not max_size:
+        return None
+    with _connection_cache_lock:
+        if _connection_cache is None:
+            _connection_cache = ConnectionCache(max_size, idle_timeout, max_age)
+        return _connection_cache
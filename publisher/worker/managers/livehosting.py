@@ -97,7 +97,8 @@ class LiveHostingManager(base.PublishManager):
     def _get_rsync_helper(self):
         return self._rsync_helper
 
-    def start(self, working_dir, recovery=None, writeable_list=[], cache_list=[]):
+    def start(self, working_dir, recovery=None, writeable_list=[], cache_list=[],
+              checksums=None, archive=None, checkpoint=None):
         """
         Starts the synchronization
         """
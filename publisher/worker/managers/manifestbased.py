@@ -1,5 +1,8 @@
 import json
 import pickle
+import gzip
+import io
+import itertools
 import time
 
 import hashlib
@@ -11,12 +14,16 @@ import random
 import abc
 
 from . import base
+from .backends import ConnectionBackEndPool
+from .scheduler import Operation, TaskGraph, run_task_graph
 from ..exceptions import NoRetryException, RetryException
 
 from io import BytesIO
 
 from functools import total_ordering
 
+from concurrent.futures import ThreadPoolExecutor
+
 # Logging support
 import logging
 logger = logging.getLogger(__name__)
@@ -57,19 +64,28 @@ def random_string():
     return ''.join(random.choice(string.ascii_lowercase + string.digits) for unused in range(10))
 
 
+# Read buffer size for the checksum calculation
+MD5_CHUNK_SIZE = 1024 * 1024
+
+
 def md5sum(filepointer):
     """
     Calculates the md5 hash for the given file (pointer)
     """
     md5 = hashlib.md5()
     with open(filepointer, 'rb') as f:
-        data = f.read(md5.block_size)  # IGNORE:E1101
-        while data:
+        for data in iter(lambda: f.read(MD5_CHUNK_SIZE), b''):
             md5.update(data)  # IGNORE:E1101
-            data = f.read(128)
     return md5.hexdigest()
 
 
+def scan_file(path):
+    """
+    Returns the size and the md5 hash of the given file
+    """
+    return os.path.getsize(path), md5sum(path)
+
+
 def filter_unfinished_tasks(tasklist):
     return [task for task in tasklist if not task.done]
 
@@ -78,6 +94,93 @@ def filter_finished_tasks(tasklist):
     return [task for task in tasklist if task.done]
 
 
+def tree_folder(path):
+    """
+    Returns the folder of a file list path for the tree hashes, the root
+    folder is ''
+    """
+    return os.path.dirname(os.path.normpath(path))
+
+
+class FolderIndex(object):
+    """
+    Index of folder paths, that checks in O(path depth) if a path is one of
+    the folders or inside of one of them
+    """
+
+    def __init__(self, folders):
+        self._folders = set(os.path.normpath(folder) for folder in folders)
+
+    def covers(self, path):
+        path = os.path.normpath(path)
+        while path not in ('', '.', os.sep):
+            if path in self._folders:
+                return True
+            path = os.path.dirname(path)
+        return False
+
+
+# Version of the compressed manifest format. Version 1 is the plain JSON
+# manifest of older publisher versions.
+MANIFEST_VERSION = 2
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+def write_manifest(fp, records, header=None):
+    """
+    Writes a compressed manifest (version 2) to the given binary file: a
+    gzip stream with a JSON header line followed by one JSON line per
+    record. The records are written one by one, the manifest is never held
+    in memory as a whole.
+
+    Besides the FILE and DIR entries, full manifests contain ('TREE',
+    folder, hash) records and manifest deltas contain ('DELETE', path)
+    records.
+    """
+    header = dict(header or {}, version=MANIFEST_VERSION)
+    # Closing the text wrapper finishes the gzip stream, fp stays open
+    gzip_file = gzip.GzipFile(fileobj=fp, mode='wb')
+    with io.TextIOWrapper(gzip_file, encoding='utf-8') as text_file:
+        text_file.write(json.dumps(header) + '\n')
+        for record in records:
+            text_file.write(json.dumps(record) + '\n')
+
+
+def parse_manifest(fp):
+    """
+    Reads a compressed manifest line by line or a legacy JSON manifest.
+    Returns a dict with the 'files', 'folders', 'deleted' and 'trees' entry
+    lists and the manifest 'header'.
+    """
+    if fp.read(2) != GZIP_MAGIC:
+        fp.seek(0)
+        logger.debug("Reading legacy JSON manifest")
+        manifest = json.load(fp)
+        manifest.setdefault('deleted', [])
+        manifest.setdefault('trees', [])
+        manifest['header'] = {'version': 1}
+        return manifest
+    fp.seek(0)
+    manifest = {'files': [], 'folders': [], 'deleted': [], 'trees': []}
+    with gzip.GzipFile(fileobj=fp, mode='rb') as gzip_file:
+        lines = io.TextIOWrapper(gzip_file, encoding='utf-8')
+        manifest['header'] = json.loads(next(lines, '{}'))
+        version = manifest['header'].get('version')
+        if version != MANIFEST_VERSION:
+            raise NoRetryException("Unsupported manifest version: %s" % version)
+        for line in lines:
+            record = json.loads(line)
+            if record[0] == 'DIR':
+                manifest['folders'].append(record)
+            elif record[0] == 'DELETE':
+                manifest['deleted'].append(record)
+            elif record[0] == 'TREE':
+                manifest['trees'].append(record)
+            else:
+                manifest['files'].append(record)
+    return manifest
+
+
 def object_handler(Obj):
     if hasattr(Obj, 'tojson'):
         return Obj.tojson()
@@ -86,8 +189,29 @@ def object_handler(Obj):
                         ' is not JSON serializable' % (type(Obj), repr(Obj)))
 
 
+class SlotsStateMixin(object):
+    """
+    Pickle support for classes with __slots__. The state is a dict, so the
+    state of entries pickled before they had __slots__ (e.g. the recovery
+    task list of a retried job) can still be restored.
+    """
+    __slots__ = ()
+
+    def __getstate__(self):
+        return dict((name, getattr(self, name))
+                    for cls in type(self).__mro__
+                    for name in getattr(cls, '__slots__', ())
+                    if hasattr(self, name))
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+
 @total_ordering
-class TaskListEntry(object):
+class TaskListEntry(SlotsStateMixin):
+    # Entries exist for every file and folder, so they have no __dict__
+    __slots__ = ('task', 'done')
 
     def __init__(self, task):
         self.task = task
@@ -111,13 +235,28 @@ class TaskList(object):
     Calculates what steps have to be done to synchronize the two lists
     """
 
-    def __init__(self, local_list, remote_list, changed_callback):
+    # Task lists counted by their number of tasks in the progress
+    PROGRESS_CATEGORIES = ('delete_files', 'delete_folders', 'create_folders',
+                           'change_permissions')
+
+    def __init__(self, local_list, remote_list, changed_callback, dirty_paths=(),
+                 permission_map=None):
+        """
+        The changed_callback is only called for files outside of the
+        subtrees with equal tree hashes. Folders containing one of the
+        dirty_paths are always compared file by file. The permission_map
+        (permission -> octal mode) of the job is compared with the one of
+        the remote list to find the updated files that keep their mode and
+        the existing entries that need a chmod.
+        """
         logger.info("Creating task list")
         changed_files = self._get_changed_files(local_list, remote_list,
-                                                changed_callback)
+                                                changed_callback, dirty_paths)
+        mode_changed = self._get_mode_test(remote_list, permission_map)
         chmod_files = self._get_chmod_only_files(local_list, remote_list,
-                                                 changed_files)
-        chmod_folders = self._get_chmod_only_folders(local_list, remote_list)
+                                                 changed_files, mode_changed)
+        chmod_folders = self._get_chmod_only_folders(local_list, remote_list,
+                                                     mode_changed)
 
         self.delete_folders = self._get_delete_folders(local_list, remote_list)
         self.delete_files = self._get_delete_files(local_list, remote_list)
@@ -126,6 +265,8 @@ class TaskList(object):
         self.update_files = changed_files
         self.change_permissions = chmod_folders + chmod_files
         self.erase_folders = self._get_erase_folders(local_list, remote_list)
+        self.keep_permissions = self._get_kept_permissions(remote_list, dirty_paths,
+                                                           mode_changed)
         logger.debug("Erase folders in tasklist: %s" % self.erase_folders)
         logger.debug("Delete folders in tasklist: %s" % self.delete_folders)
         logger.debug("Delete files in tasklist: %s" % self.delete_files)
@@ -134,6 +275,91 @@ class TaskList(object):
         logger.debug("New files in tasklist: %s" % self.new_files)
         logger.debug("Change permissions in tasklist: %s" % self.change_permissions)
         logger.info("Task list created")
+        self._init_progress()
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # Task lists pickled by older versions have no progress counters
+        if '_done_tasks' not in state:
+            self._init_progress()
+        if 'keep_permissions' not in state:
+            self.keep_permissions = set()
+
+    def _init_progress(self):
+        """
+        Calculates the progress counters from the task lists. Afterwards
+        the counters are updated by mark_done and mark_uploaded.
+        """
+        self._total_tasks = {}
+        self._done_tasks = {}
+        for category in self.PROGRESS_CATEGORIES:
+            entries = getattr(self, category)
+            self._total_tasks[category] = len(entries)
+            self._done_tasks[category] = len(filter_finished_tasks(entries))
+        uploads = self.new_files + self.update_files
+        self._total_tasks['upload'] = len(uploads)
+        self._done_tasks['upload'] = len(filter_finished_tasks(uploads))
+        self._total_bytes = sum(entry.task.size for entry in uploads)
+        self._done_bytes = sum(entry.task.size for entry in filter_finished_tasks(uploads))
+
+    def mark_done(self, category, entry):
+        """
+        Marks an entry of the given task list (one of PROGRESS_CATEGORIES)
+        as done
+        """
+        if not entry.done:
+            entry.done = True
+            self._done_tasks[category] += 1
+
+    def mark_uploaded(self, entry):
+        """
+        Marks an entry of new_files or update_files as done
+        """
+        if not entry.done:
+            entry.done = True
+            self._done_tasks['upload'] += 1
+            self._done_bytes += entry.task.size
+
+    def restore_done(self, records):
+        """
+        Marks the tasks of the (category, path, old) records as done, e.g.
+        the records of a recovery checkpoint. The category of the uploads is
+        upload_files.
+        """
+        categories = self.PROGRESS_CATEGORIES + ('erase_folders', )
+        entries = dict(((category, entry.task.path), entry) for category in categories
+                       for entry in getattr(self, category))
+        for entry in self.new_files + self.update_files:
+            entries[('upload_files', entry.task.path)] = entry
+        for category, path, old in records:
+            entry = entries.get((category, path))
+            if entry is None:
+                logger.warning("Unknown %s task %s" % (category, path))
+                continue
+            entry.done = True
+            entry.task.old = entry.task.old or old
+        self._init_progress()
+
+    def get_upload_permission(self, entry):
+        """
+        Returns the permission the uploaded file of the new_files or
+        update_files entry needs or None if the server file keeps its
+        permission
+        """
+        if entry.task.path in self.keep_permissions:
+            return None
+        return entry.task.permission
+
+    def get_progress(self, task_weight):
+        """
+        Returns the progress (0.0 - 1.0). Uploads are weighted by their
+        size, all other tasks by task_weight.
+        """
+        done = sum(self._done_tasks[c] for c in self.PROGRESS_CATEGORIES) * task_weight
+        total = sum(self._total_tasks[c] for c in self.PROGRESS_CATEGORIES) * task_weight
+        done += self._done_bytes
+        total += self._total_bytes
+        return float(done) / float(total) if total else 0.0
 
     def _get_delete_folders(self, local_list, remote_list):
         local_folders = set(local_list.get_folders())
@@ -159,11 +385,19 @@ class TaskList(object):
         return list(TaskListEntry(local_list.get_file(x))
                     for x in local_files - remote_files)
 
-    def _get_changed_files(self, local_list, remote_list, changed_callback):
+    def _get_changed_files(self, local_list, remote_list, changed_callback,
+                           dirty_paths=()):
         local_files = set(local_list.get_files())
         remote_files = set(remote_list.get_files())
+        unchanged = self._get_unchanged_folders(local_list, remote_list, dirty_paths)
+        if '' in unchanged:
+            logger.debug("Local and remote file list are equal")
+            return []
+        unchanged = FolderIndex(unchanged)
 
         def test_changed(filepath):
+            if unchanged.covers(tree_folder(filepath)):
+                return False
             return changed_callback(local_list.get_file(filepath),
                                     remote_list.get_file(filepath))
         changed_files = set(filepath
@@ -172,35 +406,98 @@ class TaskList(object):
         return list(TaskListEntry(local_list.get_file(x))
                     for x in changed_files)
 
-    def _get_chmod_only_folders(self, local_list, remote_list):
+    def _get_mode_test(self, remote_list, permission_map):
+        """
+        Returns a function, that tells if the octal mode of a local entry
+        differs from the one of its remote entry. Every mode differs when
+        one of the permission maps is unknown.
+        """
+        old_permission_map = remote_list.permission_map
+        if permission_map is None or old_permission_map is None:
+            return lambda local_entry, remote_entry: True
+
+        def mode_changed(local_entry, remote_entry):
+            old_mode = old_permission_map.get(remote_entry.permission)
+            return old_mode is None or old_mode != permission_map.get(local_entry.permission)
+        return mode_changed
+
+    def _get_kept_permissions(self, remote_list, dirty_paths, mode_changed):
+        """
+        Returns the paths of the updated files with an unchanged octal mode.
+        Overwriting a file keeps its mode on the server. Files of an erased
+        folder and dirty paths (e.g. missing on the server) are uploaded as
+        new files.
+        """
+        erased = FolderIndex(task.task.path for task in self.erase_folders)
+        dirty_paths = set(dirty_paths)
+
+        def mode_kept(entry):
+            return not mode_changed(entry, remote_list.get_file(entry.path))
+        return set(task.task.path for task in self.update_files
+                   if task.task.path not in dirty_paths and not erased.covers(task.task.path) and
+                   mode_kept(task.task))
+
+    def _get_unchanged_folders(self, local_list, remote_list, dirty_paths):
+        """
+        Returns the folders with equal local and remote tree hashes, that
+        don't contain a dirty path
+        """
+        local_hashes = local_list.get_tree_hashes()
+        remote_hashes = remote_list.get_tree_hashes()
+        dirty_folders = set()
+        for path in dirty_paths:
+            folder = tree_folder(path)
+            while folder not in dirty_folders:
+                dirty_folders.add(folder)
+                if not folder:
+                    break
+                folder = os.path.dirname(folder)
+        unchanged = set(folder for folder, tree_hash in local_hashes.items()
+                        if remote_hashes.get(folder) == tree_hash and
+                        folder not in dirty_folders)
+        logger.debug("%d of %d folders are unchanged" % (len(unchanged), len(local_hashes)))
+        return unchanged
+
+    def _get_chmod_only_folders(self, local_list, remote_list, mode_changed):
+        """
+        Returns the existing folders with a changed octal mode
+        """
         local_folders = set(local_list.get_folders())
         remote_folders = set(remote_list.get_folders())
         return list(TaskListEntry(local_list.get_folder(x))
-                    for x in local_folders & remote_folders)
+                    for x in local_folders & remote_folders
+                    if mode_changed(local_list.get_folder(x), remote_list.get_folder(x)))
 
     def _get_erase_folders(self, local_list, remote_list):
-        chmod_folders = self._get_chmod_only_folders(local_list, remote_list)
+        local_folders = set(local_list.get_folders())
+        remote_folders = set(remote_list.get_folders())
         delete_folders = self._get_delete_folders(local_list, remote_list)
 
-        def _get_old_permissions(folder):
-            return remote_list.get_folder(folder.task.path).permission
-        erase_folders = [folder for folder in chmod_folders
-                         if _get_old_permissions(folder) == 'c']
+        erase_folders = [TaskListEntry(local_list.get_folder(x))
+                         for x in local_folders & remote_folders
+                         if remote_list.get_folder(x).permission == 'c']
         erase_folders += [folder for folder in delete_folders
                           if folder.task.permission in ('w', 'c')]
         return erase_folders
 
-    def _get_chmod_only_files(self, local_list, remote_list, changed_files):
+    def _get_chmod_only_files(self, local_list, remote_list, changed_files, mode_changed):
+        """
+        Returns the unchanged files with a changed octal mode. The updated
+        files get their mode with the upload.
+        """
         local_files = set(local_list.get_files())
         remote_files = set(remote_list.get_files())
         chmod_only_files = local_files & remote_files
         changed = set(filetask.task.path for filetask in changed_files)
         return list(TaskListEntry(local_list.get_file(x))
-                    for x in chmod_only_files - changed)
+                    for x in chmod_only_files - changed
+                    if mode_changed(local_list.get_file(x), remote_list.get_file(x)))
 
 
 @total_ordering
-class FileListEntry(object, metaclass=abc.ABCMeta):
+class FileListEntry(SlotsStateMixin, metaclass=abc.ABCMeta):
+    __slots__ = ('path', 'permission', 'old')
+
     def __init__(self, path, permission):
         self.path = path
         self.permission = permission
@@ -224,18 +521,32 @@ class FileListEntry(object, metaclass=abc.ABCMeta):
 
 
 class FileListFileEntry(FileListEntry):
+    __slots__ = ('size', 'checksum', 'crc')
 
-    def __init__(self, path, permission, size, checksum):
+    def __init__(self, path, permission, size, checksum, crc=None):
         super(FileListFileEntry, self).__init__(path, permission)
         self.size = size
         self.checksum = checksum
+        self.crc = crc
 
     def tojson(self):
         return ('FILE', self.path, self.permission, self.size, self.checksum,
-                self.old)
+                self.old, self.crc)
+
+    @classmethod
+    def fromjson(cls, entry):
+        # Manifests of older versions don't contain the CRC
+        crc = entry[6] if len(entry) > 6 else None
+        return cls(entry[1], entry[2], entry[3], entry[4], crc)
+
+    def __setstate__(self, state):
+        # Entries pickled by older versions have no CRC
+        self.crc = None
+        super(FileListFileEntry, self).__setstate__(state)
 
 
 class FileListFolderEntry(FileListEntry):
+    __slots__ = ()
 
     def tojson(self):
         return ('DIR', self.path, self.permission, self.old)
@@ -246,52 +557,218 @@ class FileList(object):
     def __init__(self, files=[], folders=[]):
         self._files = dict((f.path, f) for f in files)
         self._folders = dict((f.path, f) for f in folders)
-
-    def scan_local_folder(self, working_dir, type_mapper=None):
+        # Octal modes of the permissions (permission -> mode) the files were
+        # published with, None when unknown
+        self.permission_map = None
+        # Aggregate hashes of the folders (see get_tree_hashes), None or
+        # incomplete when they have to be calculated
+        self._tree_hashes = None
+
+    def scan_local_folder(self, working_dir, type_mapper=None, workers=1,
+                          checksums=None):
+        """
+        Reads the file list from the given local folder. With more than one
+        worker the files are hashed in parallel by a thread pool (hashlib
+        releases the GIL while hashing), the result order stays the same.
+        Files with an entry in checksums (path -> [size, md5, crc]) are not
+        read at all.
+        """
         logger.debug("Detecting local files from: %s" % working_dir)
 
-        file_list = []
+        file_entries = []
         folder_list = []
         if not type_mapper:
             type_mapper = lambda _path: 'r'
+        if not checksums:
+            checksums = {}
+        start_time = time.time()
         for base_dir, _unused_dirs, files in os.walk(working_dir):
             folder = os.path.relpath(base_dir, working_dir)
             if folder != '.':
                 permission = type_mapper(folder)
                 folder_list.append(FileListFolderEntry(folder, permission))
             for filename in files:
-                path = os.path.join(base_dir, filename)
-                permission = type_mapper(os.path.join(folder, filename))
-                file_list.append(FileListFileEntry(os.path.join(folder,
-                                                                filename),
-                                                   permission,
-                                                   os.path.getsize(path),
-                                                   md5sum(path)))
+                filepath = os.path.join(folder, filename)
+                file_entries.append((filepath, type_mapper(filepath),
+                                     os.path.join(base_dir, filename)))
+        local_paths = [entry[2] for entry in file_entries
+                       if os.path.normpath(entry[0]) not in checksums]
+        if workers > 1 and len(local_paths) > 1:
+            logger.debug("Hashing files with %d workers" % workers)
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                scan_results = list(executor.map(scan_file, local_paths))
+        else:
+            scan_results = [scan_file(path) for path in local_paths]
+        self._log_scan_throughput(len(file_entries), scan_results, time.time() - start_time)
+        scan_results = iter(scan_results)
+        file_list = []
+        for filepath, permission, _path in file_entries:
+            known = checksums.get(os.path.normpath(filepath))
+            if known:
+                crc = known[2] if len(known) > 2 else None
+                file_list.append(FileListFileEntry(filepath, permission, known[0], known[1], crc))
+            else:
+                size, checksum = next(scan_results)
+                file_list.append(FileListFileEntry(filepath, permission, size, checksum))
         self._files = dict((f.path, f) for f in file_list)
         self._folders = dict((f.path, f) for f in folder_list)
+        self._tree_hashes = None
 
-    def read_json_manifest(self, manifest, recovery_manifest=None):
-        list_dict = json.load(manifest)
+    def _log_scan_throughput(self, file_count, scan_results, duration):
+        """
+        Logs the hashing throughput. Files known from the checksums are not
+        read, so only the sizes of the hashed files (scan_results) count.
+        """
+        hashed_size = sum(size for size, _checksum in scan_results)
+        throughput = hashed_size / duration / 1024 / 1024 if duration else 0.0
+        logger.info("Hashed %d of %d files (%d bytes) in %.2fs (%.1f MB/s), %d known from the"
+                    " checksums" % (len(scan_results), file_count, hashed_size, duration,
+                                    throughput, file_count - len(scan_results)))
+
+    def read_manifest_file(self, manifest, recovery_manifest=None):
+        """
+        Reads the file list from the given manifest file(s), compressed or
+        legacy JSON
+        """
+        list_dict = parse_manifest(manifest)
         if recovery_manifest:
-            tmp_manifest = json.load(recovery_manifest)
+            tmp_manifest = parse_manifest(recovery_manifest)
             self.read_manifest(list_dict, tmp_manifest)
         else:
             self.read_manifest(list_dict)
 
     def read_manifest(self, manifest, recovery_manifest=None):
-        file_list = dict((e[1], FileListFileEntry(e[1], e[2], e[3], e[4]))
-                         for e in manifest['files'])
-        folder_list = dict((e[1], FileListFolderEntry(e[1], e[2]))
-                           for e in manifest['folders'])
+        self._files = dict((e[1], FileListFileEntry.fromjson(e))
+                           for e in manifest['files'])
+        self._folders = dict((e[1], FileListFolderEntry(e[1], e[2]))
+                             for e in manifest['folders'])
+        self._tree_hashes = dict((e[1], e[2]) for e in manifest.get('trees', [])) or None
         if recovery_manifest:
-            tmp_files = dict((e[1], FileListFileEntry(e[1], e[2], e[3], e[4]))
-                             for e in recovery_manifest['files'])
-            tmp_folders = dict((e[1], FileListFolderEntry(e[1], e[2]))
-                               for e in recovery_manifest['folders'])
-            file_list = dict(list(tmp_files.items()) + list(file_list.items()))
-            folder_list = dict(list(tmp_folders.items()) + list(folder_list.items()))
-        self._files = file_list
-        self._folders = folder_list
+            self.merge_manifest(recovery_manifest)
+
+    def merge_manifest(self, recovery_manifest):
+        """
+        Adds the entries of the (recovery) manifest that are not in this
+        file list yet
+        """
+        for e in recovery_manifest['files']:
+            if e[1] not in self._files:
+                self._files[e[1]] = FileListFileEntry.fromjson(e)
+                self._invalidate_tree_hashes(e[1])
+        for e in recovery_manifest['folders']:
+            if e[1] not in self._folders:
+                self._folders[e[1]] = FileListFolderEntry(e[1], e[2])
+                self._invalidate_tree_hashes(e[1])
+
+    def apply_delta(self, delta):
+        """
+        Applies a manifest delta (see generate_delta) to this file list
+        """
+        for e in delta['deleted']:
+            self._files.pop(e[1], None)
+            self._folders.pop(e[1], None)
+            self._invalidate_tree_hashes(e[1])
+        for e in delta['files']:
+            self._files[e[1]] = FileListFileEntry.fromjson(e)
+            self._invalidate_tree_hashes(e[1])
+        for e in delta['folders']:
+            self._folders[e[1]] = FileListFolderEntry(e[1], e[2])
+            self._invalidate_tree_hashes(e[1])
+
+    def get_tree_hashes(self):
+        """
+        Returns the aggregate (Merkle) hash of every folder (folder -> md5,
+        the root folder is ''). The hash of a folder covers all file and
+        folder entries below it, so equal hashes mean equal subtrees.
+        Valid hashes read from the manifest are reused.
+        """
+        if self._tree_hashes is not None and '' in self._tree_hashes:
+            return self._tree_hashes
+        known = self._tree_hashes or {}
+        records = {'': []}
+        subfolders = {'': []}
+
+        def add_folder(folder):
+            while folder not in records:
+                records[folder] = []
+                subfolders[folder] = []
+                parent = os.path.dirname(folder)
+                add_folder(parent)
+                subfolders[parent].append(folder)
+
+        for path, entry in self._files.items():
+            folder = tree_folder(path)
+            add_folder(folder)
+            records[folder].append(('FILE', os.path.basename(os.path.normpath(path)),
+                                    entry.permission, entry.size, entry.checksum, entry.crc))
+        for path in self._folders:
+            add_folder(os.path.normpath(path))
+        hashes = {}
+        # Child folders before their parents
+        for folder in sorted(records, key=lambda f: f.count('/') + bool(f), reverse=True):
+            if folder in known:
+                hashes[folder] = known[folder]
+                continue
+            folder_records = records[folder]
+            for subfolder in subfolders[folder]:
+                entry = self._folders.get(subfolder)
+                folder_records.append(('DIR', os.path.basename(subfolder),
+                                       entry.permission if entry else None, hashes[subfolder]))
+            folder_records.sort()
+            hashes[folder] = hashlib.md5(json.dumps(folder_records).encode('utf-8')).hexdigest()
+        self._tree_hashes = hashes
+        return hashes
+
+    def _invalidate_tree_hashes(self, path):
+        """
+        Removes the hashes of the folder of the given path and its parents
+        """
+        if not self._tree_hashes:
+            return
+        folder = os.path.normpath(path)
+        while True:
+            self._tree_hashes.pop(folder, None)
+            if not folder or folder == '.':
+                break
+            folder = os.path.dirname(folder)
+
+    def get_manifest_entries(self):
+        """
+        Returns the manifest entries of this file list (path -> entry tuple)
+        """
+        entries = dict((path, f.tojson()) for path, f in self._files.items())
+        entries.update((path, f.tojson()) for path, f in self._folders.items())
+        return entries
+
+    def generate_delta(self, stored_entries, old_folders=[], old_files=[]):
+        """
+        Returns the manifest records that turn the stored manifest entries
+        (see get_manifest_entries) into this file list
+        """
+        records = []
+        paths = set()
+        for entry in itertools.chain(self._files.values(), old_files,
+                                     self._folders.values(), old_folders):
+            paths.add(entry.path)
+            record = entry.tojson()
+            if stored_entries.get(entry.path) != record:
+                records.append(record)
+        records.extend(('DELETE', path) for path in stored_entries if path not in paths)
+        return records
+
+    def write_manifest_file(self, fp, old_folders=[], old_files=[], header=None):
+        """
+        Writes the file list as compressed manifest to fp. The tree hashes
+        are only written when there are no old entries.
+        """
+        entries = itertools.chain(self._files.values(), old_files,
+                                  self._folders.values(), old_folders)
+        records = (entry.tojson() for entry in entries)
+        if not old_folders and not old_files:
+            trees = (('TREE', folder, tree_hash)
+                     for folder, tree_hash in self.get_tree_hashes().items())
+            records = itertools.chain(records, trees)
+        write_manifest(fp, records, header)
 
     def generate_manifest(self, old_folders=[], old_files=[]):
         files = list(self._files.values()) + old_files
@@ -312,21 +789,58 @@ class FileList(object):
 
     def remove_invalids(self, validation_callback):
         logger.info("Checking remote files")
-        self._files = dict((p, f) for p, f in list(self._files.items())
-                           if validation_callback(p))
-        self._folders = dict((p, f) for p, f in list(self._folders.items())
-                             if validation_callback(p))
+        invalids = []
+        for entries in (self._files, self._folders):
+            for path in list(entries):
+                if not validation_callback(path):
+                    del entries[path]
+                    invalids.append(path)
+        for path in invalids:
+            self._invalidate_tree_hashes(path)
 
 
 class ManifestUploadManager(base.PublishManager):
 
     MANIFEST_FOLDER_PREFIX = ".publisher"
+    MANIFEST_DELTA_PREFIX = ".manifest.delta."
+
+    # Verification of the server file sizes of unchanged files
+    VERIFY_NONE = 'none'
+    VERIFY_SAMPLED = 'sampled'
+    VERIFY_FULL = 'full'
+    VERIFICATIONS = (VERIFY_NONE, VERIFY_SAMPLED, VERIFY_FULL)
 
-    def __init__(self, back_end, test_url=None, state_callback=None):
+    def __init__(self, back_end, test_url=None, state_callback=None,
+                 connections=1, scan_workers=1, verification=VERIFY_FULL,
+                 verification_sample_size=100, max_manifest_deltas=0):
         # TODO: implement test url
         self._test_url = test_url
         self._back_end = back_end
         self._state_callback = state_callback
+        # Max. number of parallel back end connections used for uploads
+        self._connections = connections
+        # Number of threads used to hash the local files
+        self._scan_workers = scan_workers
+        # Optional zip archive with the local files
+        self._archive = None
+        self._checkpoint = None
+        # Which unchanged files are checked against the server file size
+        self._verification = verification
+        self._verification_sample_size = verification_sample_size
+        # Server sizes of the verified files (path -> size)
+        self._remote_sizes = {}
+        # Number of manifest deltas before the manifest is compacted,
+        # 0 always uploads the full manifest
+        self._max_manifest_deltas = max_manifest_deltas
+        # Manifest entries stored on the server (path -> entry tuple), None
+        # when unknown. The deltas are calculated against these entries.
+        self._stored_entries = None
+        # Permission map (octal modes) of the stored manifest
+        self._stored_permissions = None
+        # Sequence number of the last manifest delta and the number of
+        # deltas since the last full manifest
+        self._delta_sequence = 0
+        self._delta_count = 0
 
         # Lazy attributes
         self._manifest_folder = None
@@ -349,6 +863,9 @@ class ManifestUploadManager(base.PublishManager):
             self._manifest_tmp = self.get_manifest_folder() + "/.manifest.new"
         return self._manifest_tmp
 
+    def _manifest_delta(self, sequence):
+        return "%s/%s%d" % (self.get_manifest_folder(), self.MANIFEST_DELTA_PREFIX, sequence)
+
     def get_manifest_folder(self):
         if not self._manifest_folder:
             folders = [x for x in map(os.path.basename, self._back_end.dir('.')) if x.startswith(self.MANIFEST_FOLDER_PREFIX)]
@@ -369,34 +886,8 @@ class ManifestUploadManager(base.PublishManager):
         if not self._start_time:
             self._start_time = time.time()
 
-        delete_files = tasklist.delete_files
-        delete_folders = tasklist.delete_folders
-        create_folders = tasklist.create_folders
-        change_permissions = tasklist.change_permissions
-        upload_files = tasklist.new_files + tasklist.update_files
-
-        dividend = len(filter_finished_tasks(delete_files))
-        dividend += len(filter_finished_tasks(delete_folders))
-        dividend += len(filter_finished_tasks(create_folders))
-        dividend += len(filter_finished_tasks(change_permissions))
-
-        divisor = len(delete_files)
-        divisor += len(delete_folders)
-        divisor += len(create_folders)
-        divisor += len(change_permissions)
-
         weight = 4096
-        dividend *= weight
-        divisor *= weight
-
-        mb_done = sum(upfile.task.size for upfile in
-                      filter_finished_tasks(upload_files))
-        mb_overall = sum(upfile.task.size for upfile in upload_files)
-
-        dividend += mb_done
-        divisor += mb_overall
-
-        percent = float(dividend) / float(divisor) if divisor else 0.0
+        percent = tasklist.get_progress(weight)
         speed = percent / (time.time() - self._start_time)
         remaining = (1.0 - percent)
         if speed and percent > 0.05:
@@ -415,9 +906,13 @@ class ManifestUploadManager(base.PublishManager):
         # TODO: Upload test file
         self._back_end.quit()
 
-    def start(self, working_dir, recovery=None, writeable_list=[], cache_list=[]):
+    def start(self, working_dir, recovery=None, writeable_list=[], cache_list=[],
+              checksums=None, archive=None, checkpoint=None):
         """
-        Starts the synchronization
+        Starts the synchronization. With an archive the local files are read
+        from the zip archive instead of the working directory. Without
+        recovery parameters the job resumes from the checkpoint
+        (publisher.worker.checkpoint.RecoveryCheckpoint), if there is one.
         """
         def type_mapper(path):
             if path in cache_list:
@@ -429,36 +924,51 @@ class ManifestUploadManager(base.PublishManager):
             else:
                 return 'r'
         self._update_state("PREPARING TASKLIST")
-        local_list = self._get_local_list(working_dir, type_mapper)
+        self._archive = archive
+        if archive is not None:
+            local_list = archive.get_file_list(type_mapper)
+        else:
+            local_list = self._get_local_list(working_dir, type_mapper, checksums)
 
         # Connect to server and create task list
         tasklist = None
+        failed = True
         self._back_end.connect()
         try:
             if recovery:
                 tasklist = pickle.loads(recovery)
                 # TODO: Compare local_list with manifest
+            elif checkpoint is not None:
+                tasklist = checkpoint.load()
+                if tasklist:
+                    logger.info("Resuming from the checkpoint")
             if not tasklist:
                 tasklist = self._create_new_task_list(local_list)
             self._validate_task_list(tasklist)
+            if checkpoint is not None:
+                checkpoint.start(tasklist)
+                self._checkpoint = checkpoint
             # Starting the real synchronization
             logger.info("Starting synchronization")
             self._create_manifest_folder()
-            self._upload_temp_manifest(local_list.generate_manifest())
+            self._upload_temp_manifest(local_list)
 
             not_cleaned_folders = self._erase_folders(tasklist)
             if not_cleaned_folders:
                 self._validate_task_list(tasklist, not_cleaned_folders)
 
-            old_files = self._delete_files(tasklist)
-            old_folders = self._delete_folders(tasklist)
-            self._create_folders(tasklist)
-            self._upload_files(tasklist, working_dir)
-            self._chmod_only(tasklist)
+            if self._connections > 1:
+                old_files, old_folders = self._synchronize_parallel(tasklist, working_dir)
+            else:
+                old_files = self._delete_files(tasklist)
+                old_folders = self._delete_folders(tasklist)
+                self._create_folders(tasklist)
+                self._upload_files(tasklist, working_dir)
+                self._chmod_only(tasklist)
 
-            new_manifest = local_list.generate_manifest(old_folders, old_files)
-            self._upload_new_manifest(new_manifest)
+            self._upload_new_manifest(local_list, old_folders, old_files)
             logger.info("Server synchronized")
+            failed = False
         except NoRetryException:
             # NoRetryExceptions are thrown as is
             raise
@@ -468,29 +978,53 @@ class ManifestUploadManager(base.PublishManager):
             logger.exception("An Exception occurred")
             raise RetryException(str(e), pickle.dumps(tasklist))
         finally:
-            try:
+            if checkpoint is not None:
+                checkpoint.close()
+                self._checkpoint = None
+            self._close_back_end(failed)
+
+    def _close_back_end(self, failed):
+        """
+        Closes the back end connection. The connection of a failed job can be
+        broken (e.g. an unread reply), so it is dropped instead of being kept
+        for the next job.
+        """
+        try:
+            if failed:
+                self._back_end.abort()
+            else:
                 self._back_end.quit()
-            except:
-                # Ignore that problem here
-                pass
+        except:
+            # Ignore that problem here
+            pass
 
     def delete_all(self):
         """ Removes all files from the given back end/server """
+        failed = True
         self._back_end.connect()
-        tasklist = self._create_new_task_list(FileList())
-        self._validate_task_list(tasklist)
-        logger.info("Removing files from %s" % self._back_end)
-        self._delete_files(tasklist)
-        logger.info("Removing folders from %s" % self._back_end)
-        self._delete_folders(tasklist)
+        try:
+            tasklist = self._create_new_task_list(FileList())
+            self._validate_task_list(tasklist)
+            logger.info("Removing files from %s" % self._back_end)
+            self._delete_files(tasklist)
+            logger.info("Removing folders from %s" % self._back_end)
+            self._delete_folders(tasklist)
+            failed = False
+        finally:
+            self._close_back_end(failed)
 
     def _create_new_task_list(self, local_list):
         # Collecting meta informations
         remote_list = self._get_remote_list()
-        logger.debug(remote_list.generate_manifest())
         remote_list.remove_invalids(self._back_end.exists)
-        logger.debug(remote_list.generate_manifest())
-        tasklist = TaskList(local_list, remote_list, self._changed)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(remote_list.generate_manifest())
+        self._remote_sizes = self._get_remote_sizes(local_list, remote_list)
+        # Files with a wrong server size are compared even in unchanged folders
+        dirty_paths = [path for path, size in self._remote_sizes.items()
+                       if size != remote_list.get_file(path).size]
+        tasklist = TaskList(local_list, remote_list, self._changed, dirty_paths,
+                            self._back_end.permission_map)
         return tasklist
 
     def _validate_task_list(self, tasklist, not_erased_folders=[]):
@@ -498,15 +1032,19 @@ class ManifestUploadManager(base.PublishManager):
         Verifying that there are no file conflicts
         """
         logger.debug("Checking for any file conflicts")
-        new_files = set(task.task.path for task in tasklist.new_files)
+        # Finished tasks of a recovered task list exist on the server
+        new_files = set(task.task.path for task in filter_unfinished_tasks(tasklist.new_files))
         delete_files = set(task.task.path for task in tasklist.delete_files)
-        new_folders = set(task.task.path for task in tasklist.create_folders)
+        new_folders = set(task.task.path
+                          for task in filter_unfinished_tasks(tasklist.create_folders))
         delete_folders = set(task.task.path for task in tasklist.delete_folders)
         erase_folders = set(task.task.path for task in tasklist.erase_folders)
         erase_folders -= set(not_erased_folders)
         logger.debug("Full erase folders are: %s" % erase_folders)
+        # Built once, the new files and folders are checked against it
+        erased = FolderIndex(erase_folders)
         invalid_new_folders = self._validate_new(new_folders - delete_files,
-                                                 erase_folders)
+                                                 erased)
 
         logger.debug("Checking that the folder for deletion can be deleted")
         #
@@ -514,37 +1052,93 @@ class ManifestUploadManager(base.PublishManager):
         #
         invalid_delete_folders = self._validate_delete_folders(delete_folders,
                                                                delete_files,
-                                                               erase_folders)
+                                                               erased)
         if invalid_delete_folders:
             logger.warn("Some folders are not empty: %s"
                         % invalid_delete_folders)
         invalid_new_files = self._validate_new(new_files - delete_folders,
-                                               erase_folders)
+                                               erased)
         invalid_files = invalid_new_files + invalid_new_folders
         if invalid_files:
             logger.warn("Some file conflicts detected: %s" % invalid_files)
             raise AlreadyExistsException(invalid_files)
         return invalid_delete_folders
 
-    def _upload_temp_manifest(self, manifest):
+    def _upload_temp_manifest(self, file_list):
+        """
+        Uploads the recovery manifest. When the stored manifest is known,
+        it only contains the new entries, because the recovery only adds
+        the entries that are not in the stored manifest.
+        """
         logger.debug("Uploading recovery manifest file")
         new_manifest = BytesIO()
-        new_manifest.write(manifest.encode("utf-8"))
+        if self._stored_entries is None:
+            file_list.write_manifest_file(new_manifest)
+        else:
+            stored = self._stored_entries
+            write_manifest(new_manifest, [record for record in file_list.generate_delta(stored)
+                                          if record[0] != 'DELETE' and record[1] not in stored])
         new_manifest.seek(0)
         self._back_end.upload(self.manifest_tmp, new_manifest)
 
-    def _upload_new_manifest(self, manifest):
+    def _upload_new_manifest(self, file_list, old_folders=[], old_files=[]):
+        """
+        Uploads the given file list as a new manifest delta or, when the
+        stored manifest is unknown or has too many deltas, as the new
+        manifest file. It also removes the temporary manifest file.
+        """
+        if (self._stored_entries is not None and
+                self._delta_count < self._max_manifest_deltas):
+            self._upload_manifest_delta(file_list, old_folders, old_files)
+        else:
+            self._upload_full_manifest(file_list, old_folders, old_files)
+        logger.debug("Deleting recovery manifest file")
+        self._back_end.delete_file(self.manifest_tmp)
+
+    def _upload_manifest_delta(self, file_list, old_folders, old_files):
+        records = file_list.generate_delta(self._stored_entries, old_folders, old_files)
+        if not records and self._back_end.permission_map == self._stored_permissions:
+            logger.debug("Manifest is unchanged")
+            return
+        sequence = self._delta_sequence + 1
+        logger.debug("Uploading manifest delta %d with %d entries" % (sequence, len(records)))
+        delta = BytesIO()
+        write_manifest(delta, records, self._manifest_header(delta=sequence))
+        delta.seek(0)
+        self._back_end.upload(self._manifest_delta(sequence), delta)
+        self._delta_sequence = sequence
+        self._delta_count += 1
+        self._stored_entries = None
+        self._stored_permissions = self._back_end.permission_map
+
+    def _manifest_header(self, **header):
+        """
+        Returns the manifest header with the octal modes of the permissions
+        (permission_map), so the next job knows the modes of the files
+        """
+        header['permissions'] = self._back_end.permission_map
+        return header
+
+    def _upload_full_manifest(self, file_list, old_folders, old_files):
         """
-        Uploads the given file list as the new manifest file.
-        It also removes the temporary manifest file.
+        Uploads the complete manifest and removes the manifest deltas. The
+        manifest contains the sequence number of the last included delta,
+        so deltas left over by an interrupted clean up are ignored.
         """
         logger.debug("Uploading new manifest file")
+        sequences = self._list_manifest_deltas()
+        self._delta_sequence = max(sequences + [self._delta_sequence])
         new_manifest = BytesIO()
-        new_manifest.write(manifest.encode("utf-8"))
+        file_list.write_manifest_file(new_manifest, old_folders, old_files,
+                                      self._manifest_header(journal=self._delta_sequence))
         new_manifest.seek(0)
         self._back_end.upload(self.manifest, new_manifest)
-        logger.debug("Deleting recovery manifest file")
-        self._back_end.delete_file(self.manifest_tmp)
+        for sequence in sequences:
+            logger.debug("Deleting manifest delta %d" % sequence)
+            self._back_end.delete_file(self._manifest_delta(sequence))
+        self._delta_count = 0
+        self._stored_entries = None
+        self._stored_permissions = self._back_end.permission_map
 
     def _upload_files(self, tasklist, working_dir):
         self._update_state("UPLOAD_FILES", tasklist)
@@ -552,37 +1146,139 @@ class ManifestUploadManager(base.PublishManager):
                                         tasklist.update_files)
         logger.info("Uploading %d files" % len(files))
         for task in files:
-            upload_file, permission = task.task.path, task.task.permission
-            local_path = os.path.abspath(os.path.join(working_dir,
-                                                      upload_file))
-            local_path = os.path.realpath(local_path)
-            # TODO (sw): figure out how this should work?!
-            #if os.path.relpath(local_path, working_dir).startswith('..'):
-            #    msg = "File (%s) is not in the current working directory" % local_path
-            #    logger.warning(msg)
-            #    raise SecurityException(msg)
-            logger.debug("Uploading file: %s" % local_path)
-            with open(local_path, 'rb') as fp:
-                self._back_end.upload(upload_file, fp)
-                self._back_end.chmod(upload_file, permission)
+            self._upload_file(self._back_end, task, working_dir,
+                              tasklist.get_upload_permission(task))
 
-            task.done = True
+            self._mark_done(tasklist, 'upload_files', task)
             self._update_state("UPLOAD_FILES", tasklist)
 
+    def _synchronize_parallel(self, tasklist, working_dir):
+        """
+        Runs the delete, create, upload and chmod tasks as a dependency graph
+        on a pool of back end connections. Folders are created before their
+        content and emptied before they are deleted, everything else runs
+        concurrently. The tasks are only marked as done by this (the calling)
+        thread, so the task list stays consistent for the recovery.
+        The kinds of the running tasks interleave, so a single SYNCHRONIZING
+        state is reported. Returns the not deleted files and folders.
+        """
+        self._update_state("SYNCHRONIZING", tasklist)
+        graph = self._build_task_graph(tasklist)
+        workers = min(self._connections, len(graph))
+        if workers:
+            logger.info("Running %d tasks with %d connections" % (len(graph), workers))
+            pool = ConnectionBackEndPool(self._back_end, workers)
+            try:
+                run_task_graph(graph, pool.size,
+                               lambda op: pool.run(self._run_operation, op, tasklist,
+                                                   working_dir),
+                               lambda op: self._operation_completed(tasklist, op))
+            except BaseException:
+                pool.close(abort=True)
+                raise
+            pool.close()
+        return ([task.task for task in tasklist.delete_files if task.task.old],
+                [task.task for task in tasklist.delete_folders if task.task.old])
+
+    def _build_task_graph(self, tasklist):
+        """
+        Builds the dependency graph of the unfinished tasks. The operation
+        kinds are the task list categories.
+        """
+        def operations(kind, tasks):
+            return dict((os.path.normpath(task.task.path), Operation(kind, task))
+                        for task in filter_unfinished_tasks(tasks))
+        delete_files = operations('delete_files', tasklist.delete_files)
+        delete_folders = operations('delete_folders', tasklist.delete_folders)
+        create_folders = operations('create_folders', tasklist.create_folders)
+        uploads = operations('upload_files', tasklist.new_files + tasklist.update_files)
+        chmods = operations('change_permissions', tasklist.change_permissions)
+
+        # Content of the deleted folders (child before parent folder)
+        deleted_content = {}
+        for path, operation in itertools.chain(delete_files.items(), delete_folders.items()):
+            deleted_content.setdefault(tree_folder(path), []).append(operation)
+
+        graph = TaskGraph()
+        # Folder creations first, they unblock the uploads
+        for path in sorted(create_folders):
+            graph.add(create_folders[path], [create_folders.get(tree_folder(path)),
+                                             delete_files.get(path)])
+        for path in sorted(delete_files):
+            graph.add(delete_files[path])
+        for path in sorted(delete_folders):
+            graph.add(delete_folders[path], deleted_content.get(path, []))
+        # Large files first, so the connections finish at the same time
+        for path in sorted(uploads, key=lambda p: -(uploads[p].task.task.size or 0)):
+            graph.add(uploads[path], [create_folders.get(tree_folder(path)),
+                                      delete_folders.get(path)])
+        for path in sorted(chmods):
+            graph.add(chmods[path])
+        return graph
+
+    def _run_operation(self, back_end, operation, tasklist, working_dir):
+        kind, entry = operation.kind, operation.task.task
+        if kind == 'upload_files':
+            self._upload_file(back_end, operation.task, working_dir,
+                              tasklist.get_upload_permission(operation.task))
+        elif kind == 'create_folders':
+            self._create_folder(back_end, entry)
+        elif kind == 'delete_files':
+            self._delete_file(back_end, entry)
+        elif kind == 'delete_folders':
+            self._delete_folder(back_end, entry)
+        else:
+            self._chmod(back_end, entry)
+
+    def _operation_completed(self, tasklist, operation):
+        self._mark_done(tasklist, operation.kind, operation.task)
+        self._update_state("SYNCHRONIZING", tasklist)
+
+    def _mark_done(self, tasklist, category, task):
+        """
+        Marks the task of the given task list category as done and adds it
+        to the recovery checkpoint
+        """
+        if category == 'upload_files':
+            tasklist.mark_uploaded(task)
+        elif category == 'erase_folders':
+            task.done = True
+        else:
+            tasklist.mark_done(category, task)
+        if self._checkpoint is not None:
+            self._checkpoint.record(category, task.task)
+
+    def _upload_file(self, back_end, task, working_dir, permission):
+        """
+        Uploads the file of the task. The back end sets the permission as
+        part of the upload, None keeps the permission of the server file.
+        """
+        upload_file = task.task.path
+        with self._open_local_file(working_dir, upload_file) as fp:
+            back_end.upload(upload_file, fp, permission)
+
+    def _open_local_file(self, working_dir, path):
+        if self._archive is not None:
+            logger.debug("Uploading file from archive: %s" % path)
+            return self._archive.open(path)
+        local_path = os.path.abspath(os.path.join(working_dir, path))
+        local_path = os.path.realpath(local_path)
+        # TODO (sw): figure out how this should work?!
+        #if os.path.relpath(local_path, working_dir).startswith('..'):
+        #    msg = "File (%s) is not in the current working directory" % local_path
+        #    logger.warning(msg)
+        #    raise SecurityException(msg)
+        logger.debug("Uploading file: %s" % local_path)
+        return open(local_path, 'rb')
+
     def _chmod_only(self, tasklist):
         self._update_state("CHANGE_PERMISSIONS", tasklist)
         chmod_only = filter_unfinished_tasks(tasklist.change_permissions)
         logger.info("Updating permissions of %d existing folders" % len(chmod_only))
         for task in chmod_only:
-            path, permission = task.task.path, task.task.permission
-            logger.debug("Updating permissions of %s" % path)
-            if not self._back_end.exists(path):
-                # This only happens when someone deletes stuff in our rukzuk
-                # folder after we finished our preparing
-                raise DoesNotExistException(path)
-            self._back_end.chmod(path, permission)
+            self._chmod(self._back_end, task.task)
 
-            task.done = True
+            self._mark_done(tasklist, 'change_permissions', task)
             self._update_state("CHANGE_PERMISSIONS", tasklist)
 
     def _create_folders(self, tasklist):
@@ -590,17 +1286,9 @@ class ManifestUploadManager(base.PublishManager):
         new_folders = filter_unfinished_tasks(tasklist.create_folders)
         logger.info("Creating %d new folders" % len(new_folders))
         for task in sorted(new_folders, key=lambda x: x.task):
-            folder = task.task
-            logger.debug("Creating folder %s/" % folder)
-            if self._back_end.exists(folder.path):
-                # This only happens when someone uploads stuff into the rukzuk
-                # folder after we started our upload and finished
-                # our preparing.
-                raise AlreadyExistsException([folder])
-            self._back_end.mkdir(folder.path)
-            self._back_end.chmod(folder.path, folder.permission)
+            self._create_folder(self._back_end, task.task)
 
-            task.done = True
+            self._mark_done(tasklist, 'create_folders', task)
             self._update_state("CREATE_FOLDERS", tasklist)
 
     def _erase_folders(self, tasklist):
@@ -614,7 +1302,7 @@ class ManifestUploadManager(base.PublishManager):
             if not self._back_end.erase_directory(folder.path):
                 logger.warn("Couldn't clean up %s" % folder.path)
                 not_clean_folders.append(folder.path)
-            task.done = True
+            self._mark_done(tasklist, 'erase_folders', task)
             self._update_state("ERASE_FOLDERS", tasklist)
         return set(not_clean_folders)
 
@@ -630,19 +1318,9 @@ class ManifestUploadManager(base.PublishManager):
         # Bring the list into the right order for deletion
         # (Child folder before parent folder)
         for task in sorted(delete_folders, reverse=True):
-            folder = task.task
-            logger.debug("Deleting %s" % folder)
-            # Check that the folder is empty
-            if self._back_end.dir(folder.path):
-                # This only happens when someone uploads stuff into the rukzuk
-                # folder after we started our upload and finished
-                # our preparing or the erasing failed.
-                folder.old = True
-            # Delete the folder
-            if not self._back_end.delete_directory(folder.path):
-                folder.old = True
+            self._delete_folder(self._back_end, task.task)
             # Mark task as done
-            task.done = True
+            self._mark_done(tasklist, 'delete_folders', task)
             self._update_state("DELETE_FOLDERS", tasklist)
         return [task.task for task in tasklist.delete_folders if task.task.old]
 
@@ -651,21 +1329,57 @@ class ManifestUploadManager(base.PublishManager):
         delete_files = filter_unfinished_tasks(tasklist.delete_files)
         logger.info("Deleting %d old files" % len(delete_files))
         for task in delete_files:
-            old_file = task.task
-            logger.debug("Deleting %s" % old_file)
-            if not self._back_end.delete_file(old_file.path):
-                old_file.old = True
+            self._delete_file(self._back_end, task.task)
 
-            task.done = True
+            self._mark_done(tasklist, 'delete_files', task)
             self._update_state("DELETE_FILES", tasklist)
         return [task.task for task in tasklist.delete_files if task.task.old]
 
-    def _validate_delete_folders(self, delete_folders, delete_files,
-                                 erase_folders):
+    def _chmod(self, back_end, entry):
+        logger.debug("Updating permissions of %s" % entry.path)
+        if not back_end.exists(entry.path):
+            # This only happens when someone deletes stuff in our rukzuk
+            # folder after we finished our preparing
+            raise DoesNotExistException(entry.path)
+        back_end.chmod(entry.path, entry.permission)
+
+    def _create_folder(self, back_end, folder):
+        logger.debug("Creating folder %s/" % folder)
+        if back_end.exists(folder.path):
+            # This only happens when someone uploads stuff into the rukzuk
+            # folder after we started our upload and finished
+            # our preparing.
+            raise AlreadyExistsException([folder])
+        back_end.mkdir(folder.path)
+        back_end.chmod(folder.path, folder.permission)
+
+    def _delete_folder(self, back_end, folder):
+        logger.debug("Deleting %s" % folder)
+        # Check that the folder is empty
+        if back_end.dir(folder.path):
+            # This only happens when someone uploads stuff into the rukzuk
+            # folder after we started our upload and finished
+            # our preparing or the erasing failed.
+            folder.old = True
+        # Delete the folder
+        if not back_end.delete_directory(folder.path):
+            folder.old = True
+
+    def _delete_file(self, back_end, old_file):
+        logger.debug("Deleting %s" % old_file)
+        if not back_end.delete_file(old_file.path):
+            old_file.old = True
+
+    def _validate_delete_folders(self, delete_folders, delete_files, erased):
+        """
+        Removes the folders that won't be empty from delete_folders and
+        returns them. Folders inside of an erased folder (FolderIndex) are
+        empty after the erasing and are not listed.
+        """
         non_empty_folders = []
         sorted_delete_folders = sorted(delete_folders, reverse=True)
         for delete_folder in sorted_delete_folders:
-            if delete_folder not in erase_folders:
+            if not erased.covers(delete_folder):
                 folder_content = self._back_end.dir(delete_folder)
                 # Add the folder to the non_empty_folders list,
                 # when its content will not removed in this transaction.
@@ -677,15 +1391,15 @@ class ManifestUploadManager(base.PublishManager):
                     delete_folders.remove(delete_folder)
         return non_empty_folders
 
-    def _validate_new(self, new_filepaths, erase_folders):
+    def _validate_new(self, new_filepaths, erased):
+        """
+        Returns the new paths that already exist on the server. Paths inside
+        of an erased folder (FolderIndex) are not checked.
+        """
         result = []
         for filepath in new_filepaths:
             logger.debug("Checking new file: %s" % filepath)
-            addit = True
-            for folder in erase_folders:
-                if filepath.startswith(folder):
-                    addit = False
-            if addit and self._back_end.exists(filepath):
+            if not erased.covers(filepath) and self._back_end.exists(filepath):
                 logger.debug("Found new file on the server : %s" % filepath)
                 result.append(filepath)
         return result
@@ -693,22 +1407,57 @@ class ManifestUploadManager(base.PublishManager):
     def _changed(self, local_file, remote_file):
         """
         Checks if the checksum has changed or the server file size is wrong.
+        The CRC is used when one of the files has no md5 checksum (e.g. in
+        the archive mode). Only the server sizes read by _get_remote_sizes
+        are checked.
         """
-        if local_file.checksum != remote_file.checksum:
+        if local_file.checksum and remote_file.checksum:
+            if local_file.checksum != remote_file.checksum:
+                return True
+        elif local_file.crc is None or local_file.crc != remote_file.crc:
             return True
 
         if local_file.size != remote_file.size:
             return True
-        else:
-            size = self._back_end.size(remote_file.path)
-            if size != remote_file.size:
+        elif remote_file.path in self._remote_sizes:
+            if self._remote_sizes[remote_file.path] != remote_file.size:
                 return True
 
         return False
 
-    def _get_local_list(self, working_dir, type_mapper=None):
+    def _get_remote_sizes(self, local_list, remote_list):
+        """
+        Reads the server sizes of the files _changed should verify. The sizes
+        are read with one directory listing per folder instead of one request
+        per file. Depending on the verification all, a random sample or none
+        of the files with an unchanged manifest size are verified.
+        """
+        if self._verification == self.VERIFY_NONE:
+            return {}
+        local_files = set(local_list.get_files())
+        paths = [path for path in remote_list.get_files()
+                 if path in local_files and
+                 local_list.get_file(path).size == remote_list.get_file(path).size]
+        if (self._verification == self.VERIFY_SAMPLED and
+                len(paths) > self._verification_sample_size):
+            paths = random.sample(paths, self._verification_sample_size)
+        folders = {}
+        for path in paths:
+            folders.setdefault(os.path.dirname(path), []).append(path)
+        logger.debug("Verifying the size of %d files in %d folders"
+                     % (len(paths), len(folders)))
+        sizes = {}
+        for folder, folder_paths in folders.items():
+            folder_sizes = self._back_end.dir_sizes(folder)
+            for path in folder_paths:
+                # Missing files have no size and are uploaded again
+                sizes[path] = folder_sizes.get(os.path.basename(path))
+        return sizes
+
+    def _get_local_list(self, working_dir, type_mapper=None, checksums=None):
         local_list = FileList()
-        local_list.scan_local_folder(working_dir, type_mapper)
+        local_list.scan_local_folder(working_dir, type_mapper,
+                                     self._scan_workers, checksums)
         return local_list
 
     def _get_remote_list(self):
@@ -729,38 +1478,77 @@ class ManifestUploadManager(base.PublishManager):
         logger.info("Removing old published data")
         files = []
         folders = []
-        content = self._back_end.dir('')
+        # The types are read with the same listing
+        content = self._back_end.dir_entries('')
         logger.debug("Content of base dir is: %s" % content)
-        for entry in content:
+        for entry, entry_type, _size in content:
             # Don't remove hidden stuff on first level
             if not entry.startswith('.'):
-                if self._back_end.type(entry) == 'd':
+                if entry_type == 'd':
                     # Mark this folder as writeable for complete erasing
                     folders.append(FileListFolderEntry(entry, 'c'))
                 else:
                     files.append(FileListFileEntry('./' + entry, 'r', 0, ''))
         filelist = FileList(files, folders)
-        logger.debug(filelist.generate_manifest())
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(filelist.generate_manifest())
         return filelist
 
     def _get_remote_list_from_manifest(self):
         logger.debug("Downloading Manifest")
-        manifest_file = self._back_end.download(self.manifest)
+        manifest = parse_manifest(self._back_end.download(self.manifest))
         remote_list = FileList()
+        remote_list.read_manifest(manifest)
+        remote_list.permission_map = manifest['header'].get('permissions')
+        self._read_manifest_deltas(remote_list, manifest['header'].get('journal', 0))
+        self._stored_permissions = remote_list.permission_map
         if self._back_end.exists(self.manifest_tmp):
             # Ups there is a hopefully broken old session
             # We will calculate a new manifest file out of both files
             # and upload it to clean up the publisher state
             # TODO: Check for parallel execution
             logger.warning("Temporary manifest file found. Trying to recover.")
+            # The modes of a partly synchronized server are unknown
+            remote_list.permission_map = None
             recovery_manifest_file = self._back_end.download(self.manifest_tmp)
-            remote_list.read_json_manifest(manifest_file,
-                                           recovery_manifest_file)
+            remote_list.merge_manifest(parse_manifest(recovery_manifest_file))
             logger.debug("New manifest file calculated")
             logger.debug("Uploading new manifest file")
             # That function also removes the temporary manifest file
-            self._upload_new_manifest(remote_list.generate_manifest())
-        else:
-            logger.debug("Reading remote manifest file")
-            remote_list.read_json_manifest(manifest_file)
+            self._upload_full_manifest(remote_list, [], [])
+            self._back_end.delete_file(self.manifest_tmp)
+        if self._max_manifest_deltas:
+            self._stored_entries = remote_list.get_manifest_entries()
         return remote_list
+
+    def _read_manifest_deltas(self, remote_list, journal):
+        """
+        Applies the manifest deltas newer than the journal sequence number
+        of the manifest to the remote list
+        """
+        self._delta_sequence = journal
+        self._delta_count = 0
+        for sequence in self._list_manifest_deltas():
+            if sequence <= journal:
+                # Left over by an interrupted clean up, already in the manifest
+                continue
+            logger.debug("Reading manifest delta %d" % sequence)
+            delta = parse_manifest(self._back_end.download(self._manifest_delta(sequence)))
+            remote_list.apply_delta(delta)
+            remote_list.permission_map = delta['header'].get('permissions')
+            self._delta_sequence = sequence
+            self._delta_count += 1
+
+    def _list_manifest_deltas(self):
+        """
+        Returns the sorted sequence numbers of the manifest deltas on the server
+        """
+        sequences = []
+        for path in self._back_end.dir(self.get_manifest_folder()):
+            name = os.path.basename(path)
+            if name.startswith(self.MANIFEST_DELTA_PREFIX):
+                try:
+                    sequences.append(int(name[len(self.MANIFEST_DELTA_PREFIX):]))
+                except ValueError:
+                    logger.warning("Unknown file in manifest folder: %s" % name)
+        return sorted(sequences)
@@ -0,0 +1,106 @@
+'''
+Dependency aware scheduling of the synchronization operations.
+
+The operations of a task list only depend on each other along the folder
+tree: a folder has to be created before its content is uploaded and has to be
+emptied before it is deleted. All other operations are independent and can
+run concurrently on several back end connections.
+'''
+from collections import deque
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# Logging support
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Operation(object):
+    """
+    A single back end operation (kind) for a task of the task list
+    """
+    __slots__ = ('kind', 'task')
+
+    def __init__(self, kind, task):
+        self.kind = kind
+        self.task = task
+
+    def __repr__(self):
+        return "<Operation %s %s>" % (self.kind, self.task.task.path)
+
+
+class TaskGraph(object):
+    """
+    Directed acyclic graph of operations. An operation is ready when all
+    operations it depends on are completed.
+    """
+
+    def __init__(self):
+        self._waiting = {}
+        self._dependents = {}
+        self._operations = []
+
+    def __len__(self):
+        return len(self._operations)
+
+    def add(self, operation, dependencies=()):
+        """
+        Adds the operation. The dependencies have to be operations of this
+        graph, None entries are ignored.
+        """
+        dependencies = [dep for dep in dependencies if dep is not None]
+        self._operations.append(operation)
+        self._waiting[operation] = len(dependencies)
+        for dependency in dependencies:
+            self._dependents.setdefault(dependency, []).append(operation)
+
+    def get_ready(self):
+        """
+        Returns the operations without dependencies in the order they were
+        added
+        """
+        return [op for op in self._operations if not self._waiting[op]]
+
+    def complete(self, operation):
+        """
+        Marks the operation as completed and returns the operations that
+        became ready
+        """
+        ready = []
+        for dependent in self._dependents.pop(operation, []):
+            self._waiting[dependent] -= 1
+            if not self._waiting[dependent]:
+                ready.append(dependent)
+        return ready
+
+
+def run_task_graph(graph, workers, execute, completed):
+    """
+    Runs the operations of the graph on at most workers threads.
+
+    execute(operation) is called in the worker threads and
+    completed(operation) in the calling thread after the operation succeeded.
+    After the first failure no further operations are started, the running
+    ones are waited for (and completed) and the exception is raised.
+    """
+    ready = deque(graph.get_ready())
+    running = {}
+    error = None
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        while running or (ready and error is None):
+            while ready and error is None and len(running) < workers:
+                operation = ready.popleft()
+                running[executor.submit(execute, operation)] = operation
+            done, unused = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                operation = running.pop(future)
+                exception = future.exception()
+                if exception is not None:
+                    logger.debug("%r failed: %s" % (operation, exception))
+                    if error is None:
+                        error = exception
+                    continue
+                completed(operation)
+                ready.extend(graph.complete(operation))
+    if error is not None:
+        raise error
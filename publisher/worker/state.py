@@ -0,0 +1,73 @@
+'''
+Coalescing of the job state updates.
+
+Every state update of a publish job is a write to the Celery result back end.
+The managers report a state after every finished task, so the updates are
+throttled before they are stored.
+'''
+import time
+
+# Logging support
+import logging
+logger = logging.getLogger(__name__)
+
+
+class StateReporter(object):
+    """
+    Pushes a state update only when the state (phase) changed, the percent
+    changed by at least min_percent_change or interval seconds passed since
+    the last pushed update. The last dropped update is kept and pushed
+    before the next state (so the final progress of a phase isn't lost) or
+    by flush.
+    """
+
+    def __init__(self, push, interval, min_percent_change=0.01, clock=time.time):
+        self._push = push
+        self.interval = interval
+        self.min_percent_change = min_percent_change
+        self._clock = clock
+        self._last_state = None
+        self._last_percent = None
+        self._last_push = None
+        self._pending = None
+
+    def update(self, state, percent, meta):
+        """
+        Pushes the given state and meta data if the update is meaningful.
+        Returns True when the update was pushed.
+        """
+        now = self._clock()
+        if not self._is_meaningful(state, percent, now):
+            self._pending = (state, percent, meta)
+            return False
+        if state != self._last_state:
+            self.flush()
+        self._do_push(state, percent, meta, now)
+        return True
+
+    def flush(self):
+        """
+        Pushes the last dropped update, e.g. when the job is finished.
+        Returns True when there was one.
+        """
+        if self._pending is None:
+            return False
+        state, percent, meta = self._pending
+        self._do_push(state, percent, meta, self._clock())
+        return True
+
+    def _do_push(self, state, percent, meta, now):
+        self._pending = None
+        self._last_state = state
+        self._last_percent = percent
+        self._last_push = now
+        self._push(state, meta)
+
+    def _is_meaningful(self, state, percent, now):
+        if self._last_push is None or state != self._last_state:
+            return True
+        if now - self._last_push >= self.interval:
+            return True
+        if percent is None or self._last_percent is None:
+            return percent != self._last_percent
+        return abs(percent - self._last_percent) >= self.min_percent_change
@@ -278,7 +278,12 @@ CELERY_RESULT_BACKEND = config.get('celery', 'result-backend')
 # use https://pypi.python.org/pypi/django-celery-results/
 #CELERY_RESULT_BACKEND = 'django-db'
 #CELERY_CACHE_BACKEND = 'django-cache'
-# BROKER_TRANSPORT_OPTIONS = {'visibility_timeout': 60 * 60}
+# Publish jobs are acknowledged late (after they finished), the broker
+# redelivers unacknowledged jobs after the visibility timeout, so it has to
+# be longer than a publish job takes
+CELERY_BROKER_TRANSPORT_OPTIONS = {'visibility_timeout': 12 * 60 * 60}  # 12 h
+# Late acknowledged jobs aren't reserved by a busy worker
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
 
 # TODO: CELERYBEAT_SCHEDULE!!!
 
@@ -294,6 +299,46 @@ CELERY_RESULT_BACKEND = config.get('celery', 'result-backend')
 #
 PUBLISHER_TOKEN_SECRET = config.get('publisher', 'jwt-secret')
 
+# Upper limit for the per job 'connections' back end parameter
+PUBLISHER_MAX_UPLOAD_CONNECTIONS = config.getint('publisher', 'max-upload-connections')
+
+# Number of threads used to hash the local files of a publish job
+PUBLISHER_SCAN_WORKERS = config.getint('publisher', 'scan-workers')
+
+# Max. size (in bytes) of the in memory buffer for downloaded publish archives
+PUBLISHER_DOWNLOAD_SPOOL_SIZE = config.getint('publisher', 'download-spool-size')
+
+# Number of threads used to extract the publish archive
+PUBLISHER_EXTRACT_WORKERS = config.getint('publisher', 'extract-workers')
+
+# Persistent md5 hash cache for unchanged files (max. entries, 0 disables it)
+PUBLISHER_HASH_CACHE_FILE = config.get('publisher', 'hash-cache-file')
+PUBLISHER_HASH_CACHE_SIZE = config.getint('publisher', 'hash-cache-size')
+
+# Read the files of (S)FTP jobs from the publish archive instead of extracting it
+PUBLISHER_ARCHIVE_MODE = config.getboolean('publisher', 'archive-mode')
+
+# Server file size verification of unchanged files: none, sampled or full
+PUBLISHER_VERIFICATION = config.get('publisher', 'verification')
+PUBLISHER_VERIFICATION_SAMPLE_SIZE = config.getint('publisher', 'verification-sample-size')
+
+# Min. seconds between two stored job state updates of the same phase
+PUBLISHER_STATE_UPDATE_INTERVAL = config.getfloat('publisher', 'state-update-interval')
+
+# Number of manifest deltas before the full manifest is uploaded again
+PUBLISHER_MANIFEST_MAX_DELTAS = config.getint('publisher', 'manifest-max-deltas')
+
+# Max. seconds between two disk syncs of the recovery checkpoint journal
+PUBLISHER_CHECKPOINT_SYNC_INTERVAL = config.getfloat('publisher', 'checkpoint-sync-interval')
+
+# Upload block size and SSH window size (0 is the paramiko default) of SFTP jobs
+PUBLISHER_SFTP_CHUNK_SIZE = config.getint('publisher', 'sftp-chunk-size')
+PUBLISHER_SFTP_WINDOW_SIZE = config.getint('publisher', 'sftp-window-size')
+# Idle FTP/SFTP connections kept per worker process for the next jobs
+PUBLISHER_CONNECTION_CACHE_SIZE = config.getint('publisher', 'connection-cache-size')
+PUBLISHER_CONNECTION_IDLE_TIMEOUT = config.getfloat('publisher', 'connection-idle-timeout')
+PUBLISHER_CONNECTION_MAX_AGE = config.getfloat('publisher', 'connection-max-age')
+
 
 # Setting global temp dir for this application
 if config.get('services', 'tempdir'):